@@ -1,8 +1,15 @@
+import asyncio
+import time
+from typing import Iterable
+
 import disnake
 from disnake.ext import commands
 from openai import AsyncOpenAI
 
-from . import config
+from . import config, db
+
+# how long to remember that a channel doesn't exist before asking the API again
+CHANNEL_NOT_FOUND_TTL = 60
 
 
 class Calypso(commands.Bot):
@@ -10,8 +17,13 @@ class Calypso(commands.Bot):
         super().__init__(*args, **kwargs)
         self.openai = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
         self.enc_chatterboxes = dict()
+        # channel id -> in-flight fetch of that channel, shared by everyone waiting for it
+        self._channel_fetches: dict[int, asyncio.Task] = {}
+        # channel id -> time.monotonic() until which it is known not to exist
+        self._missing_channels: dict[int, float] = {}
 
     async def close(self):
+        await db.close_writers()
         await self.openai.close()
         await super().close()
 
@@ -20,8 +32,33 @@ class Calypso(commands.Bot):
         channel = self.get_channel(channel_id)
         if channel is not None:
             return channel
+        if (missing_until := self._missing_channels.get(channel_id)) is not None:
+            if time.monotonic() < missing_until:
+                return None
+            del self._missing_channels[channel_id]
+
+        # coalesce concurrent fetches of the same channel into one request
+        task = self._channel_fetches.get(channel_id)
+        if task is None:
+            task = self._channel_fetches[channel_id] = asyncio.create_task(self._fetch_channel(channel_id))
+            task.add_done_callback(lambda _: self._channel_fetches.pop(channel_id, None))
+        # shielded so that one waiter being cancelled doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def get_or_fetch_channels(self, channel_ids: Iterable[int]) -> dict:
+        """
+        Get or fetch many channels at once, fetching the uncached ones concurrently.
+        Returns a dict of channel id -> channel, or None if it does not exist.
+        """
+        unique_ids = list(dict.fromkeys(channel_ids))
+        channels = await asyncio.gather(*(self.get_or_fetch_channel(channel_id) for channel_id in unique_ids))
+        return dict(zip(unique_ids, channels))
+
+    async def _fetch_channel(self, channel_id: int):
         try:
-            channel = await self.fetch_channel(channel_id)
+            return await self.fetch_channel(channel_id)
         except disnake.NotFound:
+            now = time.monotonic()
+            self._missing_channels = {k: v for k, v in self._missing_channels.items() if v > now}
+            self._missing_channels[channel_id] = now + CHANNEL_NOT_FOUND_TTL
             return None
-        return channel
@@ -0,0 +1,56 @@
+"""
+A content-addressed store for large binary blobs (e.g. generated images) on the filesystem, so that they don't live in
+the DB. Rows keep the blob's hash instead.
+
+Blobs are stored at ``<root>/<hash[:2]>/<hash[2:4]>/<hash>`` so that no directory gets too large, and written to a
+temporary file that is then renamed into place, so that a blob is either fully written or not there at all. File IO
+runs in a thread, off the event loop.
+"""
+
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from . import config
+
+
+class BlobStore:
+    def __init__(self, root: str | os.PathLike):
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key[2:4] / key
+
+    async def put(self, data: bytes) -> str:
+        """Store a blob if it isn't already stored, and return its hash."""
+        key = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, key, data)
+        return key
+
+    async def get(self, key: str) -> bytes:
+        """Read a stored blob. Raises FileNotFoundError if there is no blob with the given hash."""
+        return await asyncio.to_thread(self.path(key).read_bytes)
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(self.path(key).is_file)
+
+    def _write(self, key: str, data: bytes):
+        path = self.path(key)
+        if path.is_file():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+blob_store = BlobStore(config.BLOB_STORE_PATH)
@@ -1,3 +1,4 @@
+import datetime
 import io
 import textwrap
 import traceback
@@ -5,12 +6,21 @@ from contextlib import redirect_stdout
 
 from disnake.ext import commands
 
+from calypso import db
+from calypso.cogs.ai import queries as ai_queries
+from calypso.cogs.ai.usage import percentile, usage_report
+from calypso.cogs.msglog.backfill import BackfillProgress, backfill_guild
+from calypso.cogs.msglog.prune import prune_candidates, prune_members
+from calypso.errors import CalypsoError
+from calypso.utils.functions import chunk_text
+
 ADMIN_IDS = [187421759484592128, 197519973650923520]
 
 
 class Admin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.backfill_progress: BackfillProgress | None = None
 
     def cleanup_code(self, content):
         """Automatically removes code blocks from the code."""
@@ -65,6 +75,87 @@ class Admin(commands.Cog):
             else:
                 await ctx.send("```py\n{}{}\n```".format(value, ret))
 
+    @commands.command(hidden=True, name="aiusage")
+    async def ai_usage(self, ctx, hours: float = 24):
+        """Reports latency, token usage, and prompt cache hit ratio per AI feature over the last N hours."""
+        if ctx.author.id not in ADMIN_IDS:
+            return
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+        async with db.async_session() as session:
+            records = await ai_queries.get_usage_records_since(session, since)
+        await ctx.send(f"**AI usage in the last {hours:g} hours**")
+        for chunk in chunk_text(usage_report(records), max_chunk_size=1900, chunk_on=("\n",)):
+            await ctx.send(f"```\n{chunk}\n```")
+
+    @commands.command(hidden=True, name="dbwriters")
+    async def db_writers(self, ctx):
+        """Reports the queue depth, throughput, and flush latency of each batched DB writer since startup."""
+        if ctx.author.id not in ADMIN_IDS:
+            return
+
+        lines = []
+        for writer in db.writers():
+            stats = writer.stats()
+            latencies = list(stats.flush_latencies)
+            p50, p95 = percentile(latencies, 50), percentile(latencies, 95)
+            flush_latency = f"p50 {p50 * 1000:.0f}ms p95 {p95 * 1000:.0f}ms" if latencies else "-"
+            lines.append(
+                f"{writer.name}: {stats.queue_depth} queued (max {stats.max_queue_depth}),"
+                f" {stats.items_written} items in {stats.batches_written} batches ({stats.batches_failed} failed,"
+                f" {stats.items_dropped} items dropped)\n"
+                f"  flush latency (last {len(latencies)}): {flush_latency}"
+            )
+        await ctx.send("```\n{}\n```".format("\n".join(lines) or "No batch writers."))
+
+    @commands.command(hidden=True, name="backfill")
+    @commands.guild_only()
+    async def message_log_backfill(self, ctx):
+        """
+        Backfills the message log of this server from the API, resuming each channel from where the last backfill left
+        off. If a backfill is already running, reports its progress instead.
+        """
+        if ctx.author.id not in ADMIN_IDS:
+            return
+
+        if self.backfill_progress is not None:
+            await ctx.send(f"A backfill is already running: {self.backfill_progress}")
+            return
+        self.backfill_progress = BackfillProgress()
+        await ctx.send("Backfilling the message log...")
+        try:
+            progress = await backfill_guild(ctx.guild, self.backfill_progress)
+        finally:
+            self.backfill_progress = None
+        await ctx.send(f"Backfill done: {progress}")
+
+    @commands.command(hidden=True, name="prune")
+    @commands.guild_only()
+    async def prune(self, ctx, inactive_days: int = 7, confirm: str = None):
+        """
+        Lists the members who joined, and haven't sent a message, in the last N days (except those with a protected
+        role). Run with `confirm` to actually kick them, e.g. `prune 7 confirm`.
+        """
+        if ctx.author.id not in ADMIN_IDS:
+            return
+
+        try:
+            candidates = await prune_candidates(ctx.guild, inactive_days)
+        except CalypsoError as e:
+            await ctx.send(str(e))
+            return
+
+        if confirm != "confirm":
+            names = ", ".join(member.display_name for member in candidates) or "nobody"
+            await ctx.send(f"**Dry run**: {len(candidates)} members would be pruned")
+            for chunk in chunk_text(names, max_chunk_size=1900, chunk_on=(", ",)):
+                await ctx.send(chunk)
+            return
+
+        await ctx.send(f"Pruning {len(candidates)} members...")
+        n_kicked = await prune_members(candidates, inactive_days)
+        await ctx.send(f"Pruned {n_kicked} members.")
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
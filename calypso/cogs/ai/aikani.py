@@ -1,41 +1,198 @@
+import asyncio
 import datetime
 import itertools
+import logging
 from typing import Annotated, Any, TYPE_CHECKING
 
 import disnake
-from disnake import ChannelType, Guild
+from disnake import ChannelType
 from disnake.http import Route
 from disnake.utils import snowflake_time, time_snowflake
-from kani import AIParam, ChatMessage, ChatRole, Kani, ai_function
+from kani import AIParam, ChatMessage, ChatRole, FunctionCall, FunctionCallResult, Kani, ai_function
 
-from calypso import constants, db, models
+from calypso import db, models
+from calypso.cogs.msglog.history import get_logged_history
+from calypso.cogs.msglog.search import search_logged_messages
+from . import queries
+from .discovery import discovery_cache, paginate
 from .memory import (
+    get_memory_tree,
     memory_create,
     memory_delete,
     memory_insert,
     memory_rename,
+    memory_search,
     memory_str_replace,
     memory_view,
+    render_user_memories,
+    user_memory_dir,
 )
-from .prompts import chat_prompt
+from .prompts import (
+    COMPACTION_PROMPT,
+    chat_prompt,
+    compaction_summary_message,
+    compaction_transcript,
+    logged_message_prompt,
+    user_memories_message,
+)
+from .usage import usage_context
+from .visibility import is_public
 
 if TYPE_CHECKING:
     from calypso import Calypso
 
+log = logging.getLogger(__name__)
+
+# the maximum number of tool calls from a single round to run at once
+TOOL_CALL_CONCURRENCY = 4
+# tools that change state; these run one at a time, in the order the model requested them
+MUTATING_TOOLS = {"rename_thread", "react", "memory"}
+
 
 class AIKani(Kani):
-    def __init__(self, *args, bot: "Calypso", channel_id: int, chat_session_id=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        bot: "Calypso",
+        channel_id: int,
+        chat_session_id=None,
+        compaction_threshold: int = None,
+        compaction_keep_tokens: int = 0,
+        compacted_messages: int = 0,
+        **kwargs,
+    ):
+        """
+        :param compaction_threshold: If set, summarize the oldest turns of the chat history once it is longer than this
+            many tokens.
+        :param compaction_keep_tokens: When compacting, keep the most recent turns that fit in this many tokens.
+        :param compacted_messages: The number of raw chat messages that the summary at the start of the given chat
+            history replaces (0 if it does not start with a summary).
+        """
         super().__init__(*args, **kwargs)
         self.bot = bot
         self.channel_id = channel_id
         self.chat_session_id = chat_session_id
         self.chat_title = None
         self.last_user_message_id = None
+        self.compaction_threshold = compaction_threshold
+        self.compaction_keep_tokens = compaction_keep_tokens
+        self.compacted_messages = compacted_messages
+        self._tool_call_semaphore = asyncio.Semaphore(TOOL_CALL_CONCURRENCY)
+        self._mutating_tool_lock = asyncio.Lock()
+        # the usernames of the users who have spoken in this chat, whose memories are prefetched into the prompt
+        self.participants: list[str] = []
+        self._base_always_included_messages = list(self.always_included_messages)
+        self._user_memories_key = None
 
     @property
     def last_user_message(self) -> ChatMessage | None:
         return next((m for m in self.chat_history if m.role == ChatRole.USER), None)
 
+    # ==== tool calls ====
+    async def do_function_call(self, call: FunctionCall, tool_call_id: str = None) -> FunctionCallResult:
+        # kani runs all the tool calls in a round concurrently (and adds the results to the history in the original
+        # order); we just cap how many run at once and keep the ones with side effects serialized
+        if call.name in MUTATING_TOOLS:
+            async with self._mutating_tool_lock, self._tool_call_semaphore:
+                return await super().do_function_call(call, tool_call_id)
+        async with self._tool_call_semaphore:
+            return await super().do_function_call(call, tool_call_id)
+
+    # ==== prompt ====
+    async def get_prompt(self, include_functions=True, **kwargs) -> list[ChatMessage]:
+        if self._user_memories_key is None:
+            await self.refresh_user_memories()
+        await self.maybe_compact()
+        return await super().get_prompt(include_functions=include_functions, **kwargs)
+
+    async def add_to_history(self, message: ChatMessage):
+        # only refresh the prefetched memories when a user turn starts: the block sits right after the system prompt, so
+        # changing it in the middle of a tool loop (e.g. after a memory write) would invalidate the cache for the whole
+        # history on the next round
+        if message.role == ChatRole.USER:
+            await self.refresh_user_memories()
+        await super().add_to_history(message)
+
+    def add_participant(self, username: str):
+        if username not in self.participants:
+            self.participants.append(username)
+
+    async def refresh_user_memories(self):
+        """
+        Prefetch the memories of the chat's participants into the prompt, right after the system prompt (so that the
+        system prompt and tools stay cached on their own). Called at the start of each user turn; the message is only
+        rebuilt if a participant has joined or one of their memory files has changed since the last call.
+        """
+        tree = await get_memory_tree()
+        key = tuple((username, tree.version(user_memory_dir(username))) for username in self.participants)
+        if key == self._user_memories_key:
+            return
+        self._user_memories_key = key
+        memories = render_user_memories(tree, self.participants)
+        self.always_included_messages = self._base_always_included_messages + (
+            [user_memories_message(memories)] if memories else []
+        )
+
+    # ==== compaction ====
+
+    async def maybe_compact(self):
+        """
+        If the chat history is longer than the compaction threshold, replace its oldest turns with a summary.
+        The summarized messages are kept in ai_chat_messages_raw, and the summary is saved to ai_chat_summaries.
+        """
+        if self.compaction_threshold is None:
+            return
+        estimator = self.engine.token_estimator
+        if estimator.estimate(self.chat_history) <= self.compaction_threshold:
+            return
+
+        # only cut the history at the start of a user turn, so we never split a tool call from its result
+        start = 1 if self.compacted_messages else 0
+        turn_starts = [i for i, m in enumerate(self.chat_history) if i > start and m.role == ChatRole.USER]
+        if not turn_starts:
+            return
+        # keep as many recent turns as fit in the budget, but always compact everything before the current turn
+        cut = next(
+            (i for i in turn_starts if estimator.estimate(self.chat_history[i:]) <= self.compaction_keep_tokens),
+            turn_starts[-1],
+        )
+
+        with usage_context("ai_chat_compaction", session_id=self.chat_session_id):
+            completion = await self.engine.predict(
+                [
+                    ChatMessage.system(COMPACTION_PROMPT),
+                    ChatMessage.user(compaction_transcript(self.chat_history[:cut])),
+                ],
+                tool_choice={"type": "none"},
+            )
+        summary = completion.message.text
+        if not summary:
+            log.warning(f"Compaction of chat {self.chat_session_id} returned an empty summary")
+            return
+        n_messages = self.compacted_messages + cut - start
+
+        async with db.async_session() as session:
+            session.add(models.AIChatSummary(chat_id=self.chat_session_id, n_messages=n_messages, content=summary))
+            await session.commit()
+        self.chat_history[:cut] = [compaction_summary_message(summary)]
+        self.compacted_messages = n_messages
+        log.info(f"Compacted the first {n_messages} messages of chat {self.chat_session_id}")
+
+    @ai_function()
+    async def get_tool_result(self, tool_call_id: str):
+        """
+        Retrieve the full result of an earlier tool call by its ID.
+        Use this when the conversation summary refers to a tool result whose details you need.
+        """
+        async with db.async_session() as session:
+            rows = await queries.get_chat_messages(session, self.chat_session_id)
+        # the messages are stored compressed, so they can't be searched in the DB
+        for row in rows:
+            if row.data.get("role") != ChatRole.FUNCTION.value or row.data.get("tool_call_id") != tool_call_id:
+                continue
+            return ChatMessage.model_validate(row.data).text
+        raise ValueError(f"There is no tool result with the ID {tool_call_id!r} in this chat")
+
     # ==== meta ====
     @ai_function(enabled=False, json_schema={}, desc="managed by claude server")
     async def memory(self, command: str, **kwargs):
@@ -68,6 +225,19 @@ class AIKani(Kani):
             case _:
                 raise ValueError("Unknown or malformed memory command")
 
+    @ai_function()
+    async def memory_search(
+        self,
+        query: Annotated[str, AIParam(desc="The words to search for. Files must contain all of them.")],
+        path: Annotated[str, AIParam(desc="Only search files at or beneath this path.")] = "/memories",
+    ):
+        """
+        Search the files in your memory directory by the words they contain.
+        Returns the matching files, with the line numbers and text of the lines that match.
+        Use this to find what you remember about a topic or user instead of viewing each file.
+        """
+        return await memory_search(query, path)
+
     # ==== discord ====
     @ai_function()
     async def rename_thread(self, title: str):
@@ -108,34 +278,34 @@ class AIKani(Kani):
         return "Added a reaction."
 
     @ai_function()
-    async def list_channels(self):
+    async def list_channels(self, page: int = 1):
         """
         List the publicly-visible channels in the Discord server.
         Returns the channel names, types, and IDs. Does not include threads; use list_threads(channel_id) to list threads.
+        Long lists are paginated; use `page` to see more.
         """
         channel = await self.bot.get_or_fetch_channel(self.channel_id)
         guild = channel.guild
 
-        out = []
-        for category, channels in guild.by_category():
-            # filter to ones only players/members can see to prevent leeks
-            visible_channels = [
-                c
-                for c in channels
-                if is_public_to_roles(guild, [constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID], c)
-            ]
-            if not visible_channels:
-                continue
+        if (lines := discovery_cache.get_channels(guild.id)) is None:
+            lines = []
+            for category, channels in guild.by_category():
+                # filter to ones only players/members can see to prevent leeks
+                visible_channels = [c for c in channels if is_public(c)]
+                if not visible_channels:
+                    continue
 
-            # list the channels
-            channel_list = [f"{ch.name} ({ch.type.name}, ID: {ch.id})" for ch in visible_channels]
-            if category:
-                channel_list_indented = "\n".join(f"|- {c}" for c in channel_list)
-                out.append(f"## {category.name}\n{channel_list_indented}")
-            else:
-                out.append("\n".join(channel_list))
-        channel_list_str = "\n\n".join(out)
-        return f"# Channels in {guild.name}\n\n{channel_list_str}"
+                # list the channels
+                if lines:
+                    lines.append("")
+                channel_list = [f"{ch.name} ({ch.type.name}, ID: {ch.id})" for ch in visible_channels]
+                if category:
+                    lines.append(f"## {category.name}")
+                    lines.extend(f"|- {c}" for c in channel_list)
+                else:
+                    lines.extend(channel_list)
+            discovery_cache.set_channels(guild.id, lines)
+        return paginate(f"# Channels in {guild.name}", lines, page)
 
     @ai_function()
     async def list_threads(
@@ -145,38 +315,49 @@ class AIKani(Kani):
         archived_before: Annotated[
             str, AIParam(desc="Retrieve archived threads sent before this timestamp or thread ID.")
         ] = None,
+        page: int = 1,
     ):
         """
         List the public threads in a given channel.
         Returns the thread names and IDs, and last message time.
         If `include_archived` is true, includes archived threads in batches of 50. Use `archived_before` to paginate. Always true for forum channels.
+        Long lists are paginated; use `page` to see more.
         """
-        invoker_channel = await self.bot.get_or_fetch_channel(self.channel_id)
-        target_channel = await self.bot.get_or_fetch_channel(channel_id)
+        channels = await self.bot.get_or_fetch_channels([self.channel_id, channel_id])
+        invoker_channel, target_channel = channels[self.channel_id], channels[channel_id]
         if not target_channel:
             raise ValueError("Target channel does not exist")
         if target_channel.guild != invoker_channel.guild:
             raise ValueError("Cannot list threads of a channel in a different guild")
-        if not is_public_to_roles(
-            target_channel.guild, [constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID], target_channel
-        ):
+        if not is_public(target_channel):
             raise ValueError("Cannot list threads of a private channel")
 
-        visible_threads = []
-        for t in target_channel.threads:
-            if not is_public_to_roles(invoker_channel.guild, [constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID], t):
-                continue
-            if t.is_private() or t.archived:
-                continue
-            visible_threads.append(t)
-        # include archived threads for forums or if archived pagination set
-        if target_channel.type == ChannelType.forum:
-            async for t in target_channel.archived_threads(limit=None):
-                visible_threads.append(t)
-        elif include_archived:
-            async for t in target_channel.archived_threads(before=archived_before):
+        # the first batch of each list is cached; archived_before pages always come from the API
+        guild_id = target_channel.guild.id
+        include_archived = include_archived or target_channel.type == ChannelType.forum
+        visible_threads = None
+        if archived_before is None:
+            visible_threads = discovery_cache.get_threads(guild_id, target_channel.id, include_archived)
+
+        if visible_threads is None:
+            visible_threads = []
+            for t in target_channel.threads:
+                if not is_public(t):
+                    continue
+                if t.is_private() or t.archived:
+                    continue
                 visible_threads.append(t)
+            # include archived threads for forums or if archived pagination set
+            if target_channel.type == ChannelType.forum:
+                async for t in target_channel.archived_threads(limit=None):
+                    visible_threads.append(t)
+            elif include_archived:
+                async for t in target_channel.archived_threads(before=archived_before):
+                    visible_threads.append(t)
+            if archived_before is None:
+                discovery_cache.set_threads(guild_id, target_channel.id, include_archived, visible_threads)
 
+        # rendered on every call, since the threads' last messages change as messages are sent
         thread_list = []
         for t in visible_threads:
             if t.last_message_id:
@@ -186,26 +367,18 @@ class AIKani(Kani):
                 )
             else:
                 thread_list.append(f"{t.name} (ID: {t.id}, no messages)")
-        thread_list_str = "\n".join(thread_list)
-        return f"# Threads in {target_channel.name}\n\n{thread_list_str}"
+        return paginate(f"# Threads in {target_channel.name}", thread_list, page)
 
     @ai_function()
-    async def list_members(self, name: str = None):
+    async def list_members(self, name: str = None, page: int = 1):
         """
         List the members in the Discord server (whose display names contain `name` if set).
         Returns the members' ID, username, display name, and relevant roles.
+        Long lists are paginated; use `page` to see more.
         """
         channel = await self.bot.get_or_fetch_channel(self.channel_id)
-        members = channel.guild.members
-        if name is not None:
-            members = [m for m in members if name.lower() in m.display_name.lower()]
-        member_list = []
-        for m in members:
-            relevant_role_list = [r for r in m.roles if r.id in (constants.STAFF_ROLE_ID, constants.DM_ROLE_ID)]
-            relevant_roles = f", roles: {', '.join(r.name for r in relevant_role_list)}" if relevant_role_list else ""
-            member_list.append(f"{m.display_name} (ID: {m.id}, username: {m.name}{relevant_roles})")
-        member_list_str = "\n".join(member_list)
-        return f"# Members in {channel.guild.name}\n\n{member_list_str}"
+        member_list = discovery_cache.member_index(channel.guild).search(name)
+        return paginate(f"# Members in {channel.guild.name}", member_list, page)
 
     @ai_function()
     async def get_channel_history(
@@ -221,15 +394,13 @@ class AIKani(Kani):
         At most one of `before` or `after` should be set for search/pagination purposes.
         If `before` or `after` is a date, it should be formatted in `YYYY-MM-DD HH:mm:ss` format.
         """
-        invoker_channel = await self.bot.get_or_fetch_channel(self.channel_id)
-        target_channel = await self.bot.get_or_fetch_channel(channel_id)
+        channels = await self.bot.get_or_fetch_channels([self.channel_id, channel_id])
+        invoker_channel, target_channel = channels[self.channel_id], channels[channel_id]
         if not target_channel:
             raise ValueError("Target channel does not exist")
         if target_channel.guild != invoker_channel.guild:
             raise ValueError("Cannot view a channel in a different guild")
-        if not is_public_to_roles(
-            target_channel.guild, [constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID], target_channel
-        ):
+        if not is_public(target_channel):
             raise ValueError("Cannot view a private channel")
 
         if before:
@@ -237,6 +408,11 @@ class AIKani(Kani):
         if after:
             after = ensure_datetime_or_id(after, "%Y-%m-%d %H:%M:%S")
 
+        # serve from the message log if it has everything, otherwise fall back to the API
+        logged_messages = await get_logged_history(target_channel, limit=n, before=before, after=after)
+        if logged_messages is not None:
+            return "\n\n".join(logged_message_prompt(m) for m in logged_messages)
+
         messages = await target_channel.history(limit=n, before=before, after=after).flatten()
         messages = sorted(messages, key=lambda m: m.id)
         return "\n\n".join(chat_prompt(m) for m in messages)
@@ -275,20 +451,50 @@ class AIKani(Kani):
         """
         invoker_channel = await self.bot.get_or_fetch_channel(self.channel_id)
         guild = invoker_channel.guild
-        # todo we do this manually since it's not in disnake yet
-        r = Route("GET", "/guilds/{guild_id}/messages/search", guild_id=guild.id)
-        params: dict[str, Any] = {"limit": limit}
-        if offset is not None:
-            params["offset"] = offset
         if before is not None:
             before = ensure_datetime_or_id(before, "%Y-%m-%d %H:%M:%S")
             if isinstance(before, datetime.datetime):
                 before = time_snowflake(before, high=False)
-            params["max_id"] = before
         if after is not None:
             after = ensure_datetime_or_id(after, "%Y-%m-%d %H:%M:%S")
             if isinstance(after, datetime.datetime):
                 after = time_snowflake(after, high=False)
+
+        # search the message log first: it's faster, isn't limited to 25 results, and has recent messages that Discord
+        # hasn't indexed yet
+        if link_hostname is None:
+            logged_results = await search_logged_messages(
+                guild.id,
+                content=content,
+                channel_ids=channel_id,
+                author_ids=author_id,
+                pinned=pinned,
+                before=before,
+                after=after,
+                sort_by=sort_by,
+                sort_order=sort_order,
+                limit=limit,
+                offset=offset or 0,
+            )
+            if logged_results is not None:
+                total_results, logged_messages = logged_results
+                channels = await self.bot.get_or_fetch_channels(m.channel_id for m in logged_messages)
+                message_results = []
+                for m in sorted(logged_messages, key=lambda m: m.message_id):
+                    channel = channels[m.channel_id]
+                    if channel is None or not is_public(channel):
+                        continue
+                    message_results.append(f"In {channel.name} ({channel.id})\n" + logged_message_prompt(m))
+                return f"# Search Results\n{total_results} results\n\n" + "\n\n".join(message_results)
+
+        # todo we do this manually since it's not in disnake yet
+        r = Route("GET", "/guilds/{guild_id}/messages/search", guild_id=guild.id)
+        params: dict[str, Any] = {"limit": limit}
+        if offset is not None:
+            params["offset"] = offset
+        if before is not None:
+            params["max_id"] = before
+        if after is not None:
             params["min_id"] = after
         if content is not None:
             params["content"] = content
@@ -314,11 +520,13 @@ class AIKani(Kani):
 
         # build message objects
         messages = []
-        for msg_data in itertools.chain.from_iterable(resp["messages"]):
-            channel = await self.bot.get_or_fetch_channel(msg_data["channel_id"])
-            msg = self.bot._connection.create_message(channel=channel, data=msg_data)
-            if not is_public_to_roles(channel.guild, [constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID], channel):
+        msg_datas = list(itertools.chain.from_iterable(resp["messages"]))
+        channels = await self.bot.get_or_fetch_channels(int(msg_data["channel_id"]) for msg_data in msg_datas)
+        for msg_data in msg_datas:
+            channel = channels[int(msg_data["channel_id"])]
+            if channel is None or not is_public(channel):
                 continue
+            msg = self.bot._connection.create_message(channel=channel, data=msg_data)
             messages.append(msg)
         messages = sorted(messages, key=lambda m: m.id)
 
@@ -329,12 +537,6 @@ class AIKani(Kani):
         return f"# Search Results\n{resp['total_results']} results\n\n{message_results}"
 
 
-def is_public_to_roles(guild: Guild, role_ids: list[int], channel, reduce=any):
-    if channel.type == ChannelType.private_thread:
-        return False
-    return reduce(channel.permissions_for(guild.get_role(r)).view_channel for r in role_ids)
-
-
 def ensure_datetime_or_id(x: str, strptime_fmt="%Y-%m-%d %H:%M:%S"):
     try:
         return datetime.datetime.strptime(x, strptime_fmt)
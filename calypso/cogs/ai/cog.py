@@ -5,19 +5,30 @@ import io
 import json
 import logging
 import re
+import time
 
 import disnake
 from disnake.ext import commands
 from kani import ChatMessage, ChatRole
-from kani.engines.anthropic import AnthropicUnknownPart
-from kani.engines.anthropic.parts import AnthropicThinkingPart
 
-from calypso import Calypso, config, constants, db, models
-from calypso.utils.functions import send_chunked
+from calypso import Calypso, config, constants, db, models, prompt_store
+from calypso.blob_store import blob_store
 from . import queries
 from .aikani import AIKani
-from .engines import CHAT_DESIRED_RESPONSE_TOKENS, CHAT_HYPERPARAMS, chat_engine
-from .prompts import AI_CHAT_PROMPT, chat_prompt
+from . import visibility
+from .discovery import discovery_cache
+from .engines import (
+    CHAT_COMPACTION_KEEP_TOKENS,
+    CHAT_COMPACTION_THRESHOLD,
+    CHAT_DESIRED_RESPONSE_TOKENS,
+    CHAT_HYPERPARAMS,
+    chat_engine,
+)
+from .prompts import AI_CHAT_PROMPT, chat_prompt, compaction_summary_message
+from .scheduler import ai_scheduler, queue_feedback
+from .streaming import StreamingRenderer
+from .transcripts import transcript_writer
+from .usage import record_usage, usage_context
 
 log = logging.getLogger(__name__)
 
@@ -152,55 +163,121 @@ class AIUtils(commands.Cog):
 
         # create the prompt and add it to the channel buffer
         chatter.last_user_message_id = message.id
+        chatter.add_participant(message.author.name)
         prompt = chat_prompt(message)
         self.chat_input_buffer[message.channel.id].append(prompt)
 
         # sleep 250ms to debounce messages
         await asyncio.sleep(0.25)
 
-        async with db.async_session() as session:
-            # if the lock is held, terminate here; otherwise enter the buffer consumption loop
-            if chatter.lock.locked():
-                return
-
-            # consume all messages from the input buffer until we have none left (future discord messages might add to
-            # the buf before we are done processing one)
-            async with message.channel.typing():
-                while buf := self.chat_input_buffer[message.channel.id]:
-                    prompt = "\n\n".join(buf)
-                    buf.clear()
+        # if the lock is held, terminate here; otherwise enter the buffer consumption loop
+        if chatter.lock.locked():
+            return
 
-                    user_msg = models.AIChatMessageRaw(
-                        chat_id=chatter.chat_session_id,
-                        data=ChatMessage.user(prompt).model_dump(mode="json", fallback=repr),
-                    )
-                    session.add(user_msg)
-                    await session.commit()
-
-                    try:
-                        async for stream in chatter.full_round_stream(
-                            prompt, cache_control={"type": "ephemeral"}, max_function_rounds=32
-                        ):
-                            msg = await stream.message()
+        # if Calypso is busy, let the channel know (once per batch of messages)
+        notified_queued = False
+
+        async def notify_queued(position):
+            nonlocal notified_queued
+            if not notified_queued:
+                notified_queued = True
+                await message.channel.send(f"-# > Calypso is busy! You're #{position} in line.")
+
+        # consume all messages from the input buffer until we have none left (future discord messages might add to
+        # the buf before we are done processing one)
+        async with message.channel.typing():
+            while buf := self.chat_input_buffer[message.channel.id]:
+                prompt = "\n\n".join(buf)
+                buf.clear()
+
+                # record msgs in db (written in the background)
+                transcript_writer.add_chat_message(chatter.chat_session_id, ChatMessage.user(prompt))
+
+                try:
+                    with (
+                        usage_context("ai_chat", session_id=chatter.chat_session_id, user_id=message.author.id),
+                        queue_feedback(notify_queued),
+                    ):
+                        async for stream in chatter.full_round_stream(prompt, max_function_rounds=32):
+                            if stream.role == ChatRole.ASSISTANT:
+                                renderer = StreamingRenderer(message.channel)
+                                async for token in stream:
+                                    renderer.feed(token)
+                                msg = await stream.message()
+                                await renderer.finish(msg)
+                            else:
+                                msg = await stream.message()
                             log.debug(msg)
-                            if msg.role == ChatRole.ASSISTANT:
-                                await send_ai_msg(message.channel, msg)
-
-                            # record msg in db
-                            model_msg = models.AIChatMessageRaw(
-                                chat_id=chatter.chat_session_id, data=msg.model_dump(mode="json", fallback=repr)
-                            )
-                            session.add(model_msg)
-                            await session.commit()
-                    except Exception as e:
-                        log.warning("Failed to generate AI chat message", exc_info=e)
-                        await message.channel.send(f"-# > Calypso failed with error: {e}")
+                            transcript_writer.add_chat_message(chatter.chat_session_id, msg)
+                except Exception as e:
+                    log.warning("Failed to generate AI chat message", exc_info=e)
+                    await message.channel.send(f"-# > Calypso failed with error: {e}")
 
     @commands.Cog.listener()
     async def on_thread_update(self, _, after: disnake.Thread):
         if after.archived and after.id in self.chats:
             del self.chats[after.id]
 
+    # ==== discovery cache/visibility invalidation ====
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: disnake.abc.GuildChannel):
+        visibility.on_channel_update(channel)
+        discovery_cache.invalidate_channels(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: disnake.abc.GuildChannel):
+        visibility.on_channel_delete(channel)
+        discovery_cache.invalidate_channels(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, _, after: disnake.abc.GuildChannel):
+        visibility.on_channel_update(after)
+        discovery_cache.invalidate_channels(after.guild.id)
+
+    @commands.Cog.listener("on_guild_role_create")
+    @commands.Cog.listener("on_guild_role_delete")
+    async def on_guild_role_change(self, role: disnake.Role):
+        visibility.on_role_update(role.guild)
+        discovery_cache.invalidate_channels(role.guild.id)
+        discovery_cache.invalidate_members(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, _, after: disnake.Role):
+        visibility.on_role_update(after.guild)
+        discovery_cache.invalidate_channels(after.guild.id)
+        discovery_cache.invalidate_members(after.guild.id)
+
+    @commands.Cog.listener("on_thread_create")
+    @commands.Cog.listener("on_thread_delete")
+    async def on_thread_change(self, thread: disnake.Thread):
+        discovery_cache.invalidate_threads(thread.guild.id, thread.parent_id)
+
+    @commands.Cog.listener("on_thread_update")
+    async def on_thread_update_discovery(self, _, after: disnake.Thread):
+        discovery_cache.invalidate_threads(after.guild.id, after.parent_id)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: disnake.RawThreadDeleteEvent):
+        discovery_cache.invalidate_threads(payload.guild_id, payload.parent_id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: disnake.Member):
+        discovery_cache.update_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, _, after: disnake.Member):
+        discovery_cache.update_member(after)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload: disnake.RawGuildMemberRemoveEvent):
+        discovery_cache.remove_member(payload.guild_id, payload.user.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, _, after: disnake.User):
+        for guild in after.mutual_guilds:
+            if (member := guild.get_member(after.id)) is not None:
+                discovery_cache.update_member(member)
+
     @ai.sub_command(name="chat", description="Chat with Calypso (experimental).")
     async def ai_chat(
         self,
@@ -237,14 +314,19 @@ class AIUtils(commands.Cog):
             engine=chat_engine,
             system_prompt=AI_CHAT_PROMPT,
             desired_response_tokens=CHAT_DESIRED_RESPONSE_TOKENS,
+            compaction_threshold=CHAT_COMPACTION_THRESHOLD,
+            compaction_keep_tokens=CHAT_COMPACTION_KEEP_TOKENS,
         )
+        chatter.add_participant(inter.author.name)
 
         # register session in db
+        prompt_json = json.dumps([m.model_dump(mode="json", exclude_none=True) for m in await chatter.get_prompt()])
+        prompt_hash = await prompt_store.store_prompt(prompt_json)
         async with db.async_session() as session:
             brainstorm = models.AIOpenEndedChat(
                 channel_id=inter.channel_id,
                 author_id=inter.author.id,
-                prompt=json.dumps([m.model_dump(mode="json", exclude_none=True) for m in await chatter.get_prompt()]),
+                prompt_hash=prompt_hash,
                 hyperparams=json.dumps(CHAT_HYPERPARAMS),
                 thread_id=thread.id,
             )
@@ -257,7 +339,8 @@ class AIUtils(commands.Cog):
         await thread.add_user(inter.author)
 
     async def _ai_chat_maybe_resume(self, inter: disnake.ApplicationCommandInteraction):
-        # load the messages from db
+        # load the messages from db (making sure any queued messages from a recently closed chat are written first)
+        await transcript_writer.flush()
         async with db.async_session() as session:
             chat_info = await queries.get_chat_thread(session, inter.channel.id)
             if not chat_info:
@@ -267,14 +350,19 @@ class AIUtils(commands.Cog):
                 )
                 return
             messages_raw = await queries.get_chat_messages(session, chat_info.id)
+            summary = await queries.get_latest_chat_summary(session, chat_info.id)
 
-        # validate
+        # validate (only the messages after the latest summary are sent to the model)
+        compacted_messages = summary.n_messages if summary is not None else 0
         try:
-            messages = [ChatMessage.model_validate(m.data) for m in messages_raw]
+            messages = [ChatMessage.model_validate(m.data) for m in messages_raw[compacted_messages:]]
         except Exception as e:
             log.error("Failed to load AI chat history", exc_info=e)
             await inter.send("Could not load the chat history for this thread. Sorry :(")
             return
+        await chat_engine.token_estimator.preload(messages)
+        if summary is not None:
+            messages.insert(0, compaction_summary_message(summary.content))
 
         # create the kani and add to active memory
         chatter = AIKani(
@@ -285,11 +373,15 @@ class AIUtils(commands.Cog):
             desired_response_tokens=CHAT_DESIRED_RESPONSE_TOKENS,
             chat_session_id=chat_info.id,
             chat_history=messages,
+            compaction_threshold=CHAT_COMPACTION_THRESHOLD,
+            compaction_keep_tokens=CHAT_COMPACTION_KEEP_TOKENS,
+            compacted_messages=compacted_messages,
         )
+        chatter.add_participant(inter.author.name)
 
         # begin chat
         self.chats[inter.channel.id] = chatter
-        await inter.send(f"-# > Loaded {len(messages)} messages. Welcome back!")
+        await inter.send(f"-# > Loaded {len(messages_raw)} messages. Welcome back!")
 
     # ==== dalle ====
     # @commands.slash_command(
@@ -377,17 +469,37 @@ class AIUtils(commands.Cog):
             size = "auto"
 
         # generate image and parse webp + metadata
-        resp = await self.bot.openai.images.generate(
-            prompt=prompt,
-            model="gpt-image-2",
-            moderation="low",
-            n=1,
-            quality=quality,
-            output_format="webp",
-            size=size,
-            user=str(inter.author.id),
-            extra_headers={"OpenAI-Organization": config.DALLE_ORG_ID} if config.DALLE_ORG_ID else None,
-        )
+        async def notify_queued(position):
+            await inter.edit_original_response(content=f"-# > Image generation is busy! You're #{position} in line.")
+
+        with usage_context("gptimage", user_id=inter.author.id), queue_feedback(notify_queued):
+            async with ai_scheduler.slot("openai-images"):
+                start = time.perf_counter()
+                try:
+                    resp = await self.bot.openai.images.generate(
+                        prompt=prompt,
+                        model="gpt-image-2",
+                        moderation="low",
+                        n=1,
+                        quality=quality,
+                        output_format="webp",
+                        size=size,
+                        user=str(inter.author.id),
+                        extra_headers={"OpenAI-Organization": config.DALLE_ORG_ID} if config.DALLE_ORG_ID else None,
+                    )
+                except Exception as e:
+                    record_usage(model="gpt-image-2", latency=time.perf_counter() - start, error=repr(e))
+                    raise
+            usage = getattr(resp, "usage", None)
+            input_tokens = getattr(usage, "input_tokens", None)
+            output_tokens = getattr(usage, "output_tokens", None)
+            record_usage(
+                model="gpt-image-2",
+                latency=time.perf_counter() - start,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+            )
+            ai_scheduler.charge(inter.author.id, (input_tokens or 0) + (output_tokens or 0))
         image = resp.data[0]
         data_bytes = base64.b64decode(image.b64_json)
         data = io.BytesIO(data_bytes)
@@ -397,7 +509,8 @@ class AIUtils(commands.Cog):
         out = f"**Prompt**: {prompt[:800]}"
         await inter.send(out, file=disnake.File(data, prompt_filename))
 
-        # save to db
+        # save to db (the image itself goes in the blob store)
+        data_hash = await blob_store.put(data_bytes)
         async with db.async_session() as session:
             db_img = models.DalleImage(
                 author_id=inter.author.id,
@@ -405,56 +518,9 @@ class AIUtils(commands.Cog):
                 prompt=prompt,
                 size=size,
                 style="N/A",
-                data=data_bytes,
+                data_hash=data_hash,
                 filename=prompt_filename,
                 revised_prompt="N/A",
             )
             session.add(db_img)
             await session.commit()
-
-
-async def send_ai_msg(dest, msg):
-    buf = []
-    last_was_content = False
-
-    async def flush():
-        if not buf:
-            return
-        out = "\n".join(buf)
-        await send_chunked(dest, out.strip(), allowed_mentions=disnake.AllowedMentions.none())
-        buf.clear()
-
-    for part in msg.parts:
-        match part:
-            case AnthropicThinkingPart(content=str(thinking)) if thinking:
-                if last_was_content:
-                    await flush()
-                thinking_clean = thinking.replace("\n", " ").replace("||", "|")
-                buf.append(f"> -# Thinking: ||{thinking_clean}||")
-                last_was_content = False
-            case AnthropicUnknownPart(type="server_tool_use", data={"name": "web_search", "input": {"query": q}}):
-                if last_was_content:
-                    await flush()
-                buf.append(f"> -# Calypso searched for: `{q}`")
-                last_was_content = False
-            case AnthropicUnknownPart(type="web_fetch_tool_result", data={"content": {"url": url}}):
-                if last_was_content:
-                    await flush()
-                buf.append(f"> -# Calypso visited: `{url}`")
-                last_was_content = False
-            case _:
-                content = str(part)
-                if content:
-                    if last_was_content:
-                        buf[-1] += content
-                    else:
-                        await flush()
-                        buf.append(content)
-                    last_was_content = True
-
-    if msg.tool_calls:
-        tool_calls = ", ".join(f"`{tc.function.name}`" for tc in msg.tool_calls)
-        tool_calls_str = f"> -# Calypso used tools: {tool_calls}"
-        buf.append(tool_calls_str)
-
-    await flush()
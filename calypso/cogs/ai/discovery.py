@@ -0,0 +1,147 @@
+"""
+Cached renders of the AI discovery tools (list_channels, list_threads, list_members).
+
+The renders are kept until a gateway event changes what they would show (see the listeners in AIUtils), so most calls
+don't walk the guild at all. Thread lists are cached as the threads themselves and rendered on each call, since their
+last message time changes with every message. Members are kept in a name index that is updated member by member.
+"""
+
+import collections
+import math
+import time
+
+import disnake
+
+from calypso import constants
+
+# the maximum number of lines in one page of a discovery tool's output
+PAGE_SIZE = 100
+# archived threads aren't in the gateway cache, so we can't rely on events to know when their lists change; active
+# thread lists are kept up to date by events, but expire too in case we miss one
+THREAD_LISTS_TTL = 600
+
+
+def paginate(header: str, lines: list[str], page: int, page_size: int = PAGE_SIZE) -> str:
+    """Render one page of *lines* under *header*, with a footer explaining how to get the next page."""
+    n_pages = max(math.ceil(len(lines) / page_size), 1)
+    if not 1 <= page <= n_pages:
+        raise ValueError(f"Page must be between 1 and {n_pages}")
+    page_lines = "\n".join(lines[(page - 1) * page_size : page * page_size])
+    if n_pages == 1:
+        return f"{header}\n\n{page_lines}"
+    return f"{header} (page {page} of {n_pages})\n\n{page_lines}\n\nUse `page={page + 1}` to see more."
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class MemberIndex:
+    """The rendered member list of a guild, indexed by display name trigrams for substring search."""
+
+    def __init__(self, members: list[disnake.Member]):
+        self._lines: dict[int, str] = {}
+        self._names: dict[int, str] = {}  # lowercase display names
+        self._trigrams: dict[str, set[int]] = collections.defaultdict(set)
+        self._sorted_ids: list[int] | None = None
+        for member in members:
+            self.add(member)
+
+    def add(self, member: disnake.Member):
+        """Add or update a member."""
+        self.remove(member.id)
+        relevant_role_list = [r for r in member.roles if r.id in (constants.STAFF_ROLE_ID, constants.DM_ROLE_ID)]
+        relevant_roles = f", roles: {', '.join(r.name for r in relevant_role_list)}" if relevant_role_list else ""
+        name = member.display_name.lower()
+        self._lines[member.id] = f"{member.display_name} (ID: {member.id}, username: {member.name}{relevant_roles})"
+        self._names[member.id] = name
+        for trigram in _trigrams(name):
+            self._trigrams[trigram].add(member.id)
+        self._sorted_ids = None
+
+    def remove(self, member_id: int):
+        """Remove a member, if they are in the index."""
+        if (name := self._names.pop(member_id, None)) is None:
+            return
+        del self._lines[member_id]
+        for trigram in _trigrams(name):
+            self._trigrams[trigram].discard(member_id)
+            if not self._trigrams[trigram]:
+                del self._trigrams[trigram]
+        self._sorted_ids = None
+
+    def search(self, name: str = None) -> list[str]:
+        """The rendered lines of the members whose display names contain *name* (or all members), sorted by name."""
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self._names, key=lambda member_id: self._names[member_id])
+        if name is None:
+            return [self._lines[member_id] for member_id in self._sorted_ids]
+
+        query = name.lower()
+        if len(query) < 3:
+            candidates = self._names.keys()
+        else:
+            candidates = set.intersection(*(self._trigrams.get(t, set()) for t in _trigrams(query)))
+        matches = [member_id for member_id in candidates if query in self._names[member_id]]
+        return [self._lines[member_id] for member_id in sorted(matches, key=lambda member_id: self._names[member_id])]
+
+
+class DiscoveryCache:
+    def __init__(self):
+        # guild id -> rendered channel list lines
+        self._channel_lists: dict[int, list[str]] = {}
+        # (guild id, channel id, include archived) -> (time listed, threads); the threads are rendered when read, since
+        # their last message changes with every message sent in them
+        self._thread_lists: dict[tuple[int, int, bool], tuple[float, list[disnake.Thread]]] = {}
+        self._member_indexes: dict[int, MemberIndex] = {}
+
+    # ==== channels ====
+    def get_channels(self, guild_id: int) -> list[str] | None:
+        return self._channel_lists.get(guild_id)
+
+    def set_channels(self, guild_id: int, lines: list[str]):
+        self._channel_lists[guild_id] = lines
+
+    def invalidate_channels(self, guild_id: int):
+        """Forget the renders that depend on a guild's channels or permissions (including its thread lists)."""
+        self._channel_lists.pop(guild_id, None)
+        for key in [key for key in self._thread_lists if key[0] == guild_id]:
+            del self._thread_lists[key]
+
+    # ==== threads ====
+    def get_threads(self, guild_id: int, channel_id: int, include_archived: bool) -> list[disnake.Thread] | None:
+        if (cached := self._thread_lists.get((guild_id, channel_id, include_archived))) is None:
+            return None
+        listed_at, threads = cached
+        if time.monotonic() - listed_at > THREAD_LISTS_TTL:
+            return None
+        return threads
+
+    def set_threads(self, guild_id: int, channel_id: int, include_archived: bool, threads: list[disnake.Thread]):
+        self._thread_lists[(guild_id, channel_id, include_archived)] = (time.monotonic(), threads)
+
+    def invalidate_threads(self, guild_id: int, channel_id: int):
+        """Forget the thread lists of the given parent channel."""
+        self._thread_lists.pop((guild_id, channel_id, False), None)
+        self._thread_lists.pop((guild_id, channel_id, True), None)
+
+    # ==== members ====
+    def member_index(self, guild: disnake.Guild) -> MemberIndex:
+        if guild.id not in self._member_indexes:
+            self._member_indexes[guild.id] = MemberIndex(guild.members)
+        return self._member_indexes[guild.id]
+
+    def update_member(self, member: disnake.Member):
+        if (index := self._member_indexes.get(member.guild.id)) is not None:
+            index.add(member)
+
+    def remove_member(self, guild_id: int, member_id: int):
+        if (index := self._member_indexes.get(guild_id)) is not None:
+            index.remove(member_id)
+
+    def invalidate_members(self, guild_id: int):
+        """Forget a guild's member index entirely (e.g. when a role is renamed)."""
+        self._member_indexes.pop(guild_id, None)
+
+
+discovery_cache = DiscoveryCache()
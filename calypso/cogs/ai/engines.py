@@ -1,6 +1,16 @@
-from kani.engines.anthropic import AnthropicEngine
+import collections
+import logging
+
+from kani.engines.anthropic import AnthropicEngine, AnthropicUnknownPart
+from kani.engines.anthropic.parts import AnthropicThinkingPart
+from kani.engines.base import BaseCompletion
 
 from calypso import config
+from .scheduler import ScheduledEngine, ai_scheduler
+from .tokens import TokenEstimator
+from .usage import UsageTrackingMixin
+
+log = logging.getLogger(__name__)
 
 # CHAT_4O_HYPERPARAMS = dict(
 #     model="gpt-4o",
@@ -18,9 +28,30 @@ CHAT_HYPERPARAMS = dict(
     thinking={"type": "adaptive", "display": "summarized"},
 )
 CHAT_DESIRED_RESPONSE_TOKENS = 128_000
+# once the chat history is longer than this, summarize its oldest turns...
+CHAT_COMPACTION_THRESHOLD = 200_000
+# ...keeping the most recent turns that fit in this many tokens verbatim
+CHAT_COMPACTION_KEEP_TOKENS = 60_000
+# only count prompt tokens with the API once the local estimate is within this fraction of the context size
+REMOTE_COUNT_THRESHOLD = 0.75
+# prompt caching: we place up to 4 breakpoints (the API maximum) per request
+CACHE_CONTROL = {"type": "ephemeral"}
+CACHEABLE_BLOCK_TYPES = ("text", "image", "document", "tool_use", "tool_result")
+# tool results at least this long get their own breakpoint, if there's one to spare
+LARGE_TOOL_RESULT_CHARS = 8000
+
 
+class TrackedAnthropicEngine(UsageTrackingMixin, AnthropicEngine):
+    """An AnthropicEngine that records every call in the usage ledger."""
+
+
+class AnthropicServerToolsEngine(TrackedAnthropicEngine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_estimator = TokenEstimator(self.model)
+        # running totals of input tokens: uncached, read from cache, and written to cache
+        self.cache_stats = collections.Counter()
 
-class AnthropicServerToolsEngine(AnthropicEngine):
     def _prepare_request(self, messages, functions, *, intent: str = "create") -> tuple[dict, list]:
         kwargs, prompt_msgs = super()._prepare_request(messages, functions, intent=intent)
         # add server-side tools
@@ -30,22 +61,141 @@ class AnthropicServerToolsEngine(AnthropicEngine):
             {"type": "web_fetch_20250910", "name": "web_fetch", "max_uses": 10},
             {"type": "memory_20250818", "name": "memory"},
         ])
+        prompt_msgs = self._add_cache_breakpoints(kwargs, prompt_msgs)
         return kwargs, prompt_msgs
 
+    @staticmethod
+    def _add_cache_breakpoints(kwargs: dict, prompt_msgs: list[dict]) -> list[dict]:
+        """
+        Mark the prefixes of the prompt that should be cached. In order of priority:
+
+        - the system prompt (which, since tools come first in the cache order, also caches the tools)
+        - the end of the prompt, so the next round of a tool loop can read everything up to here
+        - the end of the last user turn before that, so that a round which adds many blocks (e.g. a lot of parallel
+          tool results) still hits the cache written by the previous round
+        - the most recent large tool result before that
+        """
+        if system := kwargs.get("system"):
+            kwargs["system"] = [{"type": "text", "text": system, "cache_control": CACHE_CONTROL}]
+        if not prompt_msgs:
+            return prompt_msgs
+
+        prompt_msgs = list(prompt_msgs)
+        remaining = 3
+        # the end of the prompt
+        if _add_message_breakpoint(prompt_msgs, len(prompt_msgs) - 1):
+            remaining -= 1
+        # the last stable user turn
+        stable_idx = next(
+            (i for i in range(len(prompt_msgs) - 2, -1, -1) if prompt_msgs[i]["role"] == "user"),
+            None,
+        )
+        if stable_idx is not None and _add_message_breakpoint(prompt_msgs, stable_idx):
+            remaining -= 1
+        # the most recent large tool result before the last stable user turn (tool results are sent as user messages)
+        if stable_idx is None or remaining <= 0:
+            return prompt_msgs
+        for i in range(stable_idx - 1, -1, -1):
+            if prompt_msgs[i]["role"] != "user" or isinstance(prompt_msgs[i]["content"], str):
+                continue
+            for block_idx, block in enumerate(prompt_msgs[i]["content"]):
+                if block.get("type") == "tool_result" and len(str(block.get("content"))) >= LARGE_TOOL_RESULT_CHARS:
+                    _add_block_breakpoint(prompt_msgs, i, block_idx)
+                    return prompt_msgs
+        return prompt_msgs
+
     async def prompt_len(self, messages, functions=None, **kwargs) -> int:
+        await self.token_estimator.load()
+        estimate = self.token_estimator.estimate(messages, functions)
+        if estimate < self.max_context_size * REMOTE_COUNT_THRESHOLD:
+            return estimate
+
+        # we're close to the context limit, so get an exact count
         if (cached_len := self.get_cached_prompt_len(messages, functions, **kwargs)) is not None:
             return cached_len
 
         predict_kwargs, prompt_msgs = self._prepare_request(messages, functions, intent="count_tokens")
         predict_kwargs["max_tokens"] = 0
-        predict_kwargs.setdefault("cache_control", {"type": "ephemeral"})
         result = await self._messages_api.create(
             model=self.model,
             messages=prompt_msgs,
             **predict_kwargs,
         )
-        self.set_cached_prompt_len(messages, functions, length=result.usage.input_tokens, **kwargs)
-        return result.usage.input_tokens
+        length = _total_input_tokens(result.usage)
+        self.set_cached_prompt_len(messages, functions, length=length, **kwargs)
+        self.token_estimator.calibrate(messages, functions, length)
+        return length
+
+    async def predict(self, messages, functions=None, **hyperparams):
+        completion = await super().predict(messages, functions, **hyperparams)
+        self._record_completion(messages, functions, completion)
+        return completion
+
+    async def stream(self, messages, functions=None, **hyperparams):
+        async for elem in super().stream(messages, functions, **hyperparams):
+            if isinstance(elem, BaseCompletion):
+                self._record_completion(messages, functions, elem)
+            yield elem
 
+    def _record_completion(self, messages, functions, completion: BaseCompletion):
+        """Calibrate the token estimator with the exact counts returned with each completion."""
+        if (anthropic_message := completion.message.extra.get("anthropic_message")) is None:
+            return
+        usage = anthropic_message.usage
+        self.token_estimator.calibrate(messages, functions, _total_input_tokens(usage))
+        # server tool results (e.g. web search) are part of the message but not counted in its output tokens, and the
+        # output tokens of thinking are billed in full but the thinking is summarized or dropped when it is sent back,
+        # so messages with either are left to the estimate
+        if not any(
+            isinstance(part, (AnthropicUnknownPart, AnthropicThinkingPart)) for part in completion.message.parts
+        ):
+            self.token_estimator.record_exact(completion.message, usage.output_tokens)
 
-chat_engine = AnthropicServerToolsEngine(api_key=config.ANTHROPIC_API_KEY, **CHAT_HYPERPARAMS)
+        # prompt cache performance
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_write = usage.cache_creation_input_tokens or 0
+        self.cache_stats.update(input_tokens=usage.input_tokens, cache_read=cache_read, cache_write=cache_write)
+        log.debug(
+            f"Prompt cache: {cache_read} read, {cache_write} written, {usage.input_tokens} uncached"
+            f" (overall hit ratio {self.cache_hit_ratio:.1%})"
+        )
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """The fraction of all input tokens sent by this engine that were read from the prompt cache."""
+        total = sum(self.cache_stats.values())
+        return self.cache_stats["cache_read"] / total if total else 0.0
+
+
+def _add_message_breakpoint(prompt_msgs: list[dict], idx: int) -> bool:
+    """Mark the last cacheable block of the message at *idx*. Returns whether a breakpoint was added."""
+    content = prompt_msgs[idx]["content"]
+    if isinstance(content, str):
+        if not content:
+            return False
+        prompt_msgs[idx] = {**prompt_msgs[idx], "content": [{"type": "text", "text": content}]}
+        content = prompt_msgs[idx]["content"]
+    for block_idx in range(len(content) - 1, -1, -1):
+        if content[block_idx].get("type") in CACHEABLE_BLOCK_TYPES:
+            _add_block_breakpoint(prompt_msgs, idx, block_idx)
+            return True
+    return False
+
+
+def _add_block_breakpoint(prompt_msgs: list[dict], idx: int, block_idx: int):
+    # the blocks can be shared with the kani messages they came from (e.g. unknown parts), so copy before marking
+    content = list(prompt_msgs[idx]["content"])
+    content[block_idx] = {**content[block_idx], "cache_control": CACHE_CONTROL}
+    prompt_msgs[idx] = {**prompt_msgs[idx], "content": content}
+
+
+def _total_input_tokens(usage) -> int:
+    """The input tokens in a response's usage, including cache reads and writes (which input_tokens excludes)."""
+    return usage.input_tokens + (usage.cache_read_input_tokens or 0) + (usage.cache_creation_input_tokens or 0)
+
+
+chat_engine = ScheduledEngine(
+    AnthropicServerToolsEngine(api_key=config.ANTHROPIC_API_KEY, **CHAT_HYPERPARAMS),
+    scheduler=ai_scheduler,
+    provider="anthropic",
+)
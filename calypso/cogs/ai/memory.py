@@ -7,18 +7,31 @@ implicit (derived from the path prefixes of the files that exist). These functio
 back the (disabled) ``memory`` ai_function in :mod:`.aikani`, which dispatches the
 server-side tool calls to them.
 
+The whole filesystem is mirrored in memory by :class:`MemoryTree`, which is loaded once and updated after each write is
+committed, so views and existence checks never touch the DB. It also keeps an inverted index of the words in each file
+for :func:`memory_search`, which is our own addition to the tool's commands.
+
 https://platform.claude.com/docs/en/agents-and-tools/tool-use/memory-tool#tool-commands
 """
 
+import asyncio
 import datetime
 import posixpath
+import re
 
-from sqlalchemy import select
+from sqlalchemy import delete, func, literal, select, update
 
 from calypso import db, models
 
 MEMORY_ROOT = "/memories"
 MAX_LINES = 999_999
+MAX_SEARCH_FILES = 20
+MAX_SEARCH_LINES_PER_FILE = 10
+MAX_SNIPPET_LEN = 200
+# the maximum size of the user memories prefetched into a chat's context
+MAX_PREFETCH_CHARS = 12_000
+
+_WORD_RE = re.compile(r"\w+")
 
 
 # ==== helpers ====
@@ -53,30 +66,238 @@ def _number_lines(content: str, start: int = 1) -> str:
     return "\n".join(f"{i:>6}\t{line}" for i, line in enumerate(lines, start=start))
 
 
-async def _get_file(session, path: str) -> models.AIMemory | None:
-    return await session.get(models.AIMemory, path)
-
-
-async def _children(session, path: str) -> list[models.AIMemory]:
-    """All files anywhere beneath the directory *path*."""
-    prefix = path + "/"
-    result = await session.execute(select(models.AIMemory).where(models.AIMemory.path.startswith(prefix)))
-    return list(result.scalars())
+def _beneath(path: str):
+    """A WHERE clause matching the files anywhere beneath the directory *path*."""
+    return models.AIMemory.path.startswith(path + "/", autoescape=True)
+
+
+def _words(text: str) -> set[str]:
+    return set(_WORD_RE.findall(text.lower()))
+
+
+def _ancestors(path: str):
+    """The directories containing *path*, nearest first, up to and including the root."""
+    while path != MEMORY_ROOT:
+        path = posixpath.dirname(path)
+        yield path
+
+
+# ==== cache ====
+class MemoryTree:
+    """
+    An in-memory mirror of the memory filesystem: the content of every file, the immediate children of every
+    directory, and the number of files beneath each directory and their total size (excluding hidden files, like the
+    directory listing). Directories exist as long as there is a file beneath them. Files are also indexed by the
+    (lowercased) words they contain.
+
+    Writes must hold :attr:`write_lock` and update the tree only once they are committed to the DB.
+    """
+
+    def __init__(self):
+        self.files: dict[str, str] = {}
+        self.write_lock = asyncio.Lock()
+        self._sizes: dict[str, int] = {}  # file path -> size in bytes
+        self._children: dict[str, set[str]] = {}  # dir path -> paths of the files and dirs directly in it
+        self._n_files: dict[str, int] = {}  # dir path -> number of files beneath it
+        self._n_visible: dict[str, int] = {}  # dir path -> number of non-hidden files beneath it
+        self._visible_size: dict[str, int] = {}  # dir path -> total size of the non-hidden files beneath it
+        self._words: dict[str, set[str]] = {}  # file path -> words in it
+        self._postings: dict[str, set[str]] = {}  # word -> paths of the files containing it
+        self._versions: dict[str, int] = {}  # dir path -> number of writes beneath it so far
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """Load the tree from the DB. Only hits the DB once."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            async with db.async_session() as session:
+                result = await session.execute(select(models.AIMemory.path, models.AIMemory.content))
+                for path, content in result:
+                    self.add(path, content)
+            self._loaded = True
+
+    # ==== reads ====
+    def is_file(self, path: str) -> bool:
+        return path in self.files
+
+    def is_dir(self, path: str) -> bool:
+        """Whether there are any files beneath *path*."""
+        return self._n_files.get(path, 0) > 0
+
+    def exists(self, path: str) -> bool:
+        return self.is_file(path) or self.is_dir(path)
+
+    def has_visible_files(self, path: str) -> bool:
+        return self._n_visible.get(path, 0) > 0
+
+    def descendants(self, path: str) -> list[str]:
+        """The paths of all files anywhere beneath the directory *path*."""
+        out = []
+        stack = [path]
+        while stack:
+            for child in self._children.get(stack.pop(), ()):
+                if child in self.files:
+                    out.append(child)
+                else:
+                    stack.append(child)
+        return out
+
+    def listing(self, path: str, depth: int = 2) -> dict[str, int]:
+        """The non-hidden files and directories up to *depth* levels beneath *path* (inclusive), with their sizes."""
+        entries = {path: self._visible_size.get(path, 0)}
+        level = [path]
+        for _ in range(depth):
+            next_level = []
+            for parent in level:
+                for child in self._children.get(parent, ()):
+                    if child in self.files:
+                        if not _is_hidden(child):
+                            entries[child] = self._sizes[child]
+                    elif self.has_visible_files(child):
+                        entries[child] = self._visible_size[child]
+                        next_level.append(child)
+            level = next_level
+        return entries
+
+    def version(self, path: str) -> int:
+        """A number that changes whenever a file beneath the directory *path* is written."""
+        return self._versions.get(path, 0)
+
+    def search(self, words: set[str], path: str = MEMORY_ROOT) -> list[str]:
+        """The paths of the non-hidden files at or beneath *path* that contain all of *words*."""
+        if not words:
+            return []
+        matches = set.intersection(*(self._postings.get(word, set()) for word in words))
+        prefix = path + "/"
+        return [p for p in matches if (p == path or p.startswith(prefix)) and not _is_hidden(p)]
+
+    # ==== writes ====
+    def add(self, path: str, content: str):
+        """Add a file, or replace its content."""
+        if path in self.files:
+            self.remove(path)
+        size = len(content.encode("utf-8"))
+        visible = not _is_hidden(path)
+        self.files[path] = content
+        self._sizes[path] = size
+        self._words[path] = _words(content)
+        for word in self._words[path]:
+            self._postings.setdefault(word, set()).add(path)
+        child = path
+        for parent in _ancestors(path):
+            self._children.setdefault(parent, set()).add(child)
+            self._n_files[parent] = self._n_files.get(parent, 0) + 1
+            self._versions[parent] = self._versions.get(parent, 0) + 1
+            if visible:
+                self._n_visible[parent] = self._n_visible.get(parent, 0) + 1
+                self._visible_size[parent] = self._visible_size.get(parent, 0) + size
+            child = parent
+
+    def remove(self, path: str):
+        """Remove a file. Directories that are left empty are removed along with it."""
+        del self.files[path]
+        size = self._sizes.pop(path)
+        visible = not _is_hidden(path)
+        for word in self._words.pop(path):
+            self._postings[word].discard(path)
+            if not self._postings[word]:
+                del self._postings[word]
+        self._children[posixpath.dirname(path)].discard(path)
+        for parent in _ancestors(path):
+            self._n_files[parent] -= 1
+            self._versions[parent] += 1
+            if visible:
+                self._n_visible[parent] -= 1
+                self._visible_size[parent] -= size
+            if not self._n_files[parent] and parent != MEMORY_ROOT:
+                for counts in (self._n_files, self._n_visible, self._visible_size, self._children):
+                    counts.pop(parent, None)
+                self._children[posixpath.dirname(parent)].discard(parent)
+
+
+memory_tree = MemoryTree()
+
+
+def user_memory_dir(username: str) -> str:
+    """The directory that the system prompt tells Calypso to keep a user's memories in."""
+    return posixpath.join(MEMORY_ROOT, username)
+
+
+def render_user_memories(tree: MemoryTree, usernames: list[str], budget: int = MAX_PREFETCH_CHARS) -> str | None:
+    """
+    Render the contents of the given users' memory directories, for prefetching into a chat's context. Files are
+    included whole, in order, until the next one would take the rendered files over *budget* characters; that file and
+    the ones after it are only listed. Returns None if none of the users have any memories.
+    """
+    shown = []
+    omitted = []
+    for username in usernames:
+        path = user_memory_dir(username)
+        if _is_hidden(path) or not tree.has_visible_files(path):
+            continue
+        for fpath in sorted(p for p in tree.descendants(path) if not _is_hidden(p)):
+            rendered = f'<file path="{fpath}">\n{tree.files[fpath]}\n</file>'
+            if not omitted and len(rendered) <= budget:
+                shown.append(rendered)
+                budget -= len(rendered) + 1
+            else:
+                omitted.append(fpath)
+    if not shown and not omitted:
+        return None
+
+    out = shown
+    if omitted:
+        out.append(f"Not shown (too long, view them if you need to): {', '.join(omitted)}")
+    return "\n".join(out)
+
+
+async def get_memory_tree() -> MemoryTree:
+    await memory_tree.load()
+    return memory_tree
 
 
 # ==== commands ====
 async def memory_view(path: str, start: int | None = None, end: int | None = None) -> str:
     path = _validate_path(path)
-    async with db.async_session() as session:
-        file = await _get_file(session, path)
-        if file is not None:
-            return _view_file(path, file.content, start, end)
+    tree = await get_memory_tree()
+    if tree.is_file(path):
+        return _view_file(path, tree.files[path], start, end)
 
-        # not a file -- treat as a directory
-        children = [f for f in await _children(session, path) if not _is_hidden(f.path)]
-        if not children and path != MEMORY_ROOT:
-            return f"Error: The path {path} does not exist. Please provide a valid path."
-        return _view_directory(path, children)
+    # not a file -- treat as a directory
+    if not tree.has_visible_files(path) and path != MEMORY_ROOT:
+        return f"Error: The path {path} does not exist. Please provide a valid path."
+    return _view_directory(path, tree.listing(path))
+
+
+async def memory_search(query: str, path: str = MEMORY_ROOT) -> str:
+    path = _validate_path(path)
+    words = _words(query)
+    if not words:
+        return "Error: The query must contain at least one word."
+    tree = await get_memory_tree()
+
+    # files containing all the words, ranked by how many of their lines contain any of them
+    results = []
+    for fpath in tree.search(words, path):
+        lines = [(i, line) for i, line in enumerate(tree.files[fpath].split("\n"), start=1) if _words(line) & words]
+        results.append((fpath, lines))
+    if not results:
+        return f"No files in {path} contain all of the words in {query!r}."
+    results.sort(key=lambda r: (-len(r[1]), r[0]))
+
+    out = [f"Found {len(results)} files in {path} containing all of the words in {query!r}:"]
+    for fpath, lines in results[:MAX_SEARCH_FILES]:
+        snippets = "\n".join(f"{i:>6}\t{line[:MAX_SNIPPET_LEN]}" for i, line in lines[:MAX_SEARCH_LINES_PER_FILE])
+        if len(lines) > MAX_SEARCH_LINES_PER_FILE:
+            snippets += f"\n\t({len(lines) - MAX_SEARCH_LINES_PER_FILE} more matching lines)"
+        out.append(f"{fpath}\n{snippets}")
+    if len(results) > MAX_SEARCH_FILES:
+        out.append(f"({len(results) - MAX_SEARCH_FILES} more files; narrow the query or path to see them)")
+    return "\n\n".join(out)
 
 
 def _view_file(path: str, content: str, start: int | None, end: int | None) -> str:
@@ -95,22 +316,7 @@ def _view_file(path: str, content: str, start: int | None, end: int | None) -> s
     return f"Here's the content of {path} with line numbers:\n{body}"
 
 
-def _view_directory(path: str, children: list[models.AIMemory]) -> str:
-    prefix = path + "/"
-    sizes = {f.path: len(f.content.encode("utf-8")) for f in children}
-
-    # collect entries up to 2 levels deep, aggregating directory sizes
-    entries: dict[str, int] = {path: sum(sizes.values())}
-    for fpath, size in sizes.items():
-        parts = fpath[len(prefix) :].split("/")
-        lvl1 = prefix + parts[0]
-        if len(parts) == 1:
-            entries[lvl1] = size
-        else:
-            entries[lvl1] = entries.get(lvl1, 0) + size
-            lvl2 = lvl1 + "/" + parts[1]
-            entries[lvl2] = entries.get(lvl2, 0) + size
-
+def _view_directory(path: str, entries: dict[str, int]) -> str:
     listing = "\n".join(f"{_human_size(entries[p])}\t{p}" for p in sorted(entries))
     return (
         f"Here're the files and directories up to 2 levels deep in {path}, "
@@ -122,25 +328,28 @@ async def memory_create(path: str, file_text: str) -> str:
     path = _validate_path(path)
     if path == MEMORY_ROOT:
         return f"Error: {path} is a directory, not a file."
-    async with db.async_session() as session:
-        if await _get_file(session, path) is not None:
+    tree = await get_memory_tree()
+    async with tree.write_lock:
+        if tree.is_file(path):
             return f"Error: File {path} already exists"
         # guard against shadowing an existing implicit directory
-        if await _children(session, path):
+        if tree.is_dir(path):
             return f"Error: {path} is a directory, not a file."
-        session.add(models.AIMemory(path=path, content=file_text))
-        await session.commit()
+        async with db.async_session() as session:
+            session.add(models.AIMemory(path=path, content=file_text))
+            await session.commit()
+        tree.add(path, file_text)
     return f"File created successfully at: {path}"
 
 
 async def memory_str_replace(path: str, old_str: str, new_str: str) -> str:
     path = _validate_path(path)
-    async with db.async_session() as session:
-        file = await _get_file(session, path)
-        if file is None:
+    tree = await get_memory_tree()
+    async with tree.write_lock:
+        if not tree.is_file(path):
             return f"Error: The path {path} does not exist. Please provide a valid path."
 
-        content = file.content
+        content = tree.files[path]
         occurrences = content.count(old_str)
         if occurrences == 0:
             return f"No replacement was performed, old_str `{old_str}` did not appear verbatim in {path}."
@@ -155,14 +364,24 @@ async def memory_str_replace(path: str, old_str: str, new_str: str) -> str:
             )
 
         new_content = content.replace(old_str, new_str)
-        file.content = new_content
-        file.timestamp = datetime.datetime.utcnow()
-        await session.commit()
+        await _write_file(path, new_content)
+        tree.add(path, new_content)
 
     snippet = _edit_snippet(new_content, content.index(old_str), new_str)
     return f"The memory file has been edited.\n{snippet}"
 
 
+async def _write_file(path: str, content: str):
+    """Update the content of an existing file in the DB."""
+    async with db.async_session() as session:
+        await session.execute(
+            update(models.AIMemory)
+            .where(models.AIMemory.path == path)
+            .values(content=content, timestamp=datetime.datetime.utcnow())
+        )
+        await session.commit()
+
+
 def _edit_snippet(new_content: str, char_offset: int, new_str: str, context: int = 4) -> str:
     """A few lines of context around an edit, with line numbers."""
     lines = new_content.split("\n")
@@ -175,12 +394,12 @@ def _edit_snippet(new_content: str, char_offset: int, new_str: str, context: int
 
 async def memory_insert(path: str, insert_line: int, insert_text: str) -> str:
     path = _validate_path(path)
-    async with db.async_session() as session:
-        file = await _get_file(session, path)
-        if file is None:
+    tree = await get_memory_tree()
+    async with tree.write_lock:
+        if not tree.is_file(path):
             return f"Error: The path {path} does not exist"
 
-        lines = file.content.split("\n")
+        lines = tree.files[path].split("\n")
         if insert_line < 0 or insert_line > len(lines):
             return (
                 f"Error: Invalid `insert_line` parameter: {insert_line}. "
@@ -188,52 +407,73 @@ async def memory_insert(path: str, insert_line: int, insert_text: str) -> str:
             )
 
         lines[insert_line:insert_line] = insert_text.split("\n")
-        file.content = "\n".join(lines)
-        file.timestamp = datetime.datetime.utcnow()
-        await session.commit()
+        new_content = "\n".join(lines)
+        await _write_file(path, new_content)
+        tree.add(path, new_content)
     return f"The file {path} has been edited."
 
 
 async def memory_delete(path: str) -> str:
     path = _validate_path(path)
-    async with db.async_session() as session:
-        file = await _get_file(session, path)
-        if file is not None:
-            await session.delete(file)
-            await session.commit()
+    tree = await get_memory_tree()
+    async with tree.write_lock:
+        if tree.is_file(path):
+            async with db.async_session() as session:
+                await session.execute(delete(models.AIMemory).where(models.AIMemory.path == path))
+                await session.commit()
+            tree.remove(path)
             return f"Successfully deleted {path}"
 
         # directory: delete recursively
-        children = await _children(session, path)
-        if not children and path != MEMORY_ROOT:
+        if not tree.is_dir(path) and path != MEMORY_ROOT:
             return f"Error: The path {path} does not exist"
-        for child in children:
-            await session.delete(child)
-        await session.commit()
+        async with db.async_session() as session:
+            await session.execute(
+                delete(models.AIMemory).where(_beneath(path)).execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        for child_path in tree.descendants(path):
+            tree.remove(child_path)
     return f"Successfully deleted {path}"
 
 
 async def memory_rename(old_path: str, new_path: str) -> str:
     old_path = _validate_path(old_path)
     new_path = _validate_path(new_path)
-    async with db.async_session() as session:
-        file = await _get_file(session, old_path)
-        if file is not None:
-            if await _get_file(session, new_path) is not None or await _children(session, new_path):
+    tree = await get_memory_tree()
+    async with tree.write_lock:
+        if tree.is_file(old_path):
+            if tree.exists(new_path):
                 return f"Error: The destination {new_path} already exists"
-            file.path = new_path
-            file.timestamp = datetime.datetime.utcnow()
-            await session.commit()
+            async with db.async_session() as session:
+                await session.execute(
+                    update(models.AIMemory)
+                    .where(models.AIMemory.path == old_path)
+                    .values(path=new_path, timestamp=datetime.datetime.utcnow())
+                )
+                await session.commit()
+            tree.add(new_path, tree.files[old_path])
+            tree.remove(old_path)
             return f"Successfully renamed {old_path} to {new_path}"
 
         # directory: move every descendant
-        children = await _children(session, old_path)
-        if not children:
+        if not tree.is_dir(old_path):
             return f"Error: The path {old_path} does not exist"
-        if await _get_file(session, new_path) is not None or await _children(session, new_path):
+        if tree.exists(new_path):
             return f"Error: The destination {new_path} already exists"
-        for child in children:
-            child.path = new_path + child.path[len(old_path) :]
-            child.timestamp = datetime.datetime.utcnow()
-        await session.commit()
+        async with db.async_session() as session:
+            # swap the old prefix for the new one (substr is 1-indexed)
+            await session.execute(
+                update(models.AIMemory)
+                .where(_beneath(old_path))
+                .values(
+                    path=literal(new_path) + func.substr(models.AIMemory.path, len(old_path) + 1),
+                    timestamp=datetime.datetime.utcnow(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        for child_path in tree.descendants(old_path):
+            tree.add(new_path + child_path[len(old_path) :], tree.files[child_path])
+            tree.remove(child_path)
     return f"Successfully renamed {old_path} to {new_path}"
@@ -1,4 +1,12 @@
+import json
+
 import disnake
+from disnake.utils import snowflake_time
+from kani import ChatMessage, ChatRole
+from kani.engines.anthropic import AnthropicUnknownPart
+from kani.engines.anthropic.parts import AnthropicThinkingPart
+
+from calypso import models
 
 AI_CHAT_PROMPT = """\
 You are a knowledgeable D&D player and DM. Answer concisely and casually, appropriately for a Discord chatroom.
@@ -62,6 +70,74 @@ Each reply should consist of just your in-character response as Calypso, without
 Do NOT include roleplay actions in *italics* unless asked to do so.
 """.strip()
 
+COMPACTION_PROMPT = """\
+You are summarizing the start of a long Discord conversation between Calypso (an AI fey character in a D&D server) \
+and one or more users, so that Calypso can continue the conversation without the original messages.
+
+Write concise bullet points covering:
+- who took part (by display name) and what each of them wanted
+- facts, decisions, and conclusions reached, including details about users and their characters
+- open questions and anything Calypso promised to do
+- the current topic and tone of the conversation
+
+Do not repeat the contents of tool results. Instead, refer to them by their tool call ID (e.g. \
+`[tool result toolu_123]`) so that Calypso can retrieve them with the `get_tool_result` tool if needed. If the \
+conversation already begins with a summary, fold it into your new summary.
+""".strip()
+# tool results are cut to this many characters in the transcript that is summarized
+COMPACTION_TOOL_RESULT_CHARS = 300
+
+
+def compaction_transcript(messages: list[ChatMessage]) -> str:
+    """Render a chat history as a plain-text transcript for the compaction summarizer."""
+    lines = []
+    for message in messages:
+        match message.role:
+            case ChatRole.USER:
+                lines.append(f"<user_message>\n{message.text}\n</user_message>")
+            case ChatRole.ASSISTANT:
+                parts = []
+                for part in message.parts:
+                    match part:
+                        case AnthropicThinkingPart():
+                            continue
+                        case AnthropicUnknownPart(type="server_tool_use", data={"name": name, "input": args}):
+                            parts.append(f"[Calypso used {name}: {json.dumps(args)}]")
+                        case AnthropicUnknownPart():
+                            continue
+                        case _:
+                            parts.append(str(part))
+                for tc in message.tool_calls or ():
+                    parts.append(
+                        f"[Calypso called {tc.function.name}({tc.function.arguments}) (tool call ID: {tc.id})]"
+                    )
+                lines.append(f"<calypso>\n{''.join(parts).strip()}\n</calypso>")
+            case ChatRole.FUNCTION:
+                result = message.text or ""
+                if len(result) > COMPACTION_TOOL_RESULT_CHARS:
+                    result = f"{result[:COMPACTION_TOOL_RESULT_CHARS]}... ({len(result)} characters)"
+                lines.append(
+                    f"<tool_result name={message.name!r} id={message.tool_call_id!r}>\n{result}\n</tool_result>"
+                )
+    return "\n\n".join(lines)
+
+
+def compaction_summary_message(summary: str) -> ChatMessage:
+    """The message that stands in for the summarized part of a chat history."""
+    return ChatMessage.user(
+        "<conversation_summary>\nThe earlier part of this conversation has been summarized to save space:\n\n"
+        f"{summary}\n</conversation_summary>"
+    )
+
+
+def user_memories_message(memories: str) -> ChatMessage:
+    """The message that prefetches the memories of the users in a chat, placed right after the system prompt."""
+    return ChatMessage.user(
+        "<user_memories>\nThese are the current contents of the memory directories of the users in this chat, so you"
+        " don't need to view them:\n\n"
+        f"{memories}\n</user_memories>"
+    )
+
 
 def render_forwarded_message(forwarded_message: disnake.ForwardedMessage) -> str:
     fwd_timestamp = forwarded_message.created_at.strftime("%Y-%m-%d %H:%M")
@@ -115,3 +191,21 @@ def chat_prompt(message: disnake.Message) -> str:
 
     prompt = "\n".join(prompt_lines)
     return prompt
+
+
+def logged_message_prompt(message: models.LoggedMessage) -> str:
+    """Like :func:`chat_prompt`, but for a message from the message log."""
+    timestamp = snowflake_time(message.message_id).strftime("%Y-%m-%d %H:%M")
+    prompt_lines = [f"{message.author.display_name} @ {timestamp}"]
+
+    # content
+    if message.content:
+        prompt_lines.append(message.clean_content)
+
+    # embeds
+    for embed_data in json.loads(message.embeds_json) if message.embeds_json else []:
+        embed_content = render_embed(disnake.Embed.from_dict(embed_data))
+        prompt_lines.append(f"<embed>\n{embed_content}\n</embed>")
+
+    prompt = "\n".join(prompt_lines)
+    return prompt
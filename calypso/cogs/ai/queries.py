@@ -1,4 +1,6 @@
-from sqlalchemy import select
+import datetime
+
+from sqlalchemy import func, select
 
 from calypso import models
 
@@ -17,3 +19,32 @@ async def get_chat_messages(session, chat_id: int) -> list[models.AIChatMessageR
     )
     result = await session.execute(stmt)
     return result.scalars().all()
+
+
+async def get_latest_chat_summary(session, chat_id: int) -> models.AIChatSummary | None:
+    stmt = (
+        select(models.AIChatSummary)
+        .where(models.AIChatSummary.chat_id == chat_id)
+        .order_by(models.AIChatSummary.id.desc())
+        .limit(1)
+    )
+    result = await session.execute(stmt)
+    return result.scalar()
+
+
+async def get_user_token_usage_since(session, since: datetime.datetime) -> list[tuple[int, datetime.datetime, int]]:
+    """Returns (user_id, timestamp, input + output tokens) for each model call made on behalf of a user since *since*."""
+    stmt = select(
+        models.AIUsageRecord.user_id,
+        models.AIUsageRecord.timestamp,
+        func.coalesce(models.AIUsageRecord.input_tokens, 0) + func.coalesce(models.AIUsageRecord.output_tokens, 0),
+    ).where(models.AIUsageRecord.user_id.is_not(None), models.AIUsageRecord.timestamp >= since)
+    stmt = stmt.order_by(models.AIUsageRecord.timestamp)
+    result = await session.execute(stmt)
+    return result.all()
+
+
+async def get_usage_records_since(session, since: datetime.datetime) -> list[models.AIUsageRecord]:
+    stmt = select(models.AIUsageRecord).where(models.AIUsageRecord.timestamp >= since)
+    result = await session.execute(stmt)
+    return result.scalars().all()
@@ -0,0 +1,252 @@
+"""
+A global scheduler for calls to model providers.
+
+Each provider (e.g. Anthropic, OpenAI image generation) has a concurrency limit. When a provider is busy, waiting calls
+are served by weighted fair queuing over flows of (user, feature): each flow's calls are spread out in virtual time by
+their cost divided by the feature's weight, so one user with a long tool loop or a pile of image requests can't starve
+everyone else. Callers can register a callback with :func:`queue_feedback` to tell users where they are in the queue.
+
+Each user also has a rolling token budget. It is checked before a call is admitted, and seeded from the usage ledger
+on first use so that it survives restarts.
+
+The scheduler doesn't know anything about Discord or any particular engine: :class:`ScheduledEngine` wraps any kani
+engine (including a local stand-in), and :meth:`Scheduler.slot` can gate any other awaitable.
+"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import datetime
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable
+
+from kani import AIFunction, ChatMessage
+from kani.engines.base import BaseCompletion, BaseEngine, WrapperEngine
+
+from calypso import config, db
+from calypso.errors import AIBudgetExceeded
+from . import queries
+from .usage import current_usage_context
+
+log = logging.getLogger(__name__)
+
+# the maximum number of concurrent calls to each provider
+PROVIDER_CONCURRENCY = {
+    "anthropic": 8,
+    "openai-images": 2,
+}
+DEFAULT_CONCURRENCY = 4
+# features with a higher weight get a bigger share of a busy provider
+FEATURE_WEIGHTS = {
+    "ai_chat": 1.0,
+    "ai_chat_compaction": 2.0,  # blocks a chat round that is already in progress
+    "enc_brainstorm": 1.0,
+    "gptimage": 1.0,
+}
+USER_BUDGET_WINDOW = datetime.timedelta(days=1)
+MAX_IDLE_FLOWS = 1000
+
+_on_queued: contextvars.ContextVar[Callable[[int], Awaitable] | None] = contextvars.ContextVar(
+    "on_queued", default=None
+)
+
+
+@contextlib.contextmanager
+def queue_feedback(callback: Callable[[int], Awaitable]):
+    """
+    Call ``await callback(position)`` whenever a call made in this block has to wait for a busy provider.
+    *position* is 1-based.
+    """
+    token = _on_queued.set(callback)
+    try:
+        yield
+    finally:
+        _on_queued.reset(token)
+
+
+@dataclasses.dataclass(order=True)
+class _Waiter:
+    finish: float
+    seq: int
+    start: float = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+
+
+class _Provider:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self.queue: list[_Waiter] = []
+        self.virtual_time = 0.0
+        # (user_id, feature) -> virtual finish time of the flow's last call
+        self.flow_finish: dict[tuple[int | None, str], float] = {}
+
+
+class Scheduler:
+    def __init__(
+        self,
+        concurrency: dict[str, int],
+        *,
+        default_concurrency: int = DEFAULT_CONCURRENCY,
+        user_token_budget: int | None = None,
+        budget_window: datetime.timedelta = USER_BUDGET_WINDOW,
+    ):
+        """
+        :param concurrency: The maximum number of concurrent calls to each provider.
+        :param default_concurrency: The limit for providers that aren't in *concurrency*.
+        :param user_token_budget: The number of tokens each user can use in *budget_window*, or None for no limit.
+        """
+        self.concurrency = concurrency
+        self.default_concurrency = default_concurrency
+        self.user_token_budget = user_token_budget
+        self.budget_window = budget_window
+        self._providers: dict[str, _Provider] = {}
+        self._seq = itertools.count()
+        # user_id -> deque of (timestamp, tokens), oldest first
+        self._user_usage: dict[int, collections.deque] = collections.defaultdict(collections.deque)
+        self._usage_loaded = False
+        self._usage_load_lock = asyncio.Lock()
+
+    # ==== public ====
+    @contextlib.asynccontextmanager
+    async def slot(self, provider: str, cost: float = 1.0):
+        """
+        Wait for a turn to call the given provider, attributed to the user and feature of the current usage context.
+
+        :raises AIBudgetExceeded: if the user has used up their token budget.
+        """
+        ctx = current_usage_context()
+        user_id = ctx.user_id if ctx is not None else None
+        feature = ctx.feature if ctx is not None else "unknown"
+        await self.check_budget(user_id)
+
+        p = self._get_provider(provider)
+        await self._acquire(p, (user_id, feature), cost / FEATURE_WEIGHTS.get(feature, 1.0))
+        try:
+            yield
+        finally:
+            self._release(p)
+
+    async def check_budget(self, user_id: int | None):
+        """Raise if the given user has used up their token budget for the current window."""
+        if self.user_token_budget is None or user_id is None:
+            return
+        await self._load_usage()
+        usage = self._user_usage[user_id]
+        self._expire_usage(usage)
+        used = sum(tokens for _, tokens in usage)
+        if used >= self.user_token_budget:
+            retry_at = usage[0][0] + self.budget_window
+            raise AIBudgetExceeded(
+                f"You've hit your AI usage limit for now ({used:,} tokens in the last"
+                f" {self.budget_window.total_seconds() / 3600:g} hours). Try again"
+                f" <t:{int(retry_at.replace(tzinfo=datetime.timezone.utc).timestamp())}:R>."
+            )
+
+    def charge(self, user_id: int | None, tokens: int):
+        """Count *tokens* against the given user's budget."""
+        if self.user_token_budget is None or user_id is None or not tokens:
+            return
+        self._user_usage[user_id].append((datetime.datetime.utcnow(), tokens))
+
+    # ==== internals ====
+    def _get_provider(self, name: str) -> _Provider:
+        if name not in self._providers:
+            self._providers[name] = _Provider(self.concurrency.get(name, self.default_concurrency))
+        return self._providers[name]
+
+    async def _acquire(self, p: _Provider, flow: tuple[int | None, str], cost: float):
+        start = max(p.virtual_time, p.flow_finish.get(flow, 0.0))
+        finish = start + cost
+        p.flow_finish[flow] = finish
+        if len(p.flow_finish) > MAX_IDLE_FLOWS:
+            p.flow_finish = {k: v for k, v in p.flow_finish.items() if v > p.virtual_time}
+
+        # fast path: the provider has capacity (so anything left in the queue was cancelled)
+        if p.running < p.concurrency:
+            p.running += 1
+            p.virtual_time = start
+            return
+
+        waiter = _Waiter(finish, next(self._seq), start, asyncio.get_running_loop().create_future())
+        heapq.heappush(p.queue, waiter)
+        try:
+            if (on_queued := _on_queued.get()) is not None:
+                position = sum(1 for w in p.queue if w < waiter and not w.future.done()) + 1
+                try:
+                    await on_queued(position)
+                except Exception:
+                    log.exception("Failed to send queue feedback")
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # we were handed a slot just as we were cancelled, give it to the next waiter
+                self._release(p)
+            else:
+                waiter.future.cancel()
+            raise
+
+    def _release(self, p: _Provider):
+        p.running -= 1
+        while p.running < p.concurrency and p.queue:
+            waiter = heapq.heappop(p.queue)
+            if waiter.future.done():  # cancelled while waiting
+                continue
+            p.running += 1
+            p.virtual_time = waiter.start
+            waiter.future.set_result(None)
+
+    async def _load_usage(self):
+        """Seed the rolling token usage of each user from the usage ledger. Only hits the DB once."""
+        if self._usage_loaded:
+            return
+        async with self._usage_load_lock:
+            if self._usage_loaded:
+                return
+            since = datetime.datetime.utcnow() - self.budget_window
+            async with db.async_session() as session:
+                rows = await queries.get_user_token_usage_since(session, since)
+            for user_id, timestamp, tokens in rows:
+                self._user_usage[user_id].append((timestamp, tokens))
+            self._usage_loaded = True
+
+    def _expire_usage(self, usage: collections.deque):
+        cutoff = datetime.datetime.utcnow() - self.budget_window
+        while usage and usage[0][0] < cutoff:
+            usage.popleft()
+
+
+class ScheduledEngine(WrapperEngine):
+    """Wraps an engine so that every call to it waits for a turn with the scheduler and is charged to the user."""
+
+    def __init__(self, engine: BaseEngine, *args, scheduler: Scheduler, provider: str, **kwargs):
+        super().__init__(engine, *args, **kwargs)
+        self.scheduler = scheduler
+        self.provider = provider
+
+    async def predict(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> BaseCompletion:
+        async with self.scheduler.slot(self.provider):
+            completion = await super().predict(messages, functions, **hyperparams)
+        self._charge(completion)
+        return completion
+
+    async def stream(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams):
+        async with self.scheduler.slot(self.provider):
+            async for elem in super().stream(messages, functions, **hyperparams):
+                if isinstance(elem, BaseCompletion):
+                    self._charge(elem)
+                yield elem
+
+    def _charge(self, completion: BaseCompletion):
+        if (ctx := current_usage_context()) is None:
+            return
+        self.scheduler.charge(ctx.user_id, (completion.prompt_tokens or 0) + (completion.completion_tokens or 0))
+
+
+ai_scheduler = Scheduler(PROVIDER_CONCURRENCY, user_token_budget=config.AI_USER_TOKEN_BUDGET or None)
@@ -0,0 +1,161 @@
+"""
+Rendering AI messages into Discord, either all at once or progressively as they are streamed.
+"""
+
+import asyncio
+import logging
+import time
+
+import disnake
+from kani import ChatMessage
+from kani.engines.anthropic import AnthropicUnknownPart
+from kani.engines.anthropic.parts import AnthropicThinkingPart
+
+from calypso.utils.functions import chunk_text
+
+log = logging.getLogger(__name__)
+
+MAX_MESSAGE_LEN = 2000
+# the minimum time between edits of a streaming message; Discord allows about 5 edits per 5 seconds per channel
+EDIT_INTERVAL = 1.2
+
+
+def render_ai_msg(msg: ChatMessage) -> list[str]:
+    """
+    Render a finished AI message into blocks of Discord text: thinking summaries, server tool use, and the reply
+    itself, with a list of the tools the model called at the end. Each block should be sent as its own message(s).
+    """
+    blocks = []
+    buf = []
+    last_was_content = False
+
+    def flush():
+        if not buf:
+            return
+        blocks.append("\n".join(buf).strip())
+        buf.clear()
+
+    for part in msg.parts:
+        match part:
+            case AnthropicThinkingPart(content=str(thinking)) if thinking:
+                if last_was_content:
+                    flush()
+                thinking_clean = thinking.replace("\n", " ").replace("||", "|")
+                buf.append(f"> -# Thinking: ||{thinking_clean}||")
+                last_was_content = False
+            case AnthropicUnknownPart(type="server_tool_use", data={"name": "web_search", "input": {"query": q}}):
+                if last_was_content:
+                    flush()
+                buf.append(f"> -# Calypso searched for: `{q}`")
+                last_was_content = False
+            case AnthropicUnknownPart(type="web_fetch_tool_result", data={"content": {"url": url}}):
+                if last_was_content:
+                    flush()
+                buf.append(f"> -# Calypso visited: `{url}`")
+                last_was_content = False
+            case _:
+                content = str(part)
+                if content:
+                    if last_was_content:
+                        buf[-1] += content
+                    else:
+                        flush()
+                        buf.append(content)
+                    last_was_content = True
+
+    if msg.tool_calls:
+        tool_calls = ", ".join(f"`{tc.function.name}`" for tc in msg.tool_calls)
+        tool_calls_str = f"> -# Calypso used tools: {tool_calls}"
+        buf.append(tool_calls_str)
+
+    flush()
+    return [block for block in blocks if block]
+
+
+class StreamingRenderer:
+    """
+    Posts a reply as it is streamed, editing the message as tokens arrive. Edits are coalesced to at most one per
+    EDIT_INTERVAL, and text past Discord's message length limit rolls over into a new message (split by the same rules
+    as chunk_text). Once the reply is finished, :meth:`finish` re-renders it with the annotations from
+    :func:`render_ai_msg`.
+    """
+
+    def __init__(self, dest: disnake.abc.Messageable):
+        self.dest = dest
+        self.messages: list[disnake.Message] = []
+        self._shown: list[str] = []  # the content currently shown in each message
+        self._frozen: list[str] = []  # streamed chunks that have rolled over, i.e. will not change until finish()
+        self._tail = ""  # streamed text after the frozen chunks
+        self._last_edit = 0.0
+        self._flush_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._finished = False
+
+    # ==== public ====
+    def feed(self, token: str):
+        """Add a streamed token. The message is updated in the background."""
+        self._tail += token
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def finish(self, msg: ChatMessage):
+        """Replace the streamed text with the final rendering of the message."""
+        self._finished = True
+        # only cancel a pending flush while it is still waiting; one that is already sending/editing runs to completion
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        chunks = [
+            chunk.strip()
+            for block in render_ai_msg(msg)
+            for chunk in chunk_text(block, max_chunk_size=MAX_MESSAGE_LEN)
+            if chunk.strip()
+        ]
+        async with self._lock:
+            for idx, chunk in enumerate(chunks):
+                await self._show(idx, chunk)
+            # the final render can be shorter than the streamed text (e.g. if it was re-chunked differently)
+            for message in self.messages[len(chunks) :]:
+                await message.delete()
+            del self.messages[len(chunks) :]
+            del self._shown[len(chunks) :]
+
+    # ==== internals ====
+    async def _delayed_flush(self):
+        await asyncio.sleep(max(self._last_edit + EDIT_INTERVAL - time.monotonic(), 0))
+        self._flush_task = None
+        try:
+            async with self._lock:
+                if not self._finished:
+                    await self._flush()
+        except disnake.HTTPException:
+            log.warning("Failed to update a streaming AI message", exc_info=True)
+
+    async def _flush(self):
+        # roll over full chunks; update our state before awaiting so that tokens fed in the meantime are kept
+        text = self._tail
+        chunks = chunk_text(text, max_chunk_size=MAX_MESSAGE_LEN)
+        first_new = len(self._frozen)
+        if len(chunks) > 1:
+            self._frozen.extend(chunk for chunk in chunks[:-1] if chunk.strip())
+            self._tail = chunks[-1] + self._tail[len(text) :]
+
+        for idx in range(first_new, len(self._frozen)):
+            await self._show(idx, self._frozen[idx])
+        if chunks[-1].strip():
+            await self._show(len(self._frozen), chunks[-1])
+
+    async def _show(self, idx: int, content: str):
+        """Make the *idx*-th message show *content*, sending it if it does not exist yet."""
+        content = content.strip()
+        if not content:
+            return
+        if idx < len(self.messages):
+            if self._shown[idx] != content:
+                await self.messages[idx].edit(content=content, allowed_mentions=disnake.AllowedMentions.none())
+                self._shown[idx] = content
+        else:
+            message = await self.dest.send(content, allowed_mentions=disnake.AllowedMentions.none())
+            self.messages.append(message)
+            self._shown.append(content)
+        self._last_edit = time.monotonic()
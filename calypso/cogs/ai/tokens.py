@@ -0,0 +1,184 @@
+"""
+Local token estimation for Claude prompts.
+
+Claude's tokenizer isn't public, so an exact prompt length costs an API round trip. Instead, we estimate a prompt's
+length from the number of characters it sends, using a linear fit (tokens = intercept + slope * chars) that is
+calibrated against the exact counts the API reports with every response. The intercept absorbs fixed overhead, like the
+definitions of the server-side tools.
+
+Messages whose exact length is known (i.e. the model's own replies) are counted exactly instead. These lengths are
+keyed by a hash of the message's content and persisted in ``ai_token_lengths``, so they survive restarts.
+"""
+
+import asyncio
+import collections
+import datetime
+import hashlib
+import json
+import math
+
+from kani import AIFunction, ChatMessage
+from kani.engines.anthropic import AnthropicUnknownPart
+from kani.engines.anthropic.parts import AnthropicThinkingPart
+from sqlalchemy import select
+
+from calypso import db, models
+
+DEFAULT_CHARS_PER_TOKEN = 3.2  # conservative; Anthropic documents ~3.4 bytes/token
+CALIBRATION_DECAY = 0.98  # how much to weight the existing samples each time a new one is added
+MIN_CALIBRATION_SAMPLES = 8
+TOKENS_PER_CHAR_BOUNDS = (1 / 8, 1 / 1.5)  # sanity bounds on the fitted slope
+MESSAGE_CACHE_SIZE = 8192
+
+
+class _MergeWriter(db.BatchWriter):
+    async def write_batch(self, session, rows):
+        for row in rows:
+            await session.merge(row)
+
+
+class TokenEstimator:
+    def __init__(self, model: str):
+        self.model = model
+        # decayed sums for the least-squares fit: n, sum(x), sum(y), sum(x^2), sum(xy)
+        self._stats = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self._exact_lens: dict[str, int] = {}
+        # id(message) -> (message, hash, chars); chat messages are not mutated once they are in a chat history
+        self._message_cache: collections.OrderedDict[int, tuple[ChatMessage, str, int]] = collections.OrderedDict()
+        self._function_chars: dict[tuple[str, ...], int] = {}
+        self._load_lock = asyncio.Lock()
+        self._loaded = False
+        self._writer = _MergeWriter(f"token lengths ({model})", flush_interval=5)
+
+    # ==== loading ====
+    async def load(self):
+        """Load the saved calibration for this model. Only hits the DB the first time it is called."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            async with db.async_session() as session:
+                calibration = await session.get(models.AITokenCalibration, self.model)
+            if calibration is not None:
+                self._stats = [
+                    calibration.n,
+                    calibration.sum_x,
+                    calibration.sum_y,
+                    calibration.sum_xx,
+                    calibration.sum_xy,
+                ]
+            self._loaded = True
+
+    async def preload(self, messages: list[ChatMessage]):
+        """Load the saved exact lengths of the given messages (e.g. when resuming a chat) in bulk."""
+        missing = [h for h in (self._message_info(m)[0] for m in messages) if h not in self._exact_lens]
+        async with db.async_session() as session:
+            for i in range(0, len(missing), 500):
+                stmt = select(models.AITokenLength).where(models.AITokenLength.content_hash.in_(missing[i : i + 500]))
+                result = await session.execute(stmt)
+                for row in result.scalars():
+                    self._exact_lens[row.content_hash] = row.tokens
+
+    # ==== estimation ====
+    def estimate(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None) -> int:
+        """Estimate the number of tokens in the given prompt."""
+        exact, chars = self._split(messages, functions)
+        return exact + math.ceil(self._tokens_for_chars(chars))
+
+    def record_exact(self, message: ChatMessage, tokens: int):
+        """Save the exact length of a single message."""
+        content_hash, _ = self._message_info(message)
+        if self._exact_lens.get(content_hash) == tokens:
+            return
+        self._exact_lens[content_hash] = tokens
+        self._writer.add(models.AITokenLength(content_hash=content_hash, tokens=tokens))
+
+    def calibrate(self, messages: list[ChatMessage], functions: list[AIFunction] | None, actual: int):
+        """Update the fit with the exact length of a prompt, as reported by the API."""
+        exact, chars = self._split(messages, functions)
+        x, y = chars, actual - exact
+        if x <= 0 or y <= 0:
+            return
+        n, sx, sy, sxx, sxy = (v * CALIBRATION_DECAY for v in self._stats)
+        self._stats = [n + 1, sx + x, sy + y, sxx + x * x, sxy + x * y]
+        self._writer.add(
+            models.AITokenCalibration(
+                model=self.model,
+                n=self._stats[0],
+                sum_x=self._stats[1],
+                sum_y=self._stats[2],
+                sum_xx=self._stats[3],
+                sum_xy=self._stats[4],
+                timestamp=datetime.datetime.utcnow(),
+            )
+        )
+
+    # ==== internals ====
+    def _tokens_for_chars(self, chars: int) -> float:
+        n, sx, sy, sxx, sxy = self._stats
+        low, high = TOKENS_PER_CHAR_BOUNDS
+        if n >= MIN_CALIBRATION_SAMPLES:
+            denom = n * sxx - sx * sx
+            if denom > 0:
+                slope = (n * sxy - sx * sy) / denom
+                intercept = (sy - slope * sx) / n
+                if low <= slope <= high and intercept >= 0:
+                    return intercept + slope * chars
+            # degenerate fit (e.g. all the samples are about the same size): use the mean ratio instead
+            return min(max(sy / sx, low), high) * chars
+        return chars / DEFAULT_CHARS_PER_TOKEN
+
+    def _split(self, messages: list[ChatMessage], functions: list[AIFunction] | None) -> tuple[int, int]:
+        """Returns (exact tokens, chars to estimate) for the given prompt."""
+        exact = 0
+        chars = 0
+        for message in messages:
+            content_hash, message_chars = self._message_info(message)
+            if (n := self._exact_lens.get(content_hash)) is not None:
+                exact += n
+            else:
+                chars += message_chars
+        if functions:
+            chars += self._functions_chars(functions)
+        return exact, chars
+
+    def _message_info(self, message: ChatMessage) -> tuple[str, int]:
+        """Returns (content hash, chars) for the given message."""
+        key = id(message)
+        if (cached := self._message_cache.get(key)) is not None and cached[0] is message:
+            self._message_cache.move_to_end(key)
+            return cached[1], cached[2]
+
+        data = json.dumps(message.model_dump(mode="json", exclude={"extra"}, fallback=repr), sort_keys=True)
+        content_hash = hashlib.blake2b(f"{self.model}\0{data}".encode(), digest_size=16).hexdigest()
+        chars = message_chars(message)
+
+        self._message_cache[key] = (message, content_hash, chars)
+        if len(self._message_cache) > MESSAGE_CACHE_SIZE:
+            self._message_cache.popitem(last=False)
+        return content_hash, chars
+
+    def _functions_chars(self, functions: list[AIFunction]) -> int:
+        key = tuple(f.name for f in functions)
+        if key not in self._function_chars:
+            self._function_chars[key] = sum(
+                len(f.name) + len(f.desc) + len(json.dumps(f.json_schema)) for f in functions
+            )
+        return self._function_chars[key]
+
+
+def message_chars(message: ChatMessage) -> int:
+    """The number of characters a message sends to the API, roughly."""
+    chars = len(message.role.value)
+    for part in message.parts:
+        match part:
+            case AnthropicThinkingPart(content=thinking):
+                chars += len(thinking)
+            case AnthropicUnknownPart(data=data):
+                chars += len(json.dumps(data, default=str))
+            case _:
+                chars += len(str(part))
+    for tc in message.tool_calls or ():
+        chars += len(tc.function.name) + len(tc.function.arguments)
+    return chars
@@ -0,0 +1,54 @@
+"""
+Batched writer for AI chat and brainstorm transcripts.
+
+Messages are queued as they are generated and bulk-inserted in short windows by a single background task, so a chat
+round never waits on the DB. Serializing kani messages (which can include long thinking parts and server tool results)
+happens in a worker thread when the batch is written.
+"""
+
+import asyncio
+import datetime
+from typing import NamedTuple
+
+from kani import ChatMessage, ChatRole
+
+from calypso import db, models
+
+
+class _PendingChatMessage(NamedTuple):
+    chat_id: int
+    message: ChatMessage
+    timestamp: datetime.datetime
+
+
+class TranscriptWriter(db.BatchWriter):
+    def add_chat_message(self, chat_id: int, message: ChatMessage):
+        """Queue a message in an ``/ai chat`` session to be saved to ``ai_chat_messages_raw``."""
+        self.add(_PendingChatMessage(chat_id, message, datetime.datetime.utcnow()))
+
+    def add_brainstorm_message(self, brainstorm_id: int, role: ChatRole, content: str):
+        """Queue a message in an encounter brainstorm to be saved to ``enc_brainstorm_messages``."""
+        self.add(
+            models.EncounterAIBrainstormMessage(
+                brainstorm_id=brainstorm_id, role=role, content=content, timestamp=datetime.datetime.utcnow()
+            )
+        )
+
+    async def prepare_batch(self, items: list) -> list:
+        serialized = await asyncio.to_thread(_serialize_all, items)
+        return [
+            models.AIChatMessageRaw(chat_id=item.chat_id, data=data, timestamp=item.timestamp)
+            if isinstance(item, _PendingChatMessage)
+            else item
+            for item, data in zip(items, serialized)
+        ]
+
+
+def _serialize_all(items: list) -> list[dict | None]:
+    return [
+        item.message.model_dump(mode="json", fallback=repr) if isinstance(item, _PendingChatMessage) else None
+        for item in items
+    ]
+
+
+transcript_writer = TranscriptWriter("transcripts")
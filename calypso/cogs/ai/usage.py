@@ -0,0 +1,181 @@
+"""
+Usage and latency ledger for the AI features.
+
+Every engine call made by an engine with :class:`UsageTrackingMixin` is recorded in ``ai_usage``, along with the
+feature, session, and user it was made for. That context is set by the caller with :func:`usage_context`, so the
+engines (which are shared between chats) don't need to know who they're talking to. Calls that don't go through a kani
+engine (e.g. image generation) are recorded with :func:`record_usage`.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import datetime
+import math
+import time
+from typing import Iterable
+
+from kani import AIFunction, ChatMessage
+from kani.engines.base import BaseCompletion
+
+from calypso import db, models
+
+
+@dataclasses.dataclass
+class UsageContext:
+    feature: str
+    session_id: int | None = None
+    user_id: int | None = None
+    # the number of engine calls made in this context so far, e.g. the rounds of a tool loop
+    rounds: int = 0
+
+
+_current_context: contextvars.ContextVar[UsageContext | None] = contextvars.ContextVar("usage_context", default=None)
+usage_writer = db.BatchWriter("usage", flush_interval=5)
+
+
+def current_usage_context() -> UsageContext | None:
+    """The usage context that engine calls are currently attributed to, if any."""
+    return _current_context.get()
+
+
+@contextlib.contextmanager
+def usage_context(feature: str, session_id: int = None, user_id: int = None):
+    """
+    Attribute all engine calls made in this block to the given feature, session, and user. If the session or user is
+    not given, it is inherited from the enclosing context (e.g. a chat compaction inside a chat round).
+    """
+    parent = _current_context.get()
+    if parent is not None:
+        session_id = session_id if session_id is not None else parent.session_id
+        user_id = user_id if user_id is not None else parent.user_id
+    token = _current_context.set(UsageContext(feature, session_id, user_id))
+    try:
+        yield
+    finally:
+        _current_context.reset(token)
+
+
+def record_usage(
+    *,
+    model: str,
+    latency: float,
+    ttft: float = None,
+    input_tokens: int = None,
+    output_tokens: int = None,
+    cache_read_tokens: int = None,
+    cache_write_tokens: int = None,
+    tool_calls: int = 0,
+    error: str = None,
+    feature: str = None,
+):
+    """Queue a usage record for a single model call, attributed to the current usage context."""
+    ctx = _current_context.get() or UsageContext("unknown")
+    ctx.rounds += 1
+    usage_writer.add(
+        models.AIUsageRecord(
+            feature=feature or ctx.feature,
+            session_id=ctx.session_id,
+            user_id=ctx.user_id,
+            model=model,
+            round=ctx.rounds,
+            ttft=ttft,
+            latency=latency,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_write_tokens=cache_write_tokens,
+            tool_calls=tool_calls,
+            error=error,
+            timestamp=datetime.datetime.utcnow(),
+        )
+    )
+
+
+class UsageTrackingMixin:
+    """
+    Records the latency, time to first token, and token usage of every call to :meth:`predict` and :meth:`stream` in the
+    usage ledger. Must come before the engine class in the bases.
+    """
+
+    async def predict(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams):
+        start = time.perf_counter()
+        try:
+            completion = await super().predict(messages, functions, **hyperparams)
+        except Exception as e:
+            record_usage(model=self.model, latency=time.perf_counter() - start, error=repr(e))
+            raise
+        self._record_usage(completion, latency=time.perf_counter() - start)
+        return completion
+
+    async def stream(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams):
+        start = time.perf_counter()
+        ttft = None
+        try:
+            async for elem in super().stream(messages, functions, **hyperparams):
+                if isinstance(elem, BaseCompletion):
+                    self._record_usage(elem, latency=time.perf_counter() - start, ttft=ttft)
+                elif ttft is None:
+                    ttft = time.perf_counter() - start
+                yield elem
+        except Exception as e:
+            record_usage(model=self.model, latency=time.perf_counter() - start, ttft=ttft, error=repr(e))
+            raise
+
+    def _record_usage(self, completion: BaseCompletion, latency: float, ttft: float = None):
+        cache_read_tokens = cache_write_tokens = None
+        if (anthropic_message := completion.message.extra.get("anthropic_message")) is not None:
+            cache_read_tokens = anthropic_message.usage.cache_read_input_tokens or 0
+            cache_write_tokens = anthropic_message.usage.cache_creation_input_tokens or 0
+        record_usage(
+            model=self.model,
+            latency=latency,
+            ttft=ttft,
+            input_tokens=completion.prompt_tokens,
+            output_tokens=completion.completion_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_write_tokens=cache_write_tokens,
+            tool_calls=len(completion.message.tool_calls or ()),
+        )
+
+
+# ==== reporting ====
+def percentile(values: list[float], p: float) -> float | None:
+    """The *p*-th percentile (0-100) of the given values, by the nearest-rank method."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def usage_report(records: Iterable[models.AIUsageRecord]) -> str:
+    """Summarize usage records per feature: call count, errors, latency, TTFT, tokens, and cache hit ratio."""
+    by_feature: dict[str, list[models.AIUsageRecord]] = {}
+    for record in records:
+        by_feature.setdefault(record.feature, []).append(record)
+    if not by_feature:
+        return "No AI usage in this window."
+
+    def fmt_seconds(x):
+        return f"{x:.2f}s" if x is not None else "-"
+
+    lines = []
+    for feature, feature_records in sorted(by_feature.items()):
+        ok = [r for r in feature_records if r.error is None]
+        latencies = [r.latency for r in ok]
+        ttfts = [r.ttft for r in ok if r.ttft is not None]
+        input_tokens = sum(r.input_tokens or 0 for r in ok)
+        output_tokens = sum(r.output_tokens or 0 for r in ok)
+        cache_read = sum(r.cache_read_tokens or 0 for r in ok)
+        cache_write = sum(r.cache_write_tokens or 0 for r in ok)
+        total_input = input_tokens + cache_read + cache_write
+        cache_hit_ratio = f"{cache_read / total_input:.1%}" if total_input else "-"
+        lines.append(
+            f"{feature}: {len(feature_records)} calls ({len(feature_records) - len(ok)} errors),"
+            f" {sum(r.tool_calls for r in ok)} tool calls\n"
+            f"  latency p50 {fmt_seconds(percentile(latencies, 50))} p95 {fmt_seconds(percentile(latencies, 95))},"
+            f" TTFT p50 {fmt_seconds(percentile(ttfts, 50))} p95 {fmt_seconds(percentile(ttfts, 95))}\n"
+            f"  tokens: {total_input} in ({cache_read} cache read, {cache_write} cache write), {output_tokens} out;"
+            f" cache hit ratio {cache_hit_ratio}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,95 @@
+"""
+Precomputed visibility of channels to the public (Member and Player) roles, for the AI's access checks.
+
+Resolving a channel's permissions for a role walks its overwrites, so instead of doing that on every check we keep a
+map of channel id -> visible per guild. It is updated channel by channel on channel events, and rebuilt when a role
+changes (see the listeners in AIUtils). Threads inherit the visibility of their parent, except private threads, which
+are never public.
+"""
+
+import disnake
+from disnake import ChannelType, Guild
+
+from calypso import constants
+
+PUBLIC_ROLE_IDS = (constants.MEMBER_ROLE_ID, constants.PLAYER_ROLE_ID)
+
+
+class VisibilityMap:
+    def __init__(self, guild: Guild, role_ids=PUBLIC_ROLE_IDS):
+        self.guild = guild
+        self.role_ids = role_ids
+        self._visible: dict[int, bool] = {}
+        self.rebuild()
+
+    def rebuild(self):
+        """Recompute the visibility of every channel in the guild."""
+        self._visible = {channel.id: self._compute(channel) for channel in self.guild.channels}
+
+    def update_channel(self, channel: disnake.abc.GuildChannel):
+        """Recompute the visibility of a channel, and of its children if it is a category."""
+        self._visible[channel.id] = self._compute(channel)
+        if isinstance(channel, disnake.CategoryChannel):
+            for child in channel.channels:
+                self._visible[child.id] = self._compute(child)
+
+    def remove_channel(self, channel_id: int):
+        self._visible.pop(channel_id, None)
+
+    def is_public(self, channel) -> bool:
+        """Whether the given channel or thread is visible to any of the public roles."""
+        if isinstance(channel, disnake.Thread):
+            if channel.type == ChannelType.private_thread:
+                return False
+            return self._lookup(channel.parent_id, channel.parent)
+        return self._lookup(channel.id, channel)
+
+    def _lookup(self, channel_id: int, channel) -> bool:
+        if (visible := self._visible.get(channel_id)) is not None:
+            return visible
+        # a channel we haven't seen an event for yet; compute it now if we can
+        if channel is None:
+            return False
+        visible = self._visible[channel_id] = self._compute(channel)
+        return visible
+
+    def _compute(self, channel) -> bool:
+        return is_public_to_roles(self.guild, self.role_ids, channel)
+
+
+def is_public_to_roles(guild: Guild, role_ids, channel, reduce=any):
+    if channel.type == ChannelType.private_thread:
+        return False
+    return reduce(channel.permissions_for(guild.get_role(r)).view_channel for r in role_ids)
+
+
+_visibility_maps: dict[int, VisibilityMap] = {}
+
+
+def visibility_map(guild: Guild) -> VisibilityMap:
+    """The visibility map of the given guild, building it on first use."""
+    if guild.id not in _visibility_maps:
+        _visibility_maps[guild.id] = VisibilityMap(guild)
+    return _visibility_maps[guild.id]
+
+
+def is_public(channel) -> bool:
+    """Whether the given channel or thread is visible to the Member or Player roles."""
+    return visibility_map(channel.guild).is_public(channel)
+
+
+# ==== event handlers ====
+# these only update maps that have already been built; the others are built from scratch on first use
+def on_channel_update(channel: disnake.abc.GuildChannel):
+    if (vis := _visibility_maps.get(channel.guild.id)) is not None:
+        vis.update_channel(channel)
+
+
+def on_channel_delete(channel: disnake.abc.GuildChannel):
+    if (vis := _visibility_maps.get(channel.guild.id)) is not None:
+        vis.remove_channel(channel.id)
+
+
+def on_role_update(guild: Guild):
+    if (vis := _visibility_maps.get(guild.id)) is not None:
+        vis.rebuild()
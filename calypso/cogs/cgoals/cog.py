@@ -349,15 +349,22 @@ class CommunityGoals(commands.Cog):
                 await session.commit()
 
     # ==== utils ====
+    async def _cg_channels(self, cg: models.CommunityGoal):
+        """Get the log channel and contribution channel of a CG, resolving them concurrently."""
+        log_channel_id = cg.log_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID
+        contrib_channel_id = cg.contrib_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID
+        channels = await self.bot.get_or_fetch_channels([log_channel_id, contrib_channel_id])
+        return channels[log_channel_id], channels[contrib_channel_id]
+
     async def _send_cg_message(self, cg: models.CommunityGoal):
-        cg_channel = await self.bot.get_or_fetch_channel(cg.log_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID)
-        return await cg_channel.send(embed=await self._cg_embed(cg))
+        cg_channel, contrib_channel = await self._cg_channels(cg)
+        return await cg_channel.send(embed=await self._cg_embed(cg, contrib_channel))
 
     async def _edit_cg_message(self, cg: models.CommunityGoal):
-        cg_channel = await self.bot.get_or_fetch_channel(cg.log_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID)
+        cg_channel, contrib_channel = await self._cg_channels(cg)
         msg = cg_channel.get_partial_message(cg.message_id)
         try:
-            await msg.edit(embed=await self._cg_embed(cg))
+            await msg.edit(embed=await self._cg_embed(cg, contrib_channel))
         except disnake.HTTPException:
             pass
 
@@ -377,7 +384,7 @@ class CommunityGoals(commands.Cog):
         data = [cg.to_avrae_dict() for cg in cgs]
         await self.client.set_gvar(CG_GVAR_ID, json.dumps(data))
 
-    async def _cg_embed(self, cg: models.CommunityGoal) -> disnake.Embed:
+    async def _cg_embed(self, cg: models.CommunityGoal, contrib_channel=None) -> disnake.Embed:
         is_finished = cg.funded_cp >= cg.cost_cp
         percent_complete = min(cg.funded_cp / cg.cost_cp, 1)
         if not is_finished:
@@ -426,9 +433,10 @@ class CommunityGoals(commands.Cog):
         elif cg.log_channel_id == cg.contrib_channel_id:
             embed.set_footer(text=f"Contribute to this goal with !cg {cg.slug} <amount>!")
         else:
-            contrib_channel = await self.bot.get_or_fetch_channel(
-                cg.contrib_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID
-            )
+            if contrib_channel is None:
+                contrib_channel = await self.bot.get_or_fetch_channel(
+                    cg.contrib_channel_id or constants.COMMUNITY_GOAL_CHANNEL_ID
+                )
             embed.set_footer(
                 text=f"Contribute to this goal by running !cg {cg.slug} <amount> in #{contrib_channel.name}!"
             )
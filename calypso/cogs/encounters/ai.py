@@ -1,16 +1,21 @@
 import asyncio
 import json
 import logging
+import time
 from functools import partial
 from typing import TYPE_CHECKING
 
 import disnake.ui
 from kani import ChatMessage, ChatRole, Kani
-from kani.engines.anthropic import AnthropicEngine
 
-from calypso import constants, db, gamedata, models, utils
+from calypso import constants, db, gamedata, models, prompt_store, utils
 from calypso.cogs import weather
 from calypso.cogs.ai import prompts
+from calypso.cogs.ai.engines import TrackedAnthropicEngine
+from calypso.cogs.ai.scheduler import ScheduledEngine, ai_scheduler, queue_feedback
+from calypso.cogs.ai.streaming import StreamingRenderer
+from calypso.cogs.ai.transcripts import transcript_writer
+from calypso.cogs.ai.usage import record_usage, usage_context
 from . import queries
 
 if TYPE_CHECKING:
@@ -35,7 +40,7 @@ BRAINSTORM_HYPERPARAMS = dict(
     model="claude-opus-4-8",
     cache_control={"type": "ephemeral", "ttl": "1h"},
 )
-ENGINE_CLS = AnthropicEngine
+ENGINE_CLS = TrackedAnthropicEngine
 
 log = logging.getLogger(__name__)
 
@@ -53,25 +58,28 @@ async def on_message(bot: "Calypso", message: disnake.Message):
     chatter = bot.enc_chatterboxes[message.channel.id]
     prompt = prompts.chat_prompt(message)
 
-    # record user msg in db
-    async with db.async_session() as session:
-        user_msg = models.EncounterAIBrainstormMessage(
-            brainstorm_id=chatter.chat_session_id, role=ChatRole.USER, content=prompt
-        )
-        session.add(user_msg)
-        await session.commit()
+    # record user msg in db (written in the background)
+    transcript_writer.add_brainstorm_message(chatter.chat_session_id, ChatRole.USER, prompt)
 
-        # do a chat round w/ the chatterbox
-        async with message.channel.typing():
-            response = await chatter.chat_round_str(prompt)
-            await utils.send_chunked(message.channel, response)
+    async def notify_queued(position):
+        await message.channel.send(f"-# > Calypso is busy! You're #{position} in line.")
 
-        # record model msg in db
-        model_msg = models.EncounterAIBrainstormMessage(
-            brainstorm_id=chatter.chat_session_id, role=ChatRole.ASSISTANT, content=response
-        )
-        session.add(model_msg)
-        await session.commit()
+    # do a chat round w/ the chatterbox, showing the response as it is streamed
+    async with message.channel.typing():
+        with (
+            usage_context("enc_brainstorm", session_id=chatter.chat_session_id, user_id=message.author.id),
+            queue_feedback(notify_queued),
+        ):
+            stream = chatter.chat_round_stream(prompt)
+            renderer = StreamingRenderer(message.channel)
+            async for token in stream:
+                renderer.feed(token)
+            msg = await stream.message()
+        await renderer.finish(msg)
+        response = msg.text
+
+    # record model msg in db
+    transcript_writer.add_brainstorm_message(chatter.chat_session_id, ChatRole.ASSISTANT, response)
 
 
 async def on_thread_update(bot: "Calypso", after: disnake.Thread):
@@ -183,17 +191,27 @@ class EncounterHelperController(disnake.ui.View):
         else:
             prompt = summary_prompt_2(self.encounter, self.monsters)
 
+        start = time.perf_counter()
         completion = await interaction.bot.openai_kani.create_completion(
             prompt=prompt, user=str(interaction.author.id), **SUMMARY_HYPERPARAMS
         )
+        with usage_context("enc_summary", user_id=interaction.author.id):
+            usage = getattr(completion, "usage", None)
+            record_usage(
+                model=SUMMARY_HYPERPARAMS["model"],
+                latency=time.perf_counter() - start,
+                input_tokens=getattr(usage, "prompt_tokens", None),
+                output_tokens=getattr(usage, "completion_tokens", None),
+            )
         summary = completion.text.strip()
         self.summary = summary
 
         # save it to db
+        prompt_hash = await prompt_store.store_prompt(prompt)
         async with db.async_session() as session:
             summary_obj = models.EncounterAISummary(
                 encounter_id=self.encounter.id,
-                prompt=prompt,
+                prompt_hash=prompt_hash,
                 generation=summary,
                 hyperparams=json.dumps(SUMMARY_HYPERPARAMS),
                 prompt_version=prompt_version,
@@ -287,7 +305,7 @@ class EncounterHelperController(disnake.ui.View):
 
         # load up a chatterbox
         chatter = EncKani(
-            engine=ENGINE_CLS(**BRAINSTORM_HYPERPARAMS),
+            engine=ScheduledEngine(ENGINE_CLS(**BRAINSTORM_HYPERPARAMS), scheduler=ai_scheduler, provider="anthropic"),
             system_prompt=(
                 "You are a creative D&D player and DM named Calypso.\n"
                 "Avoid mentioning game stats. You may use information from common sense, mythology, and culture."
@@ -306,10 +324,12 @@ class EncounterHelperController(disnake.ui.View):
         self.chatterbox = chatter
 
         # register session in db
+        prompt_json = json.dumps([m.model_dump(mode="json", exclude_none=True) for m in await chatter.get_prompt()])
+        prompt_hash = await prompt_store.store_prompt(prompt_json)
         async with db.async_session() as session:
             brainstorm = models.EncounterAIBrainstormSession(
                 encounter_id=self.encounter.id,
-                prompt=json.dumps([m.model_dump(mode="json", exclude_none=True) for m in await chatter.get_prompt()]),
+                prompt_hash=prompt_hash,
                 hyperparams=json.dumps(BRAINSTORM_HYPERPARAMS),
                 thread_id=thread.id,
             )
@@ -0,0 +1,6 @@
+from .cog import MessageLog
+
+
+def setup(bot):
+    msglog = MessageLog(bot)
+    bot.add_cog(msglog)
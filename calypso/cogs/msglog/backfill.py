@@ -0,0 +1,245 @@
+"""
+Backfill of the message log from the API, for messages that were sent while the bot was offline or before logging
+started.
+
+:func:`sync_guild` runs when the bot starts a new gateway session. It walks each readable channel from where its
+coverage was last synced, to log the messages that were missed while the bot was offline, and marks it synced (see
+:mod:`.coverage`). Channels that aren't synced then (e.g. archived threads) are synced when they are first read from
+the log (:func:`request_sync`). A walk also marks the logged messages it passes that have since been deleted or edited.
+
+:func:`backfill_guild` walks every readable text channel and thread (including archived threads) of a guild, several
+channels at a time. disnake queues requests per rate limit bucket, and the history endpoint's bucket is per channel, so
+channels are walked concurrently while the pages of each channel are fetched in order. Each channel has a checkpoint
+of the newest message the backfill has seen, committed in the same transaction as the messages, so an interrupted
+backfill picks up where it left off. Messages that are already logged are skipped.
+
+Once a backfill walk reaches the end of a channel, the channel is covered from its start (see :mod:`.coverage`), and
+it is synced until events might have been missed again. Channels whose backfill failed or never finished keep the
+coverage they had. Backfilled rows are marked, so that they don't move back when live logging started.
+
+Backfilled messages are logged as they are now rather than as they were sent: edited messages are marked edited, and
+the channel and author names are their current ones.
+"""
+
+import asyncio
+import dataclasses
+import datetime
+import logging
+
+import disnake
+from disnake.utils import time_snowflake
+
+from calypso import db
+from . import coverage, queries
+from .writer import message_log_writer, message_row
+
+log = logging.getLogger(__name__)
+
+# how many channels to walk at once
+CONCURRENCY = 8
+# how many messages to write (and checkpoint) at a time
+BATCH_SIZE = 500
+
+# channel id -> the task syncing it, for syncs requested by readers
+_sync_tasks: dict[int, asyncio.Task] = {}
+
+
+@dataclasses.dataclass
+class BackfillProgress:
+    channels_total: int = 0
+    channels_done: int = 0
+    channels_failed: int = 0
+    messages_seen: int = 0
+    messages_logged: int = 0
+
+
+async def backfill_guild(guild: disnake.Guild, progress: BackfillProgress = None) -> BackfillProgress:
+    """
+    Backfill the message log of every channel and thread in the guild that the bot can read.
+    Pass a :class:`BackfillProgress` to watch the progress of a running backfill.
+    """
+    if progress is None:
+        progress = BackfillProgress()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def run(channel):
+        async with semaphore:
+            try:
+                await backfill_channel(channel, progress)
+            except Exception:
+                progress.channels_failed += 1
+                log.exception(f"Failed to backfill the message log of #{channel} ({channel.id})")
+            else:
+                progress.channels_done += 1
+
+    channels = await _backfill_targets(guild, semaphore)
+    progress.channels_total = len(channels)
+    await asyncio.gather(*(run(channel) for channel in channels))
+    return progress
+
+
+async def backfill_channel(channel: disnake.TextChannel | disnake.Thread, progress: BackfillProgress):
+    """Log the messages in a channel that are newer than its checkpoint (or all of them, the first time)."""
+    generation = coverage.generation()
+    async with db.async_session() as session:
+        checkpoint = await queries.get_backfill_checkpoint(session, channel.id)
+
+    async def save_progress(session, last_message_id, done):
+        await queries.set_backfill_checkpoint(session, channel.id, last_message_id)
+        if done:
+            # every message up to here has been walked, from the start of the channel
+            await queries.set_channel_coverage(
+                session, channel.id, since_message_id=0, synced_through_id=last_message_id
+            )
+
+    await _walk_channel(channel, checkpoint.last_message_id if checkpoint is not None else 0, save_progress, progress)
+    coverage.mark_synced(channel.id, generation)
+
+
+async def sync_guild(guild: disnake.Guild):
+    """Sync the message log of every text channel and active thread in the guild that the bot can read."""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def run(channel):
+        async with semaphore:
+            try:
+                await sync_channel(channel)
+            except Exception:
+                log.exception(f"Failed to sync the message log of #{channel} ({channel.id})")
+
+    channels = [channel for channel in [*guild.text_channels, *guild.threads] if _is_readable(channel)]
+    await asyncio.gather(*(run(channel) for channel in channels))
+
+
+async def sync_channel(channel: disnake.TextChannel | disnake.Thread):
+    """
+    Log the messages in a channel that were sent since its coverage was last synced, and mark it synced (see
+    :mod:`.coverage`). A channel that isn't covered yet is covered from its newest message on.
+    """
+    generation = coverage.generation()
+    async with db.async_session() as session:
+        channel_coverage = await queries.get_channel_coverage(session, channel.id)
+
+    if channel_coverage is None:
+        # everything after the newest message when the session started is logged live
+        since_id = channel.last_message_id or time_snowflake(disnake.utils.utcnow())
+        async with db.async_session() as session:
+            await queries.set_channel_coverage(
+                session, channel.id, since_message_id=since_id, synced_through_id=since_id
+            )
+            await session.commit()
+    else:
+
+        async def save_progress(session, last_message_id, done):
+            await queries.set_channel_coverage(session, channel.id, synced_through_id=last_message_id)
+
+        await _walk_channel(channel, channel_coverage.synced_through_id, save_progress, BackfillProgress())
+    coverage.mark_synced(channel.id, generation)
+
+
+def request_sync(channel: disnake.TextChannel | disnake.Thread):
+    """Sync a channel in the background, unless it is already being synced."""
+    if channel.id in _sync_tasks:
+        return
+    task = _sync_tasks[channel.id] = asyncio.create_task(sync_channel(channel))
+
+    def done(_):
+        del _sync_tasks[channel.id]
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"Failed to sync the message log of #{channel} ({channel.id})", exc_info=task.exception())
+
+    task.add_done_callback(done)
+
+
+# ==== walks ====
+async def _walk_channel(channel, after_id: int, save_progress, progress: BackfillProgress):
+    """
+    Log the messages in a channel after *after_id* (0 for all of them), oldest first, a batch at a time.
+    ``save_progress(session, last_message_id, done)`` is called in the transaction of each batch, with the id that the
+    channel has been walked up to, and whether the walk has reached the end of the channel.
+    """
+    # anything sent before this that the walk doesn't see has been deleted
+    walk_started_id = time_snowflake(disnake.utils.utcnow())
+    after = disnake.Object(after_id) if after_id else None
+
+    batch = []
+    async for message in channel.history(limit=None, after=after, oldest_first=True):
+        progress.messages_seen += 1
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            await _write_batch(channel.id, batch, after_id, batch[-1].id, save_progress, progress)
+            after_id = batch[-1].id
+            batch = []
+    # the walk reached the end of the channel
+    await _write_batch(channel.id, batch, after_id, walk_started_id, save_progress, progress, done=True)
+
+
+async def _write_batch(
+    channel_id: int,
+    messages: list[disnake.Message],
+    after_id: int,
+    until_id: int,
+    save_progress,
+    progress: BackfillProgress,
+    done: bool = False,
+):
+    """
+    Log a batch of a walk, which saw every message in the channel after *after_id* up to *until_id*, and update the
+    logged messages in that range that have since been deleted or edited.
+    """
+    rows = await _prepare_rows(channel_id, messages)
+    edited_ids = [message.id for message in messages if message.edited_at is not None]
+    # write the messages and save the walk's progress together; the writer's insert also ignores any message that the
+    # live message log wrote in the meantime
+    async with db.async_session() as session:
+        await message_log_writer.write_batch(session, rows)
+        logged_ids = await queries.get_logged_message_ids_between(session, channel_id, after_id, until_id)
+        if deleted_ids := list(logged_ids.difference(message.id for message in messages)):
+            await queries.update_messages(session, channel_id, deleted_ids, deleted_at=datetime.datetime.utcnow())
+        if edited_ids:
+            await queries.mark_messages_edited(session, channel_id, edited_ids, datetime.datetime.utcnow())
+        await save_progress(session, messages[-1].id if messages else after_id, done)
+        await session.commit()
+    progress.messages_logged += len(rows)
+
+
+async def _prepare_rows(channel_id: int, messages: list[disnake.Message]) -> list[dict]:
+    """The rows to log for the messages that aren't logged yet."""
+    rows = {}
+    for message in messages:
+        if message.is_system():
+            continue
+        rows[message.id] = row = message_row(message)
+        row["timestamp"] = message.created_at.replace(tzinfo=None)
+        row["edited_at"] = message.edited_at.replace(tzinfo=None) if message.edited_at else None
+        row["backfilled"] = True
+    if not rows:
+        return []
+
+    async with db.async_session() as session:
+        logged = await queries.get_logged_message_ids(session, channel_id, list(rows))
+    new_rows = [row for message_id, row in rows.items() if message_id not in logged]
+    return await message_log_writer.prepare_batch(new_rows)
+
+
+async def _backfill_targets(guild: disnake.Guild, semaphore: asyncio.Semaphore) -> list:
+    """The text channels and threads in the guild whose history the bot can read."""
+
+    async def channel_targets(channel):
+        targets = [channel] if isinstance(channel, disnake.TextChannel) else []
+        targets.extend(channel.threads)
+        async with semaphore:
+            targets.extend([thread async for thread in channel.archived_threads(limit=None)])
+            if isinstance(channel, disnake.TextChannel) and channel.permissions_for(guild.me).manage_threads:
+                targets.extend([thread async for thread in channel.archived_threads(private=True, limit=None)])
+        return targets
+
+    readable = [channel for channel in [*guild.text_channels, *guild.forum_channels] if _is_readable(channel)]
+    results = await asyncio.gather(*(channel_targets(channel) for channel in readable))
+    # an archived thread can be listed twice if it was archived while we were listing
+    return list({target.id: target for targets in results for target in targets}.values())
+
+
+def _is_readable(channel) -> bool:
+    permissions = channel.permissions_for(channel.guild.me)
+    return permissions.read_messages and permissions.read_message_history
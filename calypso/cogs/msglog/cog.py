@@ -0,0 +1,111 @@
+import asyncio
+import datetime
+import logging
+
+import disnake
+from disnake.ext import commands, tasks
+
+from calypso import config
+from . import coverage
+from .backfill import sync_guild
+from .retention import archive_messages_before
+from .writer import message_log_writer, message_row
+
+log = logging.getLogger(__name__)
+
+
+class MessageLog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.sync_task = None
+        if config.MESSAGE_LOG_RETENTION_DAYS:
+            self.archive_old_messages.start()
+
+    def cog_unload(self):
+        self.archive_old_messages.cancel()
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+
+    @tasks.loop(hours=1)
+    async def archive_old_messages(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=config.MESSAGE_LOG_RETENTION_DAYS)
+        # an exception would stop the loop, so just log it and try again next time
+        try:
+            await archive_messages_before(cutoff)
+        except Exception:
+            log.exception("Failed to archive old logged messages")
+
+    # ==== coverage ====
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # a new gateway session (not a resume), so we may have missed messages since the last one
+        coverage.session_started()
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+        self.sync_task = asyncio.create_task(self.sync_guilds())
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        coverage.connection_lost()
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        coverage.session_resumed()
+
+    async def sync_guilds(self):
+        for guild in self.bot.guilds:
+            await sync_guild(guild)
+        log.info(f"Synced the message log of {len(self.bot.guilds)} guilds")
+
+    # ==== logging ====
+    @commands.Cog.listener()
+    async def on_message(self, message: disnake.Message):
+        if message.is_system():
+            return
+
+        # record user msg in db (written in the background)
+        message_log_writer.add_message(**message_row(message))
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: disnake.RawMessageUpdateEvent):
+        values = {}
+        # embed unfurls also dispatch an update, but don't set edited_timestamp; our own edits are AI replies being
+        # streamed, which are logged as they end up
+        is_own_message = int(payload.data.get("author", {}).get("id", 0)) == self.bot.user.id
+        if payload.data.get("edited_timestamp") and not is_own_message:
+            values["edited_at"] = datetime.datetime.utcnow()
+        if "pinned" in payload.data:
+            values["pinned"] = payload.data["pinned"]
+        if "content" in payload.data or "embeds" in payload.data:
+            values.update(self.edited_content(payload))
+        if not values:
+            return
+        message_log_writer.add_update(payload.channel_id, [payload.message_id], **values)
+
+    def edited_content(self, payload: disnake.RawMessageUpdateEvent) -> dict:
+        """The logged content columns of an edited message, for those that the edit carries."""
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return {}
+        try:
+            message = disnake.Message(state=self.bot._connection, channel=channel, data=payload.data)
+        except KeyError:
+            # a partial update
+            return {}
+        row = message_row(message)
+        values = {}
+        if "content" in payload.data:
+            values.update(content=row["content"], clean_content=row["clean_content"])
+        if "embeds" in payload.data:
+            values["embeds_json"] = row["embeds_json"]
+        return values
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: disnake.RawMessageDeleteEvent):
+        message_log_writer.add_update(payload.channel_id, [payload.message_id], deleted_at=datetime.datetime.utcnow())
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: disnake.RawBulkMessageDeleteEvent):
+        message_log_writer.add_update(
+            payload.channel_id, list(payload.message_ids), deleted_at=datetime.datetime.utcnow()
+        )
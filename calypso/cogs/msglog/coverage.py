@@ -0,0 +1,58 @@
+"""
+Which parts of each channel's history the message log has in full, so that readers only serve ranges of a channel
+from the log if no message in them can be missing.
+
+A channel's coverage (:class:`models.LoggedChannelCoverage`) is stored in the DB: every message after
+since_message_id, up to synced_through_id, is logged. Past synced_through_id, the live message log only has every
+message while the channel is *synced*, which is tracked here, in memory:
+
+- A restart, or a gateway disconnect, unsyncs every channel, since the bot might miss events.
+- If the gateway session is resumed, Discord replays the missed events, so the channels that were synced are again.
+- Otherwise (a new session), each channel is synced again by walking its history from synced_through_id to its newest
+  message (see :func:`.backfill.sync_channel`). The walk logs the messages that were missed, and marks the logged
+  messages it passes that were deleted or edited in the meantime.
+
+Messages from before synced_through_id that were deleted or edited while the bot was offline are not noticed.
+"""
+
+# the channels whose live message log is complete
+_synced_channel_ids: set[int] = set()
+# the channels that were synced when the gateway disconnected, in case the session is resumed
+_synced_before_disconnect: set[int] = set()
+# bumped whenever events might have been missed, so that a sync that started before then doesn't mark its channel synced
+_generation = 0
+
+
+def is_synced(channel_id: int) -> bool:
+    return channel_id in _synced_channel_ids
+
+
+def generation() -> int:
+    """Pass this to :func:`mark_synced` when a sync finishes."""
+    return _generation
+
+
+def mark_synced(channel_id: int, since_generation: int):
+    """Mark a channel synced, if no events might have been missed since *since_generation*."""
+    if since_generation == _generation:
+        _synced_channel_ids.add(channel_id)
+
+
+def connection_lost():
+    global _generation
+    _generation += 1
+    _synced_before_disconnect.update(_synced_channel_ids)
+    _synced_channel_ids.clear()
+
+
+def session_resumed():
+    _synced_channel_ids.update(_synced_before_disconnect)
+    _synced_before_disconnect.clear()
+
+
+def session_started():
+    """A new gateway session: any events since the last one were missed."""
+    global _generation
+    _generation += 1
+    _synced_before_disconnect.clear()
+    _synced_channel_ids.clear()
@@ -0,0 +1,86 @@
+"""
+The channel and author dimensions of the message log.
+
+Logged messages refer to a version of their channel's and author's names (:class:`models.LoggedChannel`,
+:class:`models.LoggedAuthor`) instead of repeating them on every row. :class:`DimensionCache` maps names to the ids of
+those rows, creating rows for names it hasn't seen before, so that writing a message usually doesn't need a lookup.
+"""
+
+import asyncio
+import datetime
+from typing import Callable, Iterable
+
+from sqlalchemy import select
+
+from calypso import db, models
+
+# (channel id, name, parent name)
+ChannelKey = tuple[int, str, str | None]
+# (author id, display name)
+AuthorKey = tuple[int, str]
+
+
+class DimensionCache:
+    def __init__(self):
+        self._channels: dict[ChannelKey, int] = {}
+        self._authors: dict[AuthorKey, int] = {}
+        # held while creating rows, so that concurrent callers (the live writer and backfill workers) that miss the
+        # same name don't both insert it
+        self._lock = asyncio.Lock()
+
+    async def channel_version_ids(
+        self, keys: Iterable[ChannelKey], first_seen: dict[ChannelKey, datetime.datetime] = None
+    ) -> dict[ChannelKey, int]:
+        """Get the ids of the LoggedChannel rows for the given channel names, creating them if needed."""
+        return await self._resolve(
+            models.LoggedChannel,
+            models.LoggedChannel.channel_id,
+            key_of=lambda row: (row.channel_id, row.name, row.parent_name),
+            make=lambda key: models.LoggedChannel(channel_id=key[0], name=key[1], parent_name=key[2]),
+            cache=self._channels,
+            keys=keys,
+            first_seen=first_seen,
+        )
+
+    async def author_version_ids(
+        self, keys: Iterable[AuthorKey], first_seen: dict[AuthorKey, datetime.datetime] = None
+    ) -> dict[AuthorKey, int]:
+        """Get the ids of the LoggedAuthor rows for the given display names, creating them if needed."""
+        return await self._resolve(
+            models.LoggedAuthor,
+            models.LoggedAuthor.author_id,
+            key_of=lambda row: (row.author_id, row.display_name),
+            make=lambda key: models.LoggedAuthor(author_id=key[0], display_name=key[1]),
+            cache=self._authors,
+            keys=keys,
+            first_seen=first_seen,
+        )
+
+    async def _resolve(self, model, id_col, *, key_of: Callable, make: Callable, cache: dict, keys, first_seen) -> dict:
+        keys = set(keys)
+        if not keys <= cache.keys():
+            async with self._lock:
+                await self._create_missing(model, id_col, key_of, make, cache, keys - cache.keys(), first_seen)
+        return {key: cache[key] for key in keys}
+
+    @staticmethod
+    async def _create_missing(model, id_col, key_of: Callable, make: Callable, cache: dict, missing: set, first_seen):
+        if missing:
+            # new rows are committed in their own transaction, so that the cache never refers to rows that were rolled
+            # back with a failed batch of messages
+            async with db.async_session() as session:
+                result = await session.execute(select(model).where(id_col.in_({key[0] for key in missing})))
+                for row in result.scalars():
+                    cache.setdefault(key_of(row), row.id)
+                new_rows = {key: make(key) for key in missing if key not in cache}
+                for key, row in new_rows.items():
+                    if first_seen and key in first_seen:
+                        row.first_seen = first_seen[key]
+                if new_rows:
+                    session.add_all(new_rows.values())
+                    await session.commit()
+                for key, row in new_rows.items():
+                    cache[key] = row.id
+
+
+dimension_cache = DimensionCache()
@@ -0,0 +1,105 @@
+"""
+Channel history served from the message log, for readers that would otherwise page through channel.history().
+
+The log only has what the bot saw, as it was originally sent. :func:`get_logged_history` only serves a query if the
+part of the channel it reads is covered (see :mod:`.coverage`), so that no message can be missing, and returns None
+whenever the log might not match what the API would return, so that the caller can fall back to the API.
+"""
+
+import datetime
+
+import disnake
+from disnake.utils import time_snowflake
+
+from calypso import config, db, models
+from . import coverage, queries
+from .backfill import request_sync
+
+# the id of the oldest message logged live, i.e. when logging started (or the retention cutoff); everything after it is
+# assumed to be logged. Backfilled messages don't count, since a backfill may not have covered every channel.
+_logging_started_id: int | None = None
+
+
+def as_snowflake(value: datetime.datetime | int | None, high: bool) -> int | None:
+    if value is None or isinstance(value, int):
+        return value
+    return time_snowflake(value, high=high)
+
+
+async def get_logging_started_id(session) -> int | None:
+    """The id of the first message logged live, or None if nothing has been logged yet."""
+    global _logging_started_id
+    if _logging_started_id is None:
+        _logging_started_id = await queries.get_first_live_logged_message_id(session)
+    return _logging_started_id
+
+
+async def get_channel_logged_since_id(session, channel_id: int) -> int | None:
+    """
+    The id that every message in the channel after it is logged (taking the retention cutoff into account), or None if
+    the channel isn't synced.
+    """
+    if not coverage.is_synced(channel_id):
+        return None
+    channel_coverage = await queries.get_channel_coverage(session, channel_id)
+    if channel_coverage is None:
+        return None
+    if config.MESSAGE_LOG_RETENTION_DAYS:
+        cutoff = disnake.utils.utcnow() - datetime.timedelta(days=config.MESSAGE_LOG_RETENTION_DAYS)
+        return max(channel_coverage.since_message_id, time_snowflake(cutoff))
+    return channel_coverage.since_message_id
+
+
+def reset_logging_started_id():
+    """Forget when logging started, e.g. after old messages have been archived."""
+    global _logging_started_id
+    _logging_started_id = None
+
+
+async def get_logged_history(
+    channel: disnake.abc.Messageable,
+    limit: int,
+    before: datetime.datetime | int = None,
+    after: datetime.datetime | int = None,
+) -> list[models.LoggedMessage] | None:
+    """
+    Get the messages that ``channel.history(limit=limit, before=before, after=after)`` would return, oldest first, from
+    the message log. Returns None if the log can't answer the query faithfully.
+    """
+    before_id = as_snowflake(before, high=False)
+    after_id = as_snowflake(after, high=True)
+
+    async with db.async_session() as session:
+        messages = await queries.get_channel_history(session, channel.id, limit, before_id, after_id)
+        logged_since_id = await get_channel_logged_since_id(session, channel.id)
+    if logged_since_id is None:
+        if isinstance(channel, (disnake.TextChannel, disnake.Thread)):
+            request_sync(channel)
+        return None
+
+    # edited messages might have been edited while we weren't listening; attachment-only messages and forwards are logged
+    # empty
+    if any(m.edited_at is not None or not (m.content or m.embeds_json) for m in messages):
+        return None
+
+    # every message in the part of the channel that we read, from `read_from_id` on, must be logged
+    oldest_first = after_id is not None and before_id is None
+    if oldest_first:
+        read_from_id = after_id
+    elif len(messages) == limit:
+        read_from_id = messages[0].message_id
+    else:
+        # we ran out of logged messages going back; there are none from before the channel was created
+        read_from_id = max(after_id or 0, channel.id)
+    if read_from_id < logged_since_id:
+        return None
+
+    # make sure we're not missing messages that haven't been logged (or were sent while we weren't listening)
+    if before_id is None and (len(messages) < limit or not oldest_first):
+        last_message_id = getattr(channel, "last_message_id", None)
+        if last_message_id is None:
+            return None
+        newest_logged = messages[-1].message_id if messages else after_id
+        if newest_logged is None or newest_logged < last_message_id:
+            return None
+    return messages
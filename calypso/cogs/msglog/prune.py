@@ -0,0 +1,73 @@
+"""
+Inactivity prune: kicks members who haven't sent a message in a while, unless they have a role that protects them.
+
+Activity comes from the member_activity table, which the message log keeps up to date, so finding the candidates is a
+single indexed query for the members who *have* been active. Kicks are sent back to back: disnake waits out the rate
+limit of the kick endpoint as needed, so they go as fast as Discord allows.
+"""
+
+import datetime
+import logging
+
+import disnake
+from disnake.utils import snowflake_time
+
+from calypso import db
+from calypso.errors import CalypsoError
+from . import queries
+from .history import get_logging_started_id
+
+log = logging.getLogger(__name__)
+
+NO_PRUNE_ROLE_IDS = {
+    1031277823404560404,  # Player
+    1031340755710652507,  # Server Booster
+    1033514863005274203,  # Bots
+    1149379623826751538,  # No Prune
+}
+PRUNE_MESSAGE = (
+    "You have been removed from the Northern Lights Province server, as you have been inactive for over {days} days"
+    " without creating a character.\n\nIf you would like to rejoin, please use the following invite:"
+    " https://discord.gg/RGDTtrhceC"
+)
+
+
+async def prune_candidates(guild: disnake.Guild, inactive_days: int) -> list[disnake.Member]:
+    """
+    The members who joined, and haven't sent a message, in the last *inactive_days* days, without a protected role.
+    """
+    cutoff = disnake.utils.utcnow() - datetime.timedelta(days=inactive_days)
+    async with db.async_session() as session:
+        logging_started_id = await get_logging_started_id(session)
+        active_ids = await queries.get_active_author_ids(session, guild.id, cutoff.replace(tzinfo=None))
+    # someone who was last active before logging started would look inactive; this is when live logging started, since a
+    # backfill doesn't necessarily cover every channel
+    if logging_started_id is None or snowflake_time(logging_started_id) > cutoff:
+        raise CalypsoError(f"The message log doesn't go back {inactive_days} days, so I can't tell who is inactive.")
+
+    return [
+        member
+        for member in guild.members
+        if not member.bot
+        and member.joined_at is not None
+        and member.joined_at < cutoff
+        and member.id not in active_ids
+        and not NO_PRUNE_ROLE_IDS.intersection(role.id for role in member.roles)
+    ]
+
+
+async def prune_members(members: list[disnake.Member], inactive_days: int) -> int:
+    """DM and kick the given members. Returns how many were kicked."""
+    n_kicked = 0
+    for member in members:
+        try:
+            await member.send(PRUNE_MESSAGE.format(days=inactive_days))
+        except disnake.HTTPException:
+            pass
+        try:
+            await member.kick(reason="inactivity prune")
+        except disnake.HTTPException:
+            log.warning(f"Failed to prune {member} ({member.id})", exc_info=True)
+            continue
+        n_kicked += 1
+    return n_kicked
@@ -0,0 +1,205 @@
+import datetime
+
+from sqlalchemy import column, delete, func, literal_column, select, table, update
+from sqlalchemy.orm import joinedload
+
+from calypso import models
+
+# the channel and author names of a logged message, loaded with it
+_with_names = (joinedload(models.LoggedMessage.channel), joinedload(models.LoggedMessage.author))
+
+
+async def get_channel_history(
+    session, channel_id: int, limit: int, before_id: int = None, after_id: int = None
+) -> list[models.LoggedMessage]:
+    """
+    Get up to *limit* logged messages in a channel, oldest first, like ``channel.history()``: the newest messages
+    before *before_id* or, if only *after_id* is given, the oldest messages after it.
+    """
+    stmt = select(models.LoggedMessage).where(
+        models.LoggedMessage.channel_id == channel_id, models.LoggedMessage.deleted_at.is_(None)
+    )
+    if before_id is not None:
+        stmt = stmt.where(models.LoggedMessage.message_id < before_id)
+    if after_id is not None:
+        stmt = stmt.where(models.LoggedMessage.message_id > after_id)
+    if after_id is not None and before_id is None:
+        stmt = stmt.order_by(models.LoggedMessage.message_id)
+    else:
+        stmt = stmt.order_by(models.LoggedMessage.message_id.desc())
+    result = await session.execute(stmt.options(*_with_names).limit(limit))
+    return sorted(result.scalars().all(), key=lambda m: m.message_id)
+
+
+async def get_first_live_logged_message_id(session) -> int | None:
+    """The id of the oldest message logged as it was sent (i.e. not by the backfill)."""
+    stmt = (
+        select(models.LoggedMessage.message_id)
+        .where(models.LoggedMessage.backfilled.is_(False))
+        .order_by(models.LoggedMessage.message_id)
+        .limit(1)
+    )
+    result = await session.execute(stmt)
+    return result.scalar()
+
+
+async def get_logged_message_ids(session, channel_id: int, message_ids: list[int]) -> set[int]:
+    """Which of the given messages in a channel are already logged."""
+    stmt = select(models.LoggedMessage.message_id).where(
+        models.LoggedMessage.channel_id == channel_id, models.LoggedMessage.message_id.in_(message_ids)
+    )
+    result = await session.execute(stmt)
+    return set(result.scalars())
+
+
+async def get_logged_message_ids_between(session, channel_id: int, after_id: int, until_id: int) -> set[int]:
+    """The ids of the messages in a channel after *after_id*, up to and including *until_id*, that aren't deleted."""
+    stmt = select(models.LoggedMessage.message_id).where(
+        models.LoggedMessage.channel_id == channel_id,
+        models.LoggedMessage.message_id > after_id,
+        models.LoggedMessage.message_id <= until_id,
+        models.LoggedMessage.deleted_at.is_(None),
+    )
+    result = await session.execute(stmt)
+    return set(result.scalars())
+
+
+async def get_oldest_messages_before(session, cutoff: datetime.datetime, limit: int) -> list[models.LoggedMessage]:
+    """The oldest logged messages that were logged before *cutoff*, up to *limit* of them."""
+    stmt = (
+        select(models.LoggedMessage)
+        .where(models.LoggedMessage.timestamp < cutoff)
+        .order_by(models.LoggedMessage.id)
+        .options(*_with_names)
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.scalars().all()
+
+
+async def delete_messages(session, ids: list[int]):
+    """Delete logged messages by their row ids."""
+    stmt = delete(models.LoggedMessage).where(models.LoggedMessage.id.in_(ids))
+    await session.execute(stmt)
+
+
+async def update_messages(session, channel_id: int, message_ids: list[int], **values):
+    stmt = (
+        update(models.LoggedMessage)
+        .where(models.LoggedMessage.channel_id == channel_id, models.LoggedMessage.message_id.in_(message_ids))
+        .values(**values)
+    )
+    await session.execute(stmt)
+
+
+async def mark_messages_edited(session, channel_id: int, message_ids: list[int], edited_at: datetime.datetime):
+    """Mark the given logged messages edited, unless they already are."""
+    stmt = (
+        update(models.LoggedMessage)
+        .where(
+            models.LoggedMessage.channel_id == channel_id,
+            models.LoggedMessage.message_id.in_(message_ids),
+            models.LoggedMessage.edited_at.is_(None),
+        )
+        .values(edited_at=edited_at)
+    )
+    await session.execute(stmt)
+
+
+async def search_messages(
+    session,
+    guild_id: int,
+    *,
+    content: str = None,
+    channel_ids: list[int] = None,
+    author_ids: list[int] = None,
+    pinned: bool = None,
+    before_id: int = None,
+    after_id: int = None,
+    sort_by: str = "timestamp",
+    sort_order: str = "desc",
+    limit: int = 25,
+    offset: int = 0,
+) -> tuple[int, list[models.LoggedMessage]] | None:
+    """
+    Search the logged messages in a guild with the full-text index (see models.LOGGED_MESSAGE_SEARCH_DDL).
+    Returns the total number of matches and the requested page of them, or None if searching content isn't supported
+    in this DB.
+    """
+    stmt = select(models.LoggedMessage).where(
+        models.LoggedMessage.guild_id == guild_id, models.LoggedMessage.deleted_at.is_(None)
+    )
+    relevance = None
+    if content:
+        match session.bind.dialect.name:
+            case "sqlite":
+                # quote each word so that FTS5 query syntax in the content is searched for literally
+                query = " ".join('"{}"'.format(word.replace('"', '""')) for word in content.split())
+                fts = table("logged_messages_fts", column("rowid"), column("rank"))
+                stmt = stmt.join(fts, fts.c.rowid == models.LoggedMessage.id)
+                stmt = stmt.where(literal_column("logged_messages_fts").op("MATCH")(query))
+                relevance = fts.c.rank  # bm25, lower is more relevant
+            case "postgresql":
+                search_vector = literal_column("logged_messages.search_vector")
+                query = func.plainto_tsquery("english", content)
+                stmt = stmt.where(search_vector.op("@@")(query))
+                relevance = -func.ts_rank(search_vector, query)
+            case _:
+                return None
+    if channel_ids:
+        stmt = stmt.where(models.LoggedMessage.channel_id.in_(channel_ids))
+    if author_ids:
+        stmt = stmt.where(models.LoggedMessage.author_id.in_(author_ids))
+    if pinned is not None:
+        stmt = stmt.where(models.LoggedMessage.pinned == pinned)
+    if before_id is not None:
+        stmt = stmt.where(models.LoggedMessage.message_id < before_id)
+    if after_id is not None:
+        stmt = stmt.where(models.LoggedMessage.message_id > after_id)
+
+    total = (await session.execute(select(func.count()).select_from(stmt.subquery()))).scalar()
+
+    by_timestamp = (
+        models.LoggedMessage.message_id.asc() if sort_order == "asc" else models.LoggedMessage.message_id.desc()
+    )
+    if sort_by == "relevance" and relevance is not None:
+        stmt = stmt.order_by(relevance, by_timestamp)
+    else:
+        stmt = stmt.order_by(by_timestamp)
+    result = await session.execute(stmt.options(*_with_names).limit(limit).offset(offset))
+    return total, result.scalars().all()
+
+
+# ==== backfill ====
+async def get_backfill_checkpoint(session, channel_id: int) -> models.LoggedMessageBackfillCheckpoint | None:
+    return await session.get(models.LoggedMessageBackfillCheckpoint, channel_id)
+
+
+async def set_backfill_checkpoint(session, channel_id: int, last_message_id: int):
+    await session.merge(models.LoggedMessageBackfillCheckpoint(channel_id=channel_id, last_message_id=last_message_id))
+
+
+# ==== coverage ====
+async def get_channel_coverage(session, channel_id: int) -> models.LoggedChannelCoverage | None:
+    return await session.get(models.LoggedChannelCoverage, channel_id)
+
+
+async def set_channel_coverage(session, channel_id: int, *, since_message_id: int = None, synced_through_id: int):
+    """Move a channel's coverage forward, or start covering it from *since_message_id*."""
+    coverage = await session.get(models.LoggedChannelCoverage, channel_id)
+    if coverage is None:
+        coverage = models.LoggedChannelCoverage(channel_id=channel_id, since_message_id=since_message_id)
+        session.add(coverage)
+    elif since_message_id is not None:
+        coverage.since_message_id = since_message_id
+    coverage.synced_through_id = synced_through_id
+
+
+# ==== activity ====
+async def get_active_author_ids(session, guild_id: int, since: datetime.datetime) -> set[int]:
+    """The ids of the authors who have sent a message in the guild since the given time."""
+    stmt = select(models.MemberActivity.author_id).where(
+        models.MemberActivity.guild_id == guild_id, models.MemberActivity.last_active_at >= since
+    )
+    result = await session.execute(stmt)
+    return set(result.scalars())
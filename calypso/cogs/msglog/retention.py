@@ -0,0 +1,74 @@
+"""
+Retention for the message log: messages older than config.MESSAGE_LOG_RETENTION_DAYS are moved out of logged_messages
+into zlib-compressed per-channel archives. Messages are moved a bounded batch at a time, each in its own short
+transaction, so the job never holds the table for long.
+"""
+
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import zlib
+
+from calypso import db, models
+from . import queries
+from .history import reset_logging_started_id
+
+ARCHIVE_BATCH_SIZE = 1000
+# how long to wait between batches, to leave room for other writers
+ARCHIVE_BATCH_DELAY = 1
+
+log = logging.getLogger(__name__)
+
+
+async def archive_messages_before(cutoff: datetime.datetime) -> int:
+    """Move all messages logged before *cutoff* to the archive. Returns the number of messages moved."""
+    n_archived = 0
+    while True:
+        async with db.async_session() as session:
+            messages = await queries.get_oldest_messages_before(session, cutoff, ARCHIVE_BATCH_SIZE)
+            if not messages:
+                break
+            session.add_all(await asyncio.to_thread(_compress, [_to_dict(m) for m in messages]))
+            await queries.delete_messages(session, [m.id for m in messages])
+            await session.commit()
+        n_archived += len(messages)
+        if len(messages) < ARCHIVE_BATCH_SIZE:
+            break
+        await asyncio.sleep(ARCHIVE_BATCH_DELAY)
+
+    if n_archived:
+        reset_logging_started_id()
+        log.info(f"Archived {n_archived} logged messages from before {cutoff}")
+    return n_archived
+
+
+def _to_dict(message: models.LoggedMessage) -> dict:
+    out = {}
+    for col in models.LoggedMessage.__table__.columns:
+        value = getattr(message, col.key)
+        out[col.key] = value.isoformat() if isinstance(value, datetime.datetime) else value
+    # archives are self-contained, so that the dimension tables can be pruned independently
+    out["channel_name"] = message.channel.name
+    out["parent_name"] = message.channel.parent_name
+    out["author_display_name"] = message.author.display_name
+    return out
+
+
+def _compress(rows: list[dict]) -> list[models.LoggedMessageArchive]:
+    """Group rows by channel and compress each group into an archive row."""
+    archives = []
+    rows = sorted(rows, key=lambda r: (r["channel_id"], r["message_id"]))
+    for channel_id, channel_rows in itertools.groupby(rows, key=lambda r: r["channel_id"]):
+        channel_rows = list(channel_rows)
+        archives.append(
+            models.LoggedMessageArchive(
+                channel_id=channel_id,
+                first_message_id=channel_rows[0]["message_id"],
+                last_message_id=channel_rows[-1]["message_id"],
+                n_messages=len(channel_rows),
+                data=zlib.compress(json.dumps(channel_rows).encode()),
+            )
+        )
+    return archives
@@ -0,0 +1,64 @@
+"""
+Message search served from the message log's full-text index, for readers that would otherwise use Discord's search
+API. Like :mod:`.history`, this returns None whenever the log might not match what the API would return.
+"""
+
+import datetime
+
+from calypso import db, models
+from . import queries
+from .history import as_snowflake, get_logging_started_id
+
+
+async def search_logged_messages(
+    guild_id: int,
+    *,
+    content: str = None,
+    channel_ids: list[int] = None,
+    author_ids: list[int] = None,
+    pinned: bool = None,
+    before: datetime.datetime | int = None,
+    after: datetime.datetime | int = None,
+    sort_by: str = "timestamp",
+    sort_order: str = "desc",
+    limit: int = 25,
+    offset: int = 0,
+) -> tuple[int, list[models.LoggedMessage]] | None:
+    """
+    Search the logged messages of a guild with the same filters as Discord's message search. Returns the total number
+    of results and the requested page of them, or None if the log can't answer the query faithfully.
+    """
+    after_id = as_snowflake(after, high=True)
+    async with db.async_session() as session:
+        results = await queries.search_messages(
+            session,
+            guild_id,
+            content=content,
+            channel_ids=channel_ids,
+            author_ids=author_ids,
+            pinned=pinned,
+            before_id=as_snowflake(before, high=False),
+            after_id=after_id,
+            sort_by=sort_by,
+            sort_order=sort_order,
+            limit=limit,
+            offset=offset,
+        )
+        logging_started_id = await get_logging_started_id(session)
+    if results is None:
+        return None
+    total, messages = results
+
+    # an empty result might just mean the messages predate logging
+    if not messages or logging_started_id is None:
+        return None
+    # edited messages might have been edited while we weren't listening, so they might be indexed out of date
+    if any(m.edited_at is not None for m in messages):
+        return None
+    # unless the search is limited to after logging started, older matches might be missing; that's only fine if we
+    # are returning a full page of the newest matches
+    if after_id is None or after_id < logging_started_id:
+        newest_first = sort_by != "relevance" and sort_order != "asc"
+        if not (newest_first and len(messages) == limit):
+            return None
+    return total, messages
@@ -0,0 +1,185 @@
+"""
+Batched writer for the message log.
+
+Every message the bot sees is logged, which makes this our highest-volume write path. Instead of a transaction per
+message, rows are queued and bulk-inserted in short windows by a single background task. Edits and deletes go through
+the same queue, so they are always applied after the insert of the message they refer to. Each batch also moves the
+last activity of its authors forward in ``member_activity``.
+"""
+
+import datetime
+import functools
+import json
+import logging
+from typing import Iterable, NamedTuple
+
+import disnake
+from disnake.utils import snowflake_time
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from calypso import db, models
+from . import queries
+from .dimensions import dimension_cache
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5
+MAX_BATCH_SIZE = 1000
+
+
+# the names that are given with a queued message, but stored in the dimension tables
+_NAME_KEYS = ("channel_name", "parent_name", "author_display_name")
+
+
+class _PendingUpdate(NamedTuple):
+    channel_id: int
+    message_ids: list[int]
+    values: dict
+
+
+class MessageLogWriter(db.BatchWriter):
+    def add_message(self, **row):
+        """
+        Queue a message to be inserted into ``logged_messages``. Every message must be given the same columns, since
+        they are inserted with executemany, except that the names of its channel and author are given as
+        ``channel_name``, ``parent_name``, and ``author_display_name`` (they are stored in the dimension tables).
+        """
+        row.setdefault("timestamp", datetime.datetime.utcnow())
+        self.add(row)
+
+    def add_update(self, channel_id: int, message_ids: list[int], **values):
+        """Queue an update to the logged messages with the given ids (e.g. marking them edited or deleted)."""
+        self.add(_PendingUpdate(channel_id, message_ids, values))
+
+    async def prepare_batch(self, items: list) -> list:
+        # swap the names in new messages for the ids of their channel/author versions, in new rows so that the queued
+        # items are left as they are if the batch has to be retried
+        messages = [item for item in items if not isinstance(item, _PendingUpdate)]
+        if messages:
+            channel_version_ids = await dimension_cache.channel_version_ids([_channel_key(m) for m in messages])
+            author_version_ids = await dimension_cache.author_version_ids([_author_key(m) for m in messages])
+
+        rows = []
+        for item in items:
+            if isinstance(item, _PendingUpdate):
+                rows.append(item)
+                continue
+            row = {key: value for key, value in item.items() if key not in _NAME_KEYS}
+            row["channel_version_id"] = channel_version_ids[_channel_key(item)]
+            row["author_version_id"] = author_version_ids[_author_key(item)]
+            rows.append(row)
+        return rows
+
+    async def write_batch(self, session, rows: list):
+        # insert runs of new messages with a single executemany, keeping updates in order with them
+        stmt = _insert_ignoring_duplicates(session.bind.dialect.name)
+        inserts = []
+        for row in rows:
+            if isinstance(row, _PendingUpdate):
+                if inserts:
+                    await session.execute(stmt, inserts)
+                    inserts = []
+                await queries.update_messages(session, row.channel_id, row.message_ids, **row.values)
+            else:
+                inserts.append(row)
+        if inserts:
+            await session.execute(stmt, inserts)
+
+        # move the authors' last activity forward in the same transaction
+        activity = _latest_activity(row for row in rows if not isinstance(row, _PendingUpdate))
+        if activity and (upsert := _upsert_member_activity(session.bind.dialect.name)) is not None:
+            await session.execute(upsert, activity)
+
+
+def message_row(message: disnake.Message) -> dict:
+    """The columns to log for a message, as given to :meth:`MessageLogWriter.add_message`."""
+    parent_id = parent_name = None
+    if isinstance(message.channel, disnake.Thread):
+        parent_id = message.channel.parent_id
+        parent_name = message.channel.parent.name
+
+    return dict(
+        # ids
+        message_id=message.id,
+        channel_id=message.channel.id,
+        guild_id=message.guild.id if message.guild else None,
+        author_id=message.author.id,
+        # names
+        channel_name=str(message.channel),
+        author_display_name=message.author.display_name,
+        # content
+        content=message.content,
+        clean_content=message.clean_content,
+        embeds_json=json.dumps([e.to_dict() for e in message.embeds]) if message.embeds else None,
+        pinned=message.pinned,
+        # thread info
+        parent_id=parent_id,
+        parent_name=parent_name,
+    )
+
+
+def _channel_key(message: dict) -> tuple:
+    return message["channel_id"], message["channel_name"], message["parent_name"]
+
+
+def _author_key(message: dict) -> tuple:
+    return message["author_id"], message["author_display_name"]
+
+
+def _insert_ignoring_duplicates(dialect: str):
+    """
+    An insert into logged_messages that skips messages that are already logged (e.g. if the gateway replays events
+    after a resume), so that a duplicate doesn't fail the rest of its batch.
+    """
+    match dialect:
+        case "sqlite":
+            return sqlite.insert(models.LoggedMessage).on_conflict_do_nothing(index_elements=["message_id"])
+        case "postgresql":
+            return postgresql.insert(models.LoggedMessage).on_conflict_do_nothing(index_elements=["message_id"])
+        case _:
+            return insert(models.LoggedMessage)
+
+
+def _latest_activity(rows: Iterable[dict]) -> list[dict]:
+    """The newest of the given messages from each author in each guild, as member_activity rows."""
+    latest = {}
+    for row in rows:
+        if row["guild_id"] is None:
+            continue
+        key = (row["guild_id"], row["author_id"])
+        if key not in latest or latest[key] < row["message_id"]:
+            latest[key] = row["message_id"]
+    return [
+        dict(
+            guild_id=guild_id,
+            author_id=author_id,
+            last_message_id=message_id,
+            last_active_at=snowflake_time(message_id).replace(tzinfo=None),
+        )
+        for (guild_id, author_id), message_id in latest.items()
+    ]
+
+
+@functools.cache
+def _upsert_member_activity(dialect: str):
+    """
+    An insert into member_activity that moves an author's last activity forward if they already have a row (but never
+    back, e.g. for backfilled messages), or None if the dialect can't upsert, in which case activity isn't tracked.
+    """
+    match dialect:
+        case "sqlite":
+            stmt = sqlite.insert(models.MemberActivity)
+        case "postgresql":
+            stmt = postgresql.insert(models.MemberActivity)
+        case _:
+            log.warning(f"Upserting member activity is not supported in {dialect}, so it won't be tracked")
+            return None
+    return stmt.on_conflict_do_update(
+        index_elements=["guild_id", "author_id"],
+        set_={"last_message_id": stmt.excluded.last_message_id, "last_active_at": stmt.excluded.last_active_at},
+        where=models.MemberActivity.last_message_id < stmt.excluded.last_message_id,
+    )
+
+
+message_log_writer = MessageLogWriter("message log", flush_interval=FLUSH_INTERVAL, max_batch_size=MAX_BATCH_SIZE)
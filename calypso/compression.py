@@ -0,0 +1,141 @@
+"""
+Transparently zstd-compressed column types, for large text and JSON columns.
+
+Values are compressed with the newest dictionary trained for the column's dictionary name (see
+``scripts/migrations/compress_large_columns.py``), or without a dictionary if none has been trained yet. Each zstd
+frame records the id of the dictionary it was compressed with, so values compressed with older dictionaries can still
+be read as long as those dictionaries are loaded. Values stored before a column was compressed (plain text, or UTF-8
+bytes) are read as-is, so existing rows can be recompressed in the background.
+
+The dictionaries are loaded from the compression_dictionaries table by :func:`load_dictionaries` when the DB is
+initialized, so a newly trained dictionary is only used (and readable) after a restart.
+"""
+
+import json
+import logging
+
+import zstandard
+from sqlalchemy import LargeBinary, text
+from sqlalchemy.types import TypeDecorator
+
+log = logging.getLogger(__name__)
+
+COMPRESSION_LEVEL = 3
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# dict id -> dictionary, for decompression
+_dictionaries: dict[int, zstandard.ZstdCompressionDict] = {}
+# dictionary name -> the newest dictionary with that name, for compression
+_current_dictionaries: dict[str, zstandard.ZstdCompressionDict] = {}
+# (de)compressors are reused; dict id 0 is no dictionary
+_compressors: dict[int, zstandard.ZstdCompressor] = {}
+_decompressors: dict[int, zstandard.ZstdDecompressor] = {}
+
+
+# ==== dictionaries ====
+def register_dictionary(name: str, data: bytes) -> zstandard.ZstdCompressionDict:
+    """Make a trained dictionary available for decompression, and use it to compress values of the given name."""
+    dictionary = zstandard.ZstdCompressionDict(data)
+    _dictionaries[dictionary.dict_id()] = dictionary
+    _current_dictionaries[name] = dictionary
+    return dictionary
+
+
+async def load_dictionaries(conn):
+    """Load all trained dictionaries from the DB, oldest first so that the newest of each name is used."""
+    result = await conn.execute(text("SELECT name, data FROM compression_dictionaries ORDER BY id"))
+    for name, data in result.all():
+        register_dictionary(name, data)
+    log.info(f"Loaded {len(_dictionaries)} compression dictionaries")
+
+
+def current_dictionary_id(name: str) -> int:
+    """The id of the dictionary that values of the given name are compressed with, or 0 if there is none."""
+    dictionary = _current_dictionaries.get(name)
+    return dictionary.dict_id() if dictionary is not None else 0
+
+
+# ==== compression ====
+def compress(name: str, data: bytes) -> bytes:
+    """
+    Compress *data* with the current dictionary of the given name. If compression doesn't make it smaller, the data is
+    returned as-is (UTF-8 text can never start with the zstd magic number, so the two can be told apart).
+    """
+    dict_id = current_dictionary_id(name)
+    if (compressor := _compressors.get(dict_id)) is None:
+        dictionary = _current_dictionaries[name] if dict_id else None
+        compressor = _compressors[dict_id] = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary)
+    compressed = compressor.compress(data)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress(data: bytes) -> bytes:
+    """Decompress a value written by :func:`compress`."""
+    if not is_compressed(data):
+        return data
+    dict_id = frame_dictionary_id(data)
+    if (decompressor := _decompressors.get(dict_id)) is None:
+        if dict_id and dict_id not in _dictionaries:
+            raise LookupError(f"Compression dictionary {dict_id} is not loaded")
+        dictionary = _dictionaries[dict_id] if dict_id else None
+        decompressor = _decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return decompressor.decompress(data)
+
+
+def is_compressed(data: bytes) -> bool:
+    return data[:4] == ZSTD_MAGIC
+
+
+def frame_dictionary_id(data: bytes) -> int:
+    """The id of the dictionary a compressed value was compressed with, or 0 if none."""
+    return zstandard.get_frame_parameters(data).dict_id
+
+
+# ==== column types ====
+class CompressedText(TypeDecorator):
+    """
+    A string column that is stored zstd-compressed. Old uncompressed values are read as-is.
+
+    :param dictionary_name: The name of the dictionary to compress with. Columns with similar contents can share one.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, dictionary_name: str):
+        super().__init__()
+        self.dictionary_name = dictionary_name
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(self.dictionary_name, self.serialize(value).encode())
+
+    def result_processor(self, dialect, coltype):
+        # skip LargeBinary's own result processing: values from before the column was compressed can come back as str
+        return lambda value: self.process_result_value(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return self.deserialize(value)
+        return self.deserialize(decompress(bytes(value)).decode())
+
+    def serialize(self, value) -> str:
+        return value
+
+    def deserialize(self, value: str):
+        return value
+
+
+class CompressedJSON(CompressedText):
+    """A JSON column that is stored zstd-compressed."""
+
+    def serialize(self, value) -> str:
+        return json.dumps(value)
+
+    def deserialize(self, value: str):
+        return json.loads(value)
@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 
 DB_URI = os.getenv("DB_URI", f"sqlite+aiosqlite:///data/calypso.db")
 TOKEN = os.getenv("TOKEN")
@@ -8,3 +9,9 @@ AVRAE_API_KEY = os.getenv("AVRAE_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 DALLE_ORG_ID = os.getenv("DALLE_ORG_ID")
+# the number of AI tokens each user can use per day (0 = unlimited); a turn that goes over it is cut off between rounds
+AI_USER_TOKEN_BUDGET = int(os.getenv("AI_USER_TOKEN_BUDGET", "0"))
+# logged messages older than this many days are moved to compressed archives (0 = keep them forever)
+MESSAGE_LOG_RETENTION_DAYS = int(os.getenv("MESSAGE_LOG_RETENTION_DAYS", "0"))
+# where large binary blobs (e.g. generated images) are stored, see calypso.blob_store
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", str(Path(__file__).parents[1] / "data" / "blobs"))
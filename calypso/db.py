@@ -1,7 +1,16 @@
+import asyncio
+import collections
+import dataclasses
+import itertools
+import logging
+import time
+
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
-from . import config
+from . import compression, config
+
+log = logging.getLogger(__name__)
 
 engine = create_async_engine(config.DB_URI, echo=False)
 async_session = sessionmaker(
@@ -14,3 +23,165 @@ Base = declarative_base()
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await compression.load_dictionaries(conn)
+
+
+# ==== batched writes ====
+_writers: list["BatchWriter"] = []
+
+# how many times to try writing a batch before narrowing the failure down to the items that cause it
+MAX_WRITE_ATTEMPTS = 5
+# how long to wait before retrying a failed batch, in seconds; doubled after each failed attempt
+RETRY_BACKOFF = 1
+
+
+@dataclasses.dataclass
+class BatchWriterStats:
+    queue_depth: int = 0
+    items_written: int = 0
+    batches_written: int = 0
+    batches_failed: int = 0
+    items_dropped: int = 0
+    max_queue_depth: int = 0
+    # how long the most recent batches took to prepare and commit, in seconds
+    flush_latencies: collections.deque = dataclasses.field(default_factory=lambda: collections.deque(maxlen=200))
+
+
+class BatchWriter:
+    """
+    Buffers rows and writes them to the DB in bulk, in short windows, from a single background task.
+
+    Items are written in the order they were added. Subclasses can override :meth:`prepare_batch` to turn queued items
+    into ORM rows (e.g. to do expensive serialization off the event loop) and :meth:`write_batch` to control how a batch
+    is written.
+
+    A batch that fails to write stays at the front of the queue and is retried with backoff. If it still fails after
+    :data:`MAX_WRITE_ATTEMPTS` attempts, it is split in halves until the failure is narrowed down to the items that
+    cause it, and only those are dropped. Since a batch can be prepared more than once, :meth:`prepare_batch` must not
+    modify the queued items.
+    """
+
+    def __init__(self, name: str, *, flush_interval: float = 0.25, max_batch_size: int = 500):
+        """
+        :param name: A name for this writer, used in logs.
+        :param flush_interval: How long to wait for more items after the first item of a batch is added, in seconds.
+        :param max_batch_size: The maximum number of items to write in a single transaction.
+        """
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._queue = collections.deque()
+        self._pending = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+        self._stats = BatchWriterStats()
+        _writers.append(self)
+
+    # ==== public ====
+    def add(self, item):
+        """Queue an item to be written in the next batch."""
+        if self._closed:
+            raise RuntimeError(f"The {self.name} writer is closed")
+        self._queue.append(item)
+        self._stats.max_queue_depth = max(self._stats.max_queue_depth, len(self._queue))
+        self._pending.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self):
+        """Write everything that is currently queued."""
+        async with self._flush_lock:
+            while self._queue:
+                # the batch stays at the front of the queue until it is written
+                n = min(len(self._queue), self.max_batch_size)
+                items = list(itertools.islice(self._queue, n))
+                for attempt in range(MAX_WRITE_ATTEMPTS):
+                    if await self._write(items):
+                        break
+                    if attempt < MAX_WRITE_ATTEMPTS - 1:
+                        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+                else:
+                    await self._write_bisecting(items)
+                for _ in range(n):
+                    self._queue.popleft()
+
+    def stats(self) -> BatchWriterStats:
+        """The writer's current queue depth, and counts and flush latencies since startup."""
+        return dataclasses.replace(self._stats, queue_depth=len(self._queue))
+
+    async def close(self):
+        """Stop the background task and write everything that is still queued."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    # ==== overridable ====
+    async def prepare_batch(self, items: list) -> list:
+        """Turn a list of queued items into a list of rows to write. By default, items are ORM rows."""
+        return items
+
+    async def write_batch(self, session: AsyncSession, rows: list):
+        """Write a batch of rows using the given session. The caller commits."""
+        session.add_all(rows)
+
+    # ==== internals ====
+    async def _write(self, items: list) -> bool:
+        """Write a batch in its own transaction. Returns whether it was written."""
+        start = time.perf_counter()
+        try:
+            rows = await self.prepare_batch(items)
+            async with async_session() as session:
+                try:
+                    await self.write_batch(session, rows)
+                    await session.commit()
+                except Exception:
+                    # roll back explicitly so that ORM rows added to this session can be added again on a retry
+                    await session.rollback()
+                    raise
+        except Exception:
+            self._stats.batches_failed += 1
+            log.exception(f"Failed to write a batch of {len(items)} items in the {self.name} writer")
+            return False
+        else:
+            self._stats.batches_written += 1
+            self._stats.items_written += len(items)
+            return True
+        finally:
+            self._stats.flush_latencies.append(time.perf_counter() - start)
+
+    async def _write_bisecting(self, items: list):
+        """Write a batch that keeps failing in halves, in order, dropping only the single items that can't be written."""
+        if len(items) == 1:
+            self._stats.items_dropped += 1
+            log.error(f"Dropping an item that could not be written in the {self.name} writer: {items[0]!r}")
+            return
+        mid = len(items) // 2
+        for half in (items[:mid], items[mid:]):
+            if not await self._write(half):
+                await self._write_bisecting(half)
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            # let the window fill up, unless we already have a full batch waiting
+            if len(self._queue) < self.max_batch_size:
+                await asyncio.sleep(self.flush_interval)
+            self._pending.clear()
+            # shield the flush so that closing the writer mid-flush doesn't lose the in-flight batch
+            await asyncio.shield(self.flush())
+
+
+def writers() -> list["BatchWriter"]:
+    return list(_writers)
+
+
+async def close_writers():
+    """Flush and close all batch writers. Called on shutdown."""
+    for writer in _writers:
+        await writer.close()
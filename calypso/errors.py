@@ -4,3 +4,7 @@ class CalypsoError(Exception):
 
 class UserInputError(CalypsoError):
     pass
+
+
+class AIBudgetExceeded(CalypsoError):
+    pass
@@ -2,9 +2,24 @@ import datetime
 import re
 
 from kani import ChatRole
-from sqlalchemy import BigInteger, Column, DateTime, Enum, ForeignKey, Integer, JSON, LargeBinary, String
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DDL,
+    DateTime,
+    Enum,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    event,
+)
 from sqlalchemy.orm import relationship
 
+from .compression import CompressedJSON, CompressedText
 from .db import Base
 
 
@@ -143,7 +158,7 @@ class EncounterAISummary(Base):
 
     id = Column(Integer, primary_key=True)
     encounter_id = Column(Integer, ForeignKey("enc_encounter_log.id", ondelete="CASCADE"))
-    prompt = Column(String, nullable=False)
+    prompt_hash = Column(String, ForeignKey("prompt_blobs.hash"), nullable=False)
     generation = Column(String, nullable=False)
     hyperparams = Column(String, nullable=False)
     feedback = Column(Integer, nullable=True)
@@ -168,7 +183,7 @@ class EncounterAIBrainstormSession(Base):
 
     id = Column(Integer, primary_key=True)
     encounter_id = Column(Integer, ForeignKey("enc_encounter_log.id", ondelete="CASCADE"))
-    prompt = Column(String, nullable=False)
+    prompt_hash = Column(String, ForeignKey("prompt_blobs.hash"), nullable=False)
     hyperparams = Column(String, nullable=False)
     thread_id = Column(BigInteger, nullable=False)
 
@@ -195,7 +210,7 @@ class AIOpenEndedChat(Base):
     channel_id = Column(BigInteger, nullable=False)
     author_id = Column(BigInteger, nullable=False)
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
-    prompt = Column(String, nullable=False)
+    prompt_hash = Column(String, ForeignKey("prompt_blobs.hash"), nullable=False)
     hyperparams = Column(String, nullable=False)
     thread_id = Column(BigInteger, nullable=False)
     thread_title = Column(String, nullable=True)
@@ -206,7 +221,24 @@ class AIChatMessageRaw(Base):
 
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, ForeignKey("ai_chats.id", ondelete="CASCADE"))
-    data = Column(JSON, nullable=False)
+    data = Column(CompressedJSON("ai_chat_messages_raw.data"), nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    chat = relationship("AIOpenEndedChat")
+
+
+class AIChatSummary(Base):
+    """
+    A rolling summary of the start of a chat, which replaces the first *n_messages* messages of the chat (in
+    ai_chat_messages_raw id order) in the model's context. The raw messages are kept.
+    """
+
+    __tablename__ = "ai_chat_summaries"
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("ai_chats.id", ondelete="CASCADE"))
+    n_messages = Column(Integer, nullable=False)
+    content = Column(String, nullable=False)
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
 
     chat = relationship("AIOpenEndedChat")
@@ -237,6 +269,55 @@ class AIFunctionCall(Base):
     message = relationship("AIChatMessage")
 
 
+class AITokenLength(Base):
+    """The exact token length of a single chat message, as reported by the API, keyed by a hash of its content."""
+
+    __tablename__ = "ai_token_lengths"
+
+    content_hash = Column(String, primary_key=True)  # hash of (model, message), see ai.tokens.TokenEstimator
+    tokens = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class AITokenCalibration(Base):
+    """
+    Running (exponentially decayed) sums for a least-squares fit of prompt tokens against prompt characters, used to
+    estimate prompt lengths locally. See ai.tokens.TokenEstimator.
+    """
+
+    __tablename__ = "ai_token_calibrations"
+
+    model = Column(String, primary_key=True)
+    n = Column(Float, nullable=False, default=0)
+    sum_x = Column(Float, nullable=False, default=0)
+    sum_y = Column(Float, nullable=False, default=0)
+    sum_xx = Column(Float, nullable=False, default=0)
+    sum_xy = Column(Float, nullable=False, default=0)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class AIUsageRecord(Base):
+    """A single model call made by an AI feature, for usage and latency reporting. See ai.usage."""
+
+    __tablename__ = "ai_usage"
+
+    id = Column(Integer, primary_key=True)
+    feature = Column(String, nullable=False)  # e.g. ai_chat, enc_brainstorm, gptimage
+    session_id = Column(Integer, nullable=True)  # the id of the chat/brainstorm/etc, if any
+    user_id = Column(BigInteger, nullable=True)
+    model = Column(String, nullable=False)
+    round = Column(Integer, nullable=False, default=1)  # the index of this call in its turn (e.g. tool loop rounds)
+    ttft = Column(Float, nullable=True)  # seconds to the first streamed token, for streaming calls
+    latency = Column(Float, nullable=False)  # seconds
+    input_tokens = Column(Integer, nullable=True)  # uncached input tokens
+    output_tokens = Column(Integer, nullable=True)
+    cache_read_tokens = Column(Integer, nullable=True)
+    cache_write_tokens = Column(Integer, nullable=True)
+    tool_calls = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+
+
 # ==== ai memory ====
 class AIMemory(Base):
     """
@@ -253,6 +334,32 @@ class AIMemory(Base):
 
 
 # ==== message logging ====
+class LoggedChannel(Base):
+    """
+    A name of a channel or thread seen by the message log. A new row is added when a channel is renamed (or a thread's
+    parent is), so logged messages keep the names their channel had when they were sent.
+    """
+
+    __tablename__ = "logged_channels"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(BigInteger, nullable=False, index=True)
+    name = Column(String, nullable=False)
+    parent_name = Column(String, nullable=True)  # channel parent name if thread
+    first_seen = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class LoggedAuthor(Base):
+    """A display name of a message author seen by the message log. A new row is added when the display name changes."""
+
+    __tablename__ = "logged_authors"
+
+    id = Column(Integer, primary_key=True)
+    author_id = Column(BigInteger, nullable=False, index=True)
+    display_name = Column(String, nullable=False)
+    first_seen = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
 class LoggedMessage(Base):
     __tablename__ = "logged_messages"
 
@@ -263,15 +370,113 @@ class LoggedMessage(Base):
     guild_id = Column(BigInteger, nullable=True)
     author_id = Column(BigInteger, nullable=False)
     parent_id = Column(BigInteger, nullable=True)  # channel parent id if thread
-    # names
-    channel_name = Column(String, nullable=False)
-    parent_name = Column(String, nullable=True)  # channel parent name if thread
-    author_display_name = Column(String, nullable=False)
+    # names, as of when the message was sent
+    channel_version_id = Column(Integer, ForeignKey("logged_channels.id"), nullable=False)
+    author_version_id = Column(Integer, ForeignKey("logged_authors.id"), nullable=False)
     # content
     content = Column(String, nullable=True)
     clean_content = Column(String, nullable=True)
-    embeds_json = Column(String, nullable=True)
+    embeds_json = Column(CompressedText("logged_messages.embeds_json"), nullable=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # set when the message is edited (except by the bot itself) or deleted after it was logged; the content above is kept
+    # up to date with the edits that the bot sees
+    edited_at = Column(DateTime, nullable=True)
+    deleted_at = Column(DateTime, nullable=True)
+    pinned = Column(Boolean, nullable=False, default=False)
+    # logged from the API by the backfill, rather than by the live message log as it was sent
+    backfilled = Column(Boolean, nullable=False, default=False)
+
+    channel = relationship("LoggedChannel")
+    author = relationship("LoggedAuthor")
+
+    __table_args__ = (
+        Index("ix_logged_messages_message_id", "message_id", unique=True),
+        Index("ix_logged_messages_channel_id_message_id", "channel_id", "message_id"),
+        Index("ix_logged_messages_channel_id_timestamp", "channel_id", "timestamp"),
+        Index("ix_logged_messages_author_id_timestamp", "author_id", "timestamp"),
+    )
+
+
+# full-text index over LoggedMessage.clean_content, kept up to date by the DB as rows are written
+# sqlite: an external content FTS5 table, maintained by triggers; postgres: a generated tsvector column with a GIN index
+LOGGED_MESSAGE_SEARCH_DDL = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS logged_messages_fts"
+        " USING fts5(clean_content, content='logged_messages', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS logged_messages_fts_insert AFTER INSERT ON logged_messages BEGIN"
+        " INSERT INTO logged_messages_fts (rowid, clean_content) VALUES (new.id, new.clean_content); END",
+        "CREATE TRIGGER IF NOT EXISTS logged_messages_fts_delete AFTER DELETE ON logged_messages BEGIN"
+        " INSERT INTO logged_messages_fts (logged_messages_fts, rowid, clean_content)"
+        " VALUES ('delete', old.id, old.clean_content); END",
+        "CREATE TRIGGER IF NOT EXISTS logged_messages_fts_update AFTER UPDATE OF clean_content ON logged_messages BEGIN"
+        " INSERT INTO logged_messages_fts (logged_messages_fts, rowid, clean_content)"
+        " VALUES ('delete', old.id, old.clean_content);"
+        " INSERT INTO logged_messages_fts (rowid, clean_content) VALUES (new.id, new.clean_content); END",
+    ],
+    "postgresql": [
+        "ALTER TABLE logged_messages ADD COLUMN IF NOT EXISTS search_vector tsvector"
+        " GENERATED ALWAYS AS (to_tsvector('english', coalesce(clean_content, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_logged_messages_search_vector ON logged_messages USING GIN (search_vector)",
+    ],
+}
+for _dialect, _statements in LOGGED_MESSAGE_SEARCH_DDL.items():
+    for _statement in _statements:
+        event.listen(LoggedMessage.__table__, "after_create", DDL(_statement).execute_if(dialect=_dialect))
+
+
+class LoggedMessageArchive(Base):
+    """
+    Logged messages from a single channel that are older than the retention period, moved out of logged_messages.
+    ``data`` is a zlib-compressed JSON list of the rows, as dicts of column name -> value.
+    """
+
+    __tablename__ = "logged_message_archives"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(BigInteger, nullable=False, index=True)
+    first_message_id = Column(BigInteger, nullable=False)
+    last_message_id = Column(BigInteger, nullable=False)
+    n_messages = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class LoggedMessageBackfillCheckpoint(Base):
+    """How far the message log has been backfilled in a channel: every message up to last_message_id has been seen."""
+
+    __tablename__ = "logged_message_backfill_checkpoints"
+
+    channel_id = Column(BigInteger, primary_key=True)
+    last_message_id = Column(BigInteger, nullable=False)  # 0 if the channel had no messages
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+
+class LoggedChannelCoverage(Base):
+    """
+    The part of a channel's history that the message log has in full: every message after since_message_id, up to
+    synced_through_id. Past synced_through_id, the log is only complete while the channel is synced (see
+    msglog.coverage).
+    """
+
+    __tablename__ = "logged_channel_coverage"
+
+    channel_id = Column(BigInteger, primary_key=True)
+    since_message_id = Column(BigInteger, nullable=False)
+    synced_through_id = Column(BigInteger, nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+
+class MemberActivity(Base):
+    """The last message each author sent in a guild, kept up to date by the message log (e.g. for inactivity prunes)."""
+
+    __tablename__ = "member_activity"
+
+    guild_id = Column(BigInteger, primary_key=True)
+    author_id = Column(BigInteger, primary_key=True)
+    last_message_id = Column(BigInteger, nullable=False)
+    last_active_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (Index("ix_member_activity_guild_id_last_active_at", "guild_id", "last_active_at"),)
 
 
 # ==== dalle ====
@@ -285,7 +490,31 @@ class DalleImage(Base):
     size = Column(String, nullable=False)
     style = Column(String, nullable=False)
 
-    data = Column(LargeBinary, nullable=False)
+    data_hash = Column(String, nullable=False, index=True)  # the image, in the blob store
     filename = Column(String, nullable=False)
     revised_prompt = Column(String, nullable=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+# ==== storage ====
+class CompressionDictionary(Base):
+    """A zstd dictionary trained on the values of a compressed column (see calypso.compression)."""
+
+    __tablename__ = "compression_dictionaries"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, index=True)
+    dict_id = Column(BigInteger, nullable=False, unique=True)
+    data = Column(LargeBinary, nullable=False)
+    n_samples = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class PromptBlob(Base):
+    """The body of a prompt that rows reference by hash, stored once however many rows use it (see prompt_store)."""
+
+    __tablename__ = "prompt_blobs"
+
+    hash = Column(String, primary_key=True)  # sha256 of the body
+    body = Column(CompressedText("prompts"), nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
@@ -0,0 +1,68 @@
+"""
+A content-addressed store for prompts that repeat across rows (chat system prompts, encounter statblocks).
+
+Rows reference a prompt by the SHA-256 hash of its body (see :class:`models.PromptBlob`), so each distinct prompt is
+stored once. Recently used prompts are kept in an LRU cache, so storing a prompt that was seen recently doesn't touch
+the DB at all, and loading one usually doesn't either.
+"""
+
+import collections
+import hashlib
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from calypso import db, models
+
+CACHE_SIZE = 256
+
+# hash -> body, least recently used first
+_cache: collections.OrderedDict[str, str] = collections.OrderedDict()
+
+
+def prompt_hash(body: str) -> str:
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+async def store_prompt(body: str) -> str:
+    """Store a prompt if it isn't already stored, and return its hash. The new row is committed in its own session."""
+    key = prompt_hash(body)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return key
+    async with db.async_session() as session:
+        stmt = _insert_ignoring_duplicates(session.bind.dialect.name).values(hash=key, body=body)
+        await session.execute(stmt)
+        await session.commit()
+    _remember(key, body)
+    return key
+
+
+async def load_prompt(key: str) -> str | None:
+    """Get the body of a stored prompt by its hash, or None if there is no such prompt."""
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    async with db.async_session() as session:
+        result = await session.execute(select(models.PromptBlob.body).where(models.PromptBlob.hash == key))
+        body = result.scalar()
+    if body is not None:
+        _remember(key, body)
+    return body
+
+
+def _remember(key: str, body: str):
+    _cache[key] = body
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _insert_ignoring_duplicates(dialect: str):
+    """An insert into prompt_blobs that does nothing if the prompt was already stored (e.g. by a concurrent writer)."""
+    match dialect:
+        case "sqlite":
+            return sqlite.insert(models.PromptBlob).on_conflict_do_nothing(index_elements=["hash"])
+        case "postgresql":
+            return postgresql.insert(models.PromptBlob).on_conflict_do_nothing(index_elements=["hash"])
+        case _:
+            return insert(models.PromptBlob)
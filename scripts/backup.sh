@@ -3,3 +3,7 @@
 
 timestamp=$(date +%s)
 sudo -u postgres pg_dump --no-owner -v -Z 9 calypso | aws s3 cp - s3://andrz-research-bak/calypso/backup-${timestamp}.sql.gz
+
+# Sync the blob store (e.g. generated images); blobs are content-addressed and never change, so this only uploads new
+# ones
+aws s3 sync "${BLOB_STORE_PATH:-$(dirname "$0")/../data/blobs}" s3://andrz-research-bak/calypso/blobs/ --exclude "*.tmp"
@@ -13,7 +13,7 @@ import disnake
 
 sys.path.append("..")
 
-from calypso import db, models
+from calypso import db, models, prompt_store
 
 TOKEN = os.getenv("TOKEN")
 GUILD_ID = 1031055347319832666
@@ -201,6 +201,7 @@ class Historian:
         async with db.async_session() as session:
             for chat in self.chats:
                 messages = chat.pop("messages")
+                chat["prompt_hash"] = await prompt_store.store_prompt(chat.pop("prompt"))
                 chat_model = models.AIOpenEndedChat(**chat)
                 session.add(chat_model)
                 await session.commit()
@@ -0,0 +1,22 @@
+"""
+2026-10-19
+Add the backfilled column to logged_messages, so that backfilled messages don't move back when live logging started
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE logged_messages ADD COLUMN backfilled BOOLEAN NOT NULL DEFAULT false"))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+"""
+2026-10-19
+Add the edited_at/deleted_at columns and the (channel_id, message_id) index to logged_messages, for serving channel
+history from the message log
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE logged_messages ADD COLUMN edited_at TIMESTAMP"))
+        await conn.execute(text("ALTER TABLE logged_messages ADD COLUMN deleted_at TIMESTAMP"))
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_logged_messages_channel_id_message_id"
+                " ON logged_messages (channel_id, message_id)"
+            )
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""
+2026-10-19
+Add the message_id (unique), (channel_id, timestamp), and (author_id, timestamp) indexes to logged_messages, removing
+duplicate messages first, and create the logged_message_archives table
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db, models
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        # keep the first copy of each message
+        result = await conn.execute(
+            text(
+                "DELETE FROM logged_messages WHERE id NOT IN (SELECT MIN(id) FROM logged_messages GROUP BY message_id)"
+            )
+        )
+        print(f"Deleted {result.rowcount} duplicate messages")
+        await conn.execute(
+            text("CREATE UNIQUE INDEX IF NOT EXISTS ix_logged_messages_message_id ON logged_messages (message_id)")
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_logged_messages_channel_id_timestamp"
+                " ON logged_messages (channel_id, timestamp)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_logged_messages_author_id_timestamp"
+                " ON logged_messages (author_id, timestamp)"
+            )
+        )
+        await conn.run_sync(models.LoggedMessageArchive.__table__.create, checkfirst=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
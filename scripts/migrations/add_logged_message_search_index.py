@@ -0,0 +1,28 @@
+"""
+2026-10-19
+Add the pinned column and the full-text search index to logged_messages, and index the messages that are already logged
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db, models
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        dialect = conn.dialect.name
+        await conn.execute(text("ALTER TABLE logged_messages ADD COLUMN pinned BOOLEAN NOT NULL DEFAULT FALSE"))
+        for statement in models.LOGGED_MESSAGE_SEARCH_DDL[dialect]:
+            await conn.execute(text(statement))
+        # postgres computes the generated column for existing rows when it is added
+        if dialect == "sqlite":
+            await conn.execute(text("INSERT INTO logged_messages_fts (logged_messages_fts) VALUES ('rebuild')"))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
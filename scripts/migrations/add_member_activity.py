@@ -0,0 +1,38 @@
+"""
+2026-10-19
+Create the member_activity table and seed it with the last logged message of each author in each guild
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db, models
+from calypso.cogs.msglog.writer import _latest_activity, _upsert_member_activity
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(models.MemberActivity.__table__.create, checkfirst=True)
+        result = await conn.execute(
+            text(
+                "SELECT guild_id, author_id, MAX(message_id) AS message_id FROM logged_messages"
+                " WHERE guild_id IS NOT NULL GROUP BY guild_id, author_id"
+            )
+        )
+        # last_active_at comes from the message id, as it does when the message log moves it forward
+        activity = _latest_activity(result.mappings())
+        upsert = _upsert_member_activity(conn.dialect.name)
+        if upsert is None:
+            print(f"Member activity isn't supported in {conn.dialect.name}")
+            return
+        if activity:
+            await conn.execute(upsert, activity)
+    print(f"Seeded the activity of {len(activity)} members")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
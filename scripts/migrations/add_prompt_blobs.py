@@ -0,0 +1,72 @@
+"""
+2026-10-19
+Move the prompts of ai_chats, enc_summaries and enc_brainstorms into the content-addressed prompt_blobs table, converting
+the existing rows in batches, then drop the prompt columns
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import compression, db, models, prompt_store
+
+BATCH_SIZE = 1000
+TABLES = ("ai_chats", "enc_summaries", "enc_brainstorms")
+
+
+def as_text(value) -> str:
+    # the prompt columns may already have been compressed by compress_large_columns.py
+    return value if isinstance(value, str) else compression.decompress(bytes(value)).decode()
+
+
+async def convert_table(table: str):
+    async with db.engine.begin() as conn:
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN prompt_hash VARCHAR REFERENCES prompt_blobs (hash)"))
+
+    last_id = 0
+    n_converted = 0
+    hashes = set()
+    size_before = 0
+    while True:
+        async with db.engine.connect() as conn:
+            result = await conn.execute(
+                text(f"SELECT id, prompt FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": BATCH_SIZE},
+            )
+            rows = result.all()
+        if not rows:
+            break
+
+        # (new prompts are committed in their own transactions)
+        updates = []
+        for row_id, prompt in rows:
+            body = as_text(prompt)
+            prompt_hash = await prompt_store.store_prompt(body)
+            hashes.add(prompt_hash)
+            size_before += len(body.encode())
+            updates.append({"row_id": row_id, "prompt_hash": prompt_hash})
+        async with db.engine.begin() as conn:
+            await conn.execute(text(f"UPDATE {table} SET prompt_hash = :prompt_hash WHERE id = :row_id"), updates)
+        last_id = rows[-1][0]
+        n_converted += len(rows)
+        print(f"{table}: converted {n_converted} rows")
+
+    async with db.engine.begin() as conn:
+        await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN prompt"))
+    print(f"{table}: {n_converted} rows share {len(hashes)} distinct prompts ({size_before / 1e6:.1f} MB of prompts)")
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(models.PromptBlob.__table__.create, checkfirst=True)
+        await conn.run_sync(models.CompressionDictionary.__table__.create, checkfirst=True)
+        await compression.load_dictionaries(conn)
+    for table in TABLES:
+        await convert_table(table)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,189 @@
+"""
+2026-10-19
+Compress the large text and JSON columns (see calypso.compression), in two steps:
+
+- ``python compress_large_columns.py train`` converts the columns to binary (postgres) and trains a zstd dictionary
+  for each of them on a sample of their existing values.
+- Restart the bot so that it loads the new dictionaries, then run ``python compress_large_columns.py recompress`` to
+  recompress the existing rows with them, a batch at a time, while the bot keeps running. It prints the size savings.
+
+Both steps can be run again later, e.g. to retrain the dictionaries once there is more data.
+"""
+import asyncio
+import collections
+import sys
+from pathlib import Path
+
+import zstandard
+from sqlalchemy import LargeBinary, bindparam, text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import compression, db, models
+
+BATCH_SIZE = 1000
+# how long to wait between batches, so that the bot's own writes don't wait on us
+BATCH_DELAY = 0.1
+# the newest values of each dictionary's columns that are used to train it
+N_SAMPLES = 20000
+DICTIONARY_SIZE = 110 * 1024
+
+COMPRESSED_COLUMNS = [
+    column
+    for table in db.Base.metadata.sorted_tables
+    for column in table.columns
+    if isinstance(column.type, compression.CompressedText)
+]
+
+
+def as_bytes(value) -> bytes:
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+# ==== train ====
+async def convert_column_types():
+    """Postgres columns have to be converted to bytea; sqlite stores bytes in any column."""
+    async with db.engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            return
+        for column in COMPRESSED_COLUMNS:
+            result = await conn.execute(
+                text(
+                    "SELECT data_type FROM information_schema.columns"
+                    " WHERE table_name = :table AND column_name = :column"
+                ),
+                {"table": column.table.name, "column": column.name},
+            )
+            if result.scalar() == "bytea":
+                continue
+            print(f"Converting {column} to bytea")
+            await conn.execute(
+                text(
+                    f"ALTER TABLE {column.table.name} ALTER COLUMN {column.name} TYPE bytea"
+                    f" USING convert_to({column.name}::text, 'UTF8')"
+                )
+            )
+
+
+async def train():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(models.CompressionDictionary.__table__.create, checkfirst=True)
+        await compression.load_dictionaries(conn)
+    await convert_column_types()
+
+    columns_by_dictionary = collections.defaultdict(list)
+    for column in COMPRESSED_COLUMNS:
+        columns_by_dictionary[column.type.dictionary_name].append(column)
+
+    for name, columns in columns_by_dictionary.items():
+        samples = []
+        async with db.engine.connect() as conn:
+            for column in columns:
+                result = await conn.execute(
+                    text(
+                        f"SELECT {column.name} FROM {column.table.name} WHERE {column.name} IS NOT NULL"
+                        " ORDER BY id DESC LIMIT :limit"
+                    ),
+                    {"limit": N_SAMPLES // len(columns)},
+                )
+                samples.extend(compression.decompress(as_bytes(value)) for value in result.scalars())
+
+        try:
+            dictionary = await asyncio.to_thread(zstandard.train_dictionary, DICTIONARY_SIZE, samples)
+        except zstandard.ZstdError as e:
+            # usually not enough data yet; values are compressed without a dictionary until there is
+            print(f"Could not train a dictionary for {name} from {len(samples)} samples: {e}")
+            continue
+
+        async with db.async_session() as session:
+            session.add(
+                models.CompressionDictionary(
+                    name=name, dict_id=dictionary.dict_id(), data=dictionary.as_bytes(), n_samples=len(samples)
+                )
+            )
+            await session.commit()
+        print(f"Trained dictionary {dictionary.dict_id()} for {name} from {len(samples)} samples")
+
+    print("Restart the bot to load the new dictionaries, then run this script again with `recompress`.")
+
+
+# ==== recompress ====
+def recompress_batch(column, rows) -> tuple[list[dict], int, int]:
+    """
+    Recompress the rows that aren't compressed with the current dictionary.
+    Returns the updates to make, and the size of the batch before and after.
+    """
+    name = column.type.dictionary_name
+    current_dict_id = compression.current_dictionary_id(name)
+    updates = []
+    size_before = size_after = 0
+    for row_id, value in rows:
+        old = as_bytes(value)
+        if compression.is_compressed(old) and compression.frame_dictionary_id(old) == current_dict_id:
+            new = old
+        else:
+            new = compression.compress(name, compression.decompress(old))
+        if new != old or isinstance(value, str):
+            updates.append({"row_id": row_id, "value": new})
+        size_before += len(old)
+        size_after += len(new)
+    return updates, size_before, size_after
+
+
+async def recompress_column(column) -> tuple[int, int]:
+    table = column.table.name
+    update = text(f"UPDATE {table} SET {column.name} = :value WHERE id = :row_id").bindparams(
+        bindparam("value", type_=LargeBinary)
+    )
+    last_id = 0
+    n_rows = n_updated = total_before = total_after = 0
+    while True:
+        async with db.engine.connect() as conn:
+            result = await conn.execute(
+                text(
+                    f"SELECT id, {column.name} FROM {table} WHERE id > :last_id AND {column.name} IS NOT NULL"
+                    " ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": BATCH_SIZE},
+            )
+            rows = result.all()
+        if not rows:
+            break
+
+        updates, size_before, size_after = await asyncio.to_thread(recompress_batch, column, rows)
+        if updates:
+            async with db.engine.begin() as conn:
+                await conn.execute(update, updates)
+        last_id = rows[-1][0]
+        n_rows += len(rows)
+        n_updated += len(updates)
+        total_before += size_before
+        total_after += size_after
+        print(f"{column}: {n_rows} rows checked, {n_updated} recompressed")
+        await asyncio.sleep(BATCH_DELAY)
+    return total_before, total_after
+
+
+async def recompress():
+    async with db.engine.connect() as conn:
+        await compression.load_dictionaries(conn)
+
+    savings = {}
+    for column in COMPRESSED_COLUMNS:
+        savings[str(column)] = await recompress_column(column)
+
+    print()
+    for column, (size_before, size_after) in savings.items():
+        saved = 1 - size_after / size_before if size_before else 0
+        print(f"{column}: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB ({saved:.0%} smaller)")
+    total_before = sum(before for before, _ in savings.values())
+    total_after = sum(after for _, after in savings.values())
+    saved = (total_before - total_after) / 1e6
+    print(f"total: {total_before / 1e6:.1f} MB -> {total_after / 1e6:.1f} MB, saved {saved:.1f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("train", "recompress"):
+        print(f"Usage: {sys.argv[0]} train|recompress")
+        sys.exit(1)
+    asyncio.run(train() if sys.argv[1] == "train" else recompress())
@@ -0,0 +1,77 @@
+"""
+2026-10-19
+Move the image data of dalle_images out of the DB and into the blob store, streaming a few rows at a time, then drop
+the data column once every image is in the blob store
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import inspect, text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import config, db
+from calypso.blob_store import blob_store
+
+# images are a few MB each, so keep batches small
+BATCH_SIZE = 20
+
+
+async def verify_blobs() -> bool:
+    """Check that every image is in the blob store."""
+    async with db.engine.connect() as conn:
+        result = await conn.execute(text("SELECT id, data_hash FROM dalle_images ORDER BY id"))
+        rows = result.all()
+    missing = [row_id for row_id, data_hash in rows if data_hash is None or not await blob_store.exists(data_hash)]
+    if missing:
+        print(f"{len(missing)} images are missing from the blob store, e.g. {missing[:10]}")
+    return not missing
+
+
+async def main():
+    print(f"Moving images to {Path(config.BLOB_STORE_PATH).resolve()}")
+    async with db.engine.begin() as conn:
+        # the script can be run again if it stopped before dropping the data column
+        columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns("dalle_images"))
+        if "data_hash" not in {column["name"] for column in columns}:
+            await conn.execute(text("ALTER TABLE dalle_images ADD COLUMN data_hash VARCHAR"))
+            await conn.execute(text("CREATE INDEX ix_dalle_images_data_hash ON dalle_images (data_hash)"))
+
+    last_id = 0
+    n_moved = 0
+    n_bytes = 0
+    while True:
+        async with db.engine.connect() as conn:
+            result = await conn.execute(
+                text("SELECT id, data FROM dalle_images WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": BATCH_SIZE},
+            )
+            rows = result.all()
+        if not rows:
+            break
+
+        # write the blobs before pointing the rows at them
+        updates = []
+        for row_id, data in rows:
+            data_hash = await blob_store.put(bytes(data))
+            updates.append({"row_id": row_id, "data_hash": data_hash})
+            n_bytes += len(data)
+        async with db.engine.begin() as conn:
+            await conn.execute(text("UPDATE dalle_images SET data_hash = :data_hash WHERE id = :row_id"), updates)
+        last_id = rows[-1][0]
+        n_moved += len(rows)
+        print(f"Moved {n_moved} images ({n_bytes / 1e6:.1f} MB)")
+
+    if not await verify_blobs():
+        print("Not dropping the data column.")
+        return
+    async with db.engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("ALTER TABLE dalle_images ALTER COLUMN data_hash SET NOT NULL"))
+        await conn.execute(text("ALTER TABLE dalle_images DROP COLUMN data"))
+    print("Done. Run VACUUM (FULL on postgres) to reclaim the space.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""
+2026-10-19
+Move the channel and author names of logged messages into the logged_channels and logged_authors dimension tables,
+converting the existing rows in batches, then drop the name columns from logged_messages
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+sys.path.append(str(Path(__file__).parents[2]))
+
+from calypso import db, models
+from calypso.cogs.msglog.dimensions import DimensionCache
+
+BATCH_SIZE = 5000
+
+
+async def main():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(models.LoggedChannel.__table__.create, checkfirst=True)
+        await conn.run_sync(models.LoggedAuthor.__table__.create, checkfirst=True)
+        await conn.execute(
+            text("ALTER TABLE logged_messages ADD COLUMN channel_version_id INTEGER REFERENCES logged_channels (id)")
+        )
+        await conn.execute(
+            text("ALTER TABLE logged_messages ADD COLUMN author_version_id INTEGER REFERENCES logged_authors (id)")
+        )
+
+    # stream the existing rows in id order, a batch at a time
+    dimensions = DimensionCache()
+    last_id = 0
+    n_converted = 0
+    while True:
+        async with db.engine.connect() as conn:
+            result = await conn.execute(
+                text(
+                    "SELECT id, channel_id, channel_name, parent_name, author_id, author_display_name, timestamp"
+                    " FROM logged_messages WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": BATCH_SIZE},
+            )
+            rows = result.all()
+        if not rows:
+            break
+
+        channel_keys = [(r.channel_id, r.channel_name, r.parent_name) for r in rows]
+        author_keys = [(r.author_id, r.author_display_name) for r in rows]
+        # the rows are in order, so the first time we see a name is the earliest
+        channel_first_seen = {}
+        author_first_seen = {}
+        for r, channel_key, author_key in zip(rows, channel_keys, author_keys):
+            channel_first_seen.setdefault(channel_key, r.timestamp)
+            author_first_seen.setdefault(author_key, r.timestamp)
+        # (committed in their own transactions)
+        channel_version_ids = await dimensions.channel_version_ids(channel_keys, channel_first_seen)
+        author_version_ids = await dimensions.author_version_ids(author_keys, author_first_seen)
+
+        async with db.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    "UPDATE logged_messages SET channel_version_id = :channel_version_id,"
+                    " author_version_id = :author_version_id WHERE id = :id"
+                ),
+                [
+                    {
+                        "id": r.id,
+                        "channel_version_id": channel_version_ids[channel_key],
+                        "author_version_id": author_version_ids[author_key],
+                    }
+                    for r, channel_key, author_key in zip(rows, channel_keys, author_keys)
+                ],
+            )
+        last_id = rows[-1].id
+        n_converted += len(rows)
+        print(f"Converted {n_converted} messages")
+
+    async with db.engine.begin() as conn:
+        # match the model; this fails (and keeps the name columns) if any row wasn't converted
+        if conn.dialect.name == "postgresql":
+            for column in ("channel_version_id", "author_version_id"):
+                await conn.execute(text(f"ALTER TABLE logged_messages ALTER COLUMN {column} SET NOT NULL"))
+        for column in ("channel_name", "parent_name", "author_display_name"):
+            await conn.execute(text(f"ALTER TABLE logged_messages DROP COLUMN {column}"))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())